@@ -0,0 +1,192 @@
+#The purpose of this file is to time the stages of data-creation on a synthetic race (see synthetic.py)
+#and to tell when one of them got slower or hungrier than the stored baseline.
+#Every stage runs in a fresh process with DATA_DIR pointing at the workspace of the scale, so its peak
+#memory is its own and nothing is cached from the stage before. The stages run in pipeline order, each
+#one on the output of the previous one: parse_file, parse_directory, combine_chunks, add_weather, metrics
+#and save_to_postgres (on SQLite, DB_URL points at a file in the workspace)
+#
+#   python bench.py --scale 1 10          run and compare against baseline.json
+#   python bench.py --scale 1 --save      run and store the results as the new baseline
+
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+import synthetic
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_CREATION_DIR = os.path.join(BENCHMARKS_DIR, "..", "data-creation")
+BASELINE_PATH = os.path.join(BENCHMARKS_DIR, "baseline.json")
+STAGES = ["parse_file", "parse_directory", "combine_chunks", "add_weather", "metrics", "save_to_postgres"]
+# parse_file is timed on the first files only, it measures the per file cost and not the directory
+PARSE_FILE_SAMPLE = 50
+# Slower throughput or more peak memory than the baseline by more than this counts as a regression
+TOLERANCE = 0.2
+
+
+def _peak_memory_mb() -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS, children covers the parser's process pool
+    unit = 1 if platform.system() == "Darwin" else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak * unit / 1024 / 1024
+
+
+# Runs inside the stage process, DATA_DIR and DB_URL are already set. Returns the rows the stage produced
+def _run_stage(stage: str) -> tuple:
+    sys.path.insert(0, DATA_CREATION_DIR)
+    import combiner
+    import metrics
+    import parser
+    import saver
+    import storage
+
+    started = time.perf_counter()
+    if stage == "parse_file":
+        files = sorted(f for f in os.listdir(parser.FILES_DIR) if f.endswith(".xlsx"))[:PARSE_FILE_SAMPLE]
+        rows = sum(len(parser.parse_file(os.path.join(parser.FILES_DIR, f))) for f in files)
+        return time.perf_counter() - started, rows
+    if stage == "parse_directory":
+        parser.parse_directory()
+        seconds = time.perf_counter() - started
+        return seconds, len(storage.read("total", columns=["Sailor"]))
+    if stage == "combine_chunks":
+        combiner.combine_chunks()
+        seconds = time.perf_counter() - started
+        with open(os.path.join(combiner.WIND_DIR, "wind_data.csv"), "r", encoding="utf-8") as f:
+            return seconds, sum(1 for _ in f) - 1
+    if stage == "add_weather":
+        combiner.add_weather()
+        seconds = time.perf_counter() - started
+        return seconds, len(storage.read("dataset", columns=["Sailor"]))
+    if stage == "metrics":
+        metrics.add_metrics()
+        seconds = time.perf_counter() - started
+        return seconds, len(storage.read("metrics", columns=["Sailor"]))
+    if stage == "save_to_postgres":
+        saver.save_to_postgres()
+        seconds = time.perf_counter() - started
+        with saver.create_engine(saver.DB_URL).connect() as connection:
+            return seconds, connection.execute(saver.select(saver.func.count()).select_from(saver.FactRace)).scalar()
+    raise ValueError(f"Unknown stage {stage}")
+
+
+# The outputs of an earlier run are removed, the generated files/ and chunks/ stay
+def _reset(workspace: str):
+    for name in ["output", "wind"]:
+        shutil.rmtree(os.path.join(workspace, name), ignore_errors=True)
+    if os.path.exists(os.path.join(workspace, "bench.db")):
+        os.remove(os.path.join(workspace, "bench.db"))
+
+
+def run_stage(stage: str, workspace: str) -> dict:
+    env = dict(os.environ, DATA_DIR=workspace, DB_URL=f"sqlite:///{os.path.join(workspace, 'bench.db')}")
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), "--stage", stage], env=env,
+                            stdout=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Stage {stage} failed with exit code {result.returncode}")
+    # The stage process prints its measurement as the last line, the logs go to stderr
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def run(scale: int, boats: int = synthetic.BOATS, repeat: int = 1) -> dict:
+    workspace = synthetic.generate(scale, boats)
+    results = {}
+    for _ in range(repeat):
+        _reset(workspace)
+        for stage in STAGES:
+            measured = run_stage(stage, workspace)
+            logger.info(f"{scale}x {stage}: {measured['seconds']:.2f}s, {measured['rows']} rows, "
+                        f"{measured['peak_mb']:.0f} MB")
+            best = results.get(stage)
+            # The fastest of the repeats, with the highest peak memory seen
+            if best is None or measured["seconds"] < best["seconds"]:
+                peak_mb = max(measured["peak_mb"], best["peak_mb"]) if best else measured["peak_mb"]
+                results[stage] = {**measured, "peak_mb": peak_mb}
+            else:
+                best["peak_mb"] = max(best["peak_mb"], measured["peak_mb"])
+    for measured in results.values():
+        measured["rows_per_s"] = measured["rows"] / measured["seconds"] if measured["seconds"] else float("inf")
+    return results
+
+
+def load_baseline(path: str = BASELINE_PATH) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_baseline(baseline: dict, path: str = BASELINE_PATH):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baseline, f, indent=2, sort_keys=True)
+    logger.info(f"Saved baseline to {path}")
+
+
+# Returns the regressions of one scale as readable lines, empty when everything is within tolerance
+def compare(results: dict, baseline: dict, tolerance: float = TOLERANCE) -> list:
+    regressions = []
+    for stage, measured in results.items():
+        reference = baseline.get(stage)
+        if reference is None:
+            continue
+        if measured["rows_per_s"] < reference["rows_per_s"] * (1 - tolerance):
+            regressions.append(f"{stage}: {measured['rows_per_s']:.0f} rows/s, baseline {reference['rows_per_s']:.0f}")
+        if measured["peak_mb"] > reference["peak_mb"] * (1 + tolerance):
+            regressions.append(f"{stage}: peak {measured['peak_mb']:.0f} MB, baseline {reference['peak_mb']:.0f} MB")
+    return regressions
+
+
+def report(scale: int, results: dict, baseline: dict):
+    print(f"\nScale {scale}x")
+    print(f"{'stage':<18}{'seconds':>10}{'rows':>12}{'rows/s':>12}{'peak MB':>10}{'vs baseline':>14}")
+    for stage in STAGES:
+        measured = results[stage]
+        reference = baseline.get(stage)
+        change = f"{measured['rows_per_s'] / reference['rows_per_s'] - 1:+.0%}" if reference else "-"
+        print(f"{stage:<18}{measured['seconds']:>10.2f}{measured['rows']:>12}{measured['rows_per_s']:>12.0f}"
+              f"{measured['peak_mb']:>10.0f}{change:>14}")
+
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description="Benchmark the data-creation stages on a synthetic race")
+    arguments.add_argument("--scale", type=int, nargs="+", default=[1], help="1, 10, 100 times the real race")
+    arguments.add_argument("--boats", type=int, default=synthetic.BOATS)
+    arguments.add_argument("--repeat", type=int, default=1, help="runs per scale, the fastest one counts")
+    arguments.add_argument("--tolerance", type=float, default=TOLERANCE)
+    arguments.add_argument("--save", action="store_true", help="store the results as the new baseline")
+    arguments.add_argument("--baseline", default=BASELINE_PATH)
+    arguments.add_argument("--stage", help=argparse.SUPPRESS)
+    args = arguments.parse_args()
+
+    if args.stage:
+        seconds, rows = _run_stage(args.stage)
+        print(json.dumps({"seconds": seconds, "rows": int(rows), "peak_mb": _peak_memory_mb()}))
+        sys.exit(0)
+
+    baseline = load_baseline(args.baseline)
+    regressions = []
+    for scale in args.scale:
+        key = f"{scale}x" if args.boats == synthetic.BOATS else f"{scale}x_{args.boats}boats"
+        results = run(scale, args.boats, args.repeat)
+        report(scale, results, baseline.get(key, {}))
+        regressions += [f"{key} {line}" for line in compare(results, baseline.get(key, {}), args.tolerance)]
+        if args.save:
+            baseline[key] = results
+
+    if args.save:
+        save_baseline(baseline, args.baseline)
+    elif regressions:
+        print("\nRegressions:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
@@ -0,0 +1,273 @@
+#The purpose of this file is to generate a race of any size to benchmark the stages on, the real one only
+#has about 18k rows. The leaderboards are written cell for cell in the format of the real .xlsx files
+#(title, two header rows, footer, coordinates like 45°52.87'N, "kts" and "nm" units, RET boats) and the
+#wind chunks hold the weather of exactly the positions the parser will read back from them.
+#Scale 1 is the size of the real race, scale 10 and 100 publish the leaderboards 10 and 100 times as often
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import zipfile
+from datetime import datetime, timedelta
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pandas as pd
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+WORKSPACE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "workspace")
+
+# The real race: 40 boats, a leaderboard every 4 hours for 77 days
+BOATS = 40
+LEADERBOARDS = 464
+STEP = timedelta(hours=4)
+START = datetime(2024, 11, 10, 14, 0)
+START_POSITION = (46.47, -1.79)
+RETIREMENT_RATE = 0.15
+MISSING_WIND_RATE = 0.01
+CHUNK_ROWS = 500
+
+FIRST_NAMES = ["Justine", "Sébastien", "Yannick", "Charlie", "Clarisse", "Thomas", "Isabelle", "Jérémie",
+               "Paul", "Samantha", "Boris", "Benjamin", "Violette", "Maxime", "Pip", "Louis"]
+LAST_NAMES = ["Mettraux", "Simon", "Bestaven", "Dalin", "Crémer", "Ruyant", "Joschke", "Beyou", "Meilhat",
+              "Davies", "Herrmann", "Dutreux", "Dorange", "Sorel", "Hare", "Burton"]
+NATIONS = ["FRA", "SUI", "GER", "GBR", "ITA", "JPN", "NZL", "USA", "BEL", "HUN"]
+
+HEADER = [
+    ["Rang\nRank", "Nat. / Voile\nNat. / Sail", "Skipper / Bateau\nSkipper / boat", None, None, None,
+     "Depuis 30 minutes\nSince 30 minutes", None, None, None,
+     "Depuis le dernier classement\nSince the the last report", None, None, None,
+     "Depuis 24 heures\nSince 24 hours", None, None, None, "DTF", "DTL"],
+    [None, None, None, "Heure FR\nHour FR", "Latitude\nLatitude", "Longitude\nLongitude"]
+    + ["Cap\nHeading", "Vitesse\nSpeed", "VMG\nVMG", "Distance\nDistance"] * 3 + [None, None],
+]
+FOOTER = [
+    ["Traitements et calculs : Géovoile, un service Hauwell Studios"],
+    [],
+    ["VMG : Velocity Made Good = projection du vecteur vitesse sur la route théorique."],
+    ["DTF : Distance To Finish = Distance théorique la plus courte pour rejoindre l'arrivée"],
+]
+
+_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+_ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="xl/workbook.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+_WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Classement" sheetId="1" r:id="rId1"/></sheets></workbook>'
+)
+_WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+    '</Relationships>'
+)
+
+
+def _column_letter(i: int) -> str:
+    letters = ""
+    i += 1
+    while i:
+        i, remainder = divmod(i - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+# A sheet of text cells, rows[i][j] lands in row i+1 and column j+2 (column A stays empty like in the real files).
+# The dimension starts at A1 so the grid read back starts there too
+def _sheet_xml(rows: list) -> str:
+    width = max(len(row) for row in rows) + 1
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        f'<dimension ref="A1:{_column_letter(width - 1)}{len(rows)}"/><sheetData>'
+    ]
+    for r, row in enumerate(rows, start=1):
+        parts.append(f'<row r="{r}">')
+        for c, value in enumerate(row, start=1):
+            if value is not None:
+                parts.append(f'<c r="{_column_letter(c)}{r}" t="inlineStr"><is><t xml:space="preserve">'
+                             f'{escape(value)}</t></is></c>')
+        parts.append('</row>')
+    parts.append('</sheetData></worksheet>')
+    return "".join(parts)
+
+
+def write_workbook(path: str, rows: list):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as workbook:
+        workbook.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        workbook.writestr("_rels/.rels", _ROOT_RELS)
+        workbook.writestr("xl/workbook.xml", _WORKBOOK)
+        workbook.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+        workbook.writestr("xl/worksheets/sheet1.xml", _sheet_xml(rows))
+
+
+def _coordinate(value: float, positive: str, negative: str, width: int) -> tuple:
+    # Rounded to the hundredth of a minute like the leaderboard, the float is what the parser makes of the text
+    minutes_total = round(abs(value) * 60, 2)
+    degrees, minutes = divmod(minutes_total, 60)
+    minutes = round(minutes, 2)
+    text = f"{int(degrees):0{width}d}°{minutes:05.2f}'{negative if value < 0 else positive}"
+    number = (int(degrees) + minutes / 60) * (-1 if value < 0 else 1)
+    return text, number
+
+
+def boats(n: int) -> pd.DataFrame:
+    names = [f"{FIRST_NAMES[i % len(FIRST_NAMES)]} {LAST_NAMES[(i // len(FIRST_NAMES) + i) % len(LAST_NAMES)]}"
+             for i in range(n)]
+    # Past 256 boats the first/last name pairs run out, a number keeps them unique
+    names = [name if i < len(FIRST_NAMES) * len(LAST_NAMES) else f"{name}{i}" for i, name in enumerate(names)]
+    return pd.DataFrame({
+        "Sailor": names,
+        "Nation": [NATIONS[i % len(NATIONS)] for i in range(n)],
+        "Sail": [f"FRA {i + 1:02d}" for i in range(n)],
+        "Team": [f"Team {name.split()[1]} - Océan {i}" for i, name in enumerate(names)],
+    })
+
+
+# Tracks of every boat at every leaderboard, arrays of shape (leaderboards, boats). Boats head south first
+# and then east around the globe with a bit of noise, some of them retire along the way
+def tracks(n_leaderboards: int, n_boats: int, step: timedelta, rng: np.random.Generator) -> dict:
+    hours = step.total_seconds() / 3600
+    progress = np.linspace(0, 1, n_leaderboards)[:, None]
+    base_heading = np.where(progress < 0.2, 200, np.where(progress < 0.85, 95, 20))
+    heading = (base_heading + rng.normal(0, 25, (n_leaderboards, n_boats))) % 360
+    speed = np.clip(rng.normal(14, 4, (n_leaderboards, n_boats)), 0.5, 30)
+    distance = speed * hours
+
+    lat = np.empty((n_leaderboards, n_boats))
+    lon = np.empty((n_leaderboards, n_boats))
+    lat[0] = START_POSITION[0] + rng.normal(0, 0.05, n_boats)
+    lon[0] = START_POSITION[1] + rng.normal(0, 0.05, n_boats)
+    radians = np.deg2rad(heading)
+    for i in range(1, n_leaderboards):
+        lat[i] = np.clip(lat[i - 1] + distance[i] * np.cos(radians[i]) / 60, -60, 60)
+        lon[i] = (lon[i - 1] + distance[i] * np.sin(radians[i]) / (60 * np.cos(np.deg2rad(lat[i]))) + 180) % 360 - 180
+
+    retired_at = np.where(rng.random(n_boats) < RETIREMENT_RATE,
+                          rng.integers(n_leaderboards // 4 + 1, n_leaderboards + 1, n_boats), n_leaderboards)
+    dtf = np.maximum(24300 - np.cumsum(distance * 0.8, axis=0), 0)
+    return {"lat": lat, "lon": lon, "heading": heading, "speed": speed, "distance": distance,
+            "dtf": dtf, "retired_at": retired_at}
+
+
+def _leaderboard_rows(time: datetime, fleet: list, track: dict, i: int, rng: np.random.Generator) -> tuple:
+    racing = np.flatnonzero(track["retired_at"] > i)
+    order = racing[np.argsort(track["dtf"][i, racing], kind="stable")]
+    leader_dtf = track["dtf"][i, order[0]] if len(order) else 0.0
+    clock = f"{time:%H:%M} FR\n"
+
+    rows = [[], [], [f"Classement du {time:%d/%m/%Y} à {time:%Hh%M} FR"]] + HEADER
+    wind = []
+    for rank, boat in enumerate(order, start=1):
+        sailor = fleet[boat]
+        lat_text, lat = _coordinate(track["lat"][i, boat], "N", "S", 2)
+        lon_text, lon = _coordinate(track["lon"][i, boat], "E", "W", 3)
+        heading = int(track["heading"][i, boat])
+        speed = track["speed"][i, boat]
+        vmg = speed * rng.uniform(0.4, 1.0)
+        distance = track["distance"][i, boat]
+        rows.append([
+            str(rank), f"{sailor['Nation']}\n{sailor['Sail']}", f"{sailor['Sailor']}\n{sailor['Team']}", clock,
+            lat_text, lon_text,
+            f"{heading}°", f"{speed:.1f} kts", f"{vmg:.1f} kts", f"{speed * 0.5:.1f} nm",
+            f"{(heading + 3) % 360}°", f"{speed * 0.95:.1f} kts", f"{vmg * 0.95:.1f} kts", f"{distance:.1f} nm",
+            f"{(heading + 7) % 360}°", f"{speed * 0.9:.1f} kts", f"{vmg * 0.9:.1f} kts", f"{speed * 21.6:.1f} nm",
+            f"{track['dtf'][i, boat]:.1f} nm", f"{track['dtf'][i, boat] - leader_dtf:.1f} nm",
+        ])
+        wind.append((time.replace(second=0), lat, lon, sailor["Sailor"]))
+    for boat in np.flatnonzero(track["retired_at"] <= i):
+        sailor = fleet[boat]
+        rows.append(["RET", f"{sailor['Nation']}\n{sailor['Sail']}", f"{sailor['Sailor']}\n{sailor['Team']}"])
+    return rows + FOOTER, wind
+
+
+# Wind rows in the shape of wind/wind_data.csv (km/h), split in chunk files like call_for_data writes them
+def _write_wind_chunks(positions: list, chunks_dir: str, rng: np.random.Generator) -> int:
+    df = pd.DataFrame(positions, columns=["Time in France", "Latitude", "Longitude", "Sailor"])
+    speed = np.round(np.clip(rng.gamma(4, 6, len(df)), 0, 120), 1)
+    df["Wind Speed"] = speed
+    df["Wind Direction"] = rng.integers(0, 360, len(df))
+    df["Wind Gust"] = np.round(speed * rng.uniform(1.1, 1.5, len(df)), 1)
+    missing = rng.random(len(df)) < MISSING_WIND_RATE
+    df.loc[missing, ["Wind Speed", "Wind Direction", "Wind Gust"]] = np.nan
+
+    for start in range(0, len(df), CHUNK_ROWS):
+        end = min(start + CHUNK_ROWS, len(df))
+        df.iloc[start:end].to_csv(os.path.join(chunks_dir, f"synthetic_with_wind_chunk_{start:08d}_{end:08d}.csv"),
+                                  index=False)
+    return len(df)
+
+
+def workspace_path(scale: int, boats_count: int = BOATS) -> str:
+    suffix = "" if boats_count == BOATS else f"_{boats_count}boats"
+    return os.path.join(WORKSPACE_DIR, f"{scale}x{suffix}")
+
+
+# Writes files/ (leaderboards) and chunks/ (wind) of a DATA_DIR for the given scale. A workspace generated
+# with the same parameters is reused, generation is deterministic for a given seed
+def generate(scale: int = 1, boats_count: int = BOATS, seed: int = 0, output_dir: str = None) -> str:
+    output_dir = output_dir or workspace_path(scale, boats_count)
+    n_leaderboards = LEADERBOARDS * scale
+    step = STEP / scale
+    params = {"scale": scale, "boats": boats_count, "leaderboards": n_leaderboards, "seed": seed}
+
+    params_path = os.path.join(output_dir, "synthetic.json")
+    if os.path.exists(params_path):
+        with open(params_path, "r", encoding="utf-8") as f:
+            if json.load(f).get("params") == params:
+                logger.info(f"Synthetic race {params} already in {output_dir}")
+                return output_dir
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    files_dir = os.path.join(output_dir, "files")
+    chunks_dir = os.path.join(output_dir, "chunks")
+    os.makedirs(files_dir)
+    os.makedirs(chunks_dir)
+
+    rng = np.random.default_rng(seed)
+    fleet = boats(boats_count).to_dict("records")
+    track = tracks(n_leaderboards, boats_count, step, rng)
+    positions = []
+    for i in range(n_leaderboards):
+        time = START + i * step
+        rows, wind = _leaderboard_rows(time, fleet, track, i, rng)
+        write_workbook(os.path.join(files_dir, f"leaderboard_{time:%Y%m%d_%H%M%S}.xlsx"), rows)
+        positions.extend(wind)
+    wind_rows = _write_wind_chunks(positions, chunks_dir, rng)
+
+    with open(params_path, "w", encoding="utf-8") as f:
+        json.dump({"params": params, "rows": wind_rows}, f, indent=2)
+    logger.info(f"Generated {n_leaderboards} leaderboards with {wind_rows} racing rows in {output_dir}")
+    return output_dir
+
+
+if __name__ == "__main__":
+    arguments = argparse.ArgumentParser(description="Generate a synthetic race to benchmark the stages on")
+    arguments.add_argument("--scale", type=int, nargs="+", default=[1], help="1, 10, 100 times the real race")
+    arguments.add_argument("--boats", type=int, default=BOATS)
+    arguments.add_argument("--seed", type=int, default=0)
+    args = arguments.parse_args()
+    for scale in args.scale:
+        generate(scale, args.boats, args.seed)
@@ -0,0 +1,139 @@
+#The purpose of this file is to keep the weather fetched by call_for_data in one place that survives a crash
+#at any moment. Every chunk is appended as one Arrow record batch to a single data file and only counts once
+#its line is in the journal: the batch is written and synced first, then the journal line with its row range,
+#offset, length and CRC32. On open, a torn journal line or batch bytes without a journal line (the process
+#died in between) are cut off, so resuming asks again for exactly the rows that never made it.
+#Reading memory-maps the data file and hands out the batches without copying or parsing them again.
+#One process writes to a store at a time
+
+import json
+import logging
+import os
+import zlib
+
+import pandas as pd
+import pyarrow as pa
+
+import schema
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = schema.arrow_schema("wind")
+DATA_FILE = "batches.arrows"
+JOURNAL_FILE = "journal.jsonl"
+
+
+def _sync(f):
+    f.flush()
+    os.fsync(f.fileno())
+
+
+# Sorted, merged (start, end) ranges
+def _merge(ranges: list) -> list:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class ChunkStore:
+    """
+    Append-only store of enriched rows. A part (e.g. "first_part_with_wind") is one input file of
+    call_for_data, every entry covers the rows start:end of it.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.data_path = os.path.join(path, DATA_FILE)
+        self.journal_path = os.path.join(path, JOURNAL_FILE)
+        os.makedirs(path, exist_ok=True)
+        self.entries = self._recover()
+
+    # Keeps the journal up to its last complete line and the data file up to the last journaled batch
+    def _recover(self) -> list:
+        entries = []
+        kept = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb") as f:
+                content = f.read()
+            for line in content.splitlines(keepends=True):
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    break
+                kept += len(line)
+            if kept < len(content):
+                logger.warning(f"Dropping {len(content) - kept} bytes of an unfinished journal line in {self.path}")
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(kept)
+
+        size = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        complete = [entry for entry in entries if entry["offset"] + entry["length"] <= size]
+        if len(complete) < len(entries):
+            # Journal lines are only written after their batch, this means the data file was cut short
+            logger.error(f"{len(entries) - len(complete)} journaled batches are missing from {self.data_path}")
+        end = max((entry["offset"] + entry["length"] for entry in complete), default=0)
+        if size > end:
+            logger.warning(f"Dropping {size - end} bytes of an unfinished batch in {self.data_path}")
+            with open(self.data_path, "r+b") as f:
+                f.truncate(end)
+        return complete
+
+    def __len__(self) -> int:
+        return sum(entry["end"] - entry["start"] for entry in self.entries)
+
+    def completed(self, part: str) -> list:
+        return _merge([(entry["start"], entry["end"]) for entry in self.entries if entry["part"] == part])
+
+    # The row ranges of a part of total_rows rows that are not in the store yet
+    def missing(self, part: str, total_rows: int) -> list:
+        gaps = []
+        position = 0
+        for start, end in self.completed(part):
+            if start > position:
+                gaps.append((position, min(start, total_rows)))
+            position = max(position, end)
+        if position < total_rows:
+            gaps.append((position, total_rows))
+        return [(start, end) for start, end in gaps if start < end]
+
+    # data is a DataFrame or an Arrow table with the SCHEMA columns
+    def append(self, part: str, start: int, end: int, data, source: str = None):
+        if isinstance(data, pd.DataFrame):
+            table = schema.to_arrow(data, "wind")
+        else:
+            table = data.select(SCHEMA.names).cast(SCHEMA)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, SCHEMA) as writer:
+            writer.write_table(table)
+        buffer = sink.getvalue()
+
+        with open(self.data_path, "ab") as f:
+            offset = f.tell()
+            f.write(buffer)
+            _sync(f)
+        entry = {"part": part, "start": start, "end": end, "rows": table.num_rows, "offset": offset,
+                 "length": buffer.size, "crc32": zlib.crc32(buffer), "source": source}
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+            _sync(f)
+        self.entries.append(entry)
+
+    # Every batch ordered by part and row, straight from the memory-mapped data file.
+    # verify=True checks the CRC32 of every batch first
+    def read(self, verify: bool = True) -> pa.Table:
+        if not self.entries:
+            return SCHEMA.empty_table()
+        buffer = pa.memory_map(self.data_path, "r").read_buffer()
+        tables = []
+        for entry in sorted(self.entries, key=lambda e: (e["part"], e["start"])):
+            piece = buffer.slice(entry["offset"], entry["length"])
+            if verify and zlib.crc32(piece) != entry["crc32"]:
+                raise ValueError(f"Batch {entry['part']} {entry['start']}-{entry['end']} of {self.data_path} is corrupted")
+            tables.append(pa.ipc.open_stream(piece).read_all())
+        return pa.concat_tables(tables)
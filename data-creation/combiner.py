@@ -3,29 +3,45 @@
 
 import logging
 import os
+from contextlib import nullcontext
 from time import sleep
 
+import numpy as np
 import requests
 import pandas as pd
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
 from datetime import datetime, timedelta
 from tqdm import tqdm
 import time
-import glob
 import re
+from itertools import groupby
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler()
-    ]
-)
+import instrumentation
+import schema
+import storage
+from chunk_store import ChunkStore, SCHEMA as CHUNK_SCHEMA
+from weather_cache import WeatherCache, get_default_cache
+from wind_field import WindField, corner_queries
+
+instrumentation.setup_logging()
 logger = logging.getLogger(__name__)
 
-OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
-CHUNKS_DIR = os.path.join(os.path.dirname(__file__), "chunks")
-WIND_DIR = os.path.join(os.path.dirname(__file__), "wind")
+DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(__file__))
+OUTPUT_DIR = os.path.join(DATA_DIR, "output")
+CHUNKS_DIR = os.path.join(DATA_DIR, "chunks")
+WIND_DIR = os.path.join(DATA_DIR, "wind")
 os.makedirs(WIND_DIR, exist_ok=True)
+# call_for_data appends its chunks here, combine_chunks turns them into wind_data.csv
+STORE_DIR = os.path.join(WIND_DIR, "store")
+# add_weather splits wind_data.csv by race day this many rows at a time, into the "wind" dataset of WIND_DIR
+WIND_CHUNK_ROWS = int(os.environ.get("WIND_CHUNK_ROWS", 500_000))
+
+ARCHIVE_API_URL = os.environ.get("ARCHIVE_API_URL", "https://archive-api.open-meteo.com/v1/archive")
+# The archive lags a few days behind, live positions are enriched from the forecast API which also serves the last days
+FORECAST_API_URL = os.environ.get("FORECAST_API_URL", "https://api.open-meteo.com/v1/forecast")
+HOURLY_VARIABLES = ["wind_speed_10m", "wind_direction_10m", "wind_gusts_10m"]
+WIND_COLUMNS = ["Wind Speed", "Wind Direction", "Wind Gust"]
 
 
 #this function is only written for presentation sake, the true combining takes place
@@ -33,8 +49,7 @@ os.makedirs(WIND_DIR, exist_ok=True)
 #This file is only used when preparing the dataset for merging
 #this is not used when running normally or in docker
 def create_fetch_parameters_csv():
-    df = pd.read_csv(OUTPUT_DIR + "/total.csv")
-    df_fetch_parameters = df[["Time in France", "Latitude", "Longitude","Sailor"]]
+    df_fetch_parameters = storage.read("total", columns=["Time in France", "Latitude", "Longitude", "Sailor"])
     df_first9999 = df_fetch_parameters.iloc[:9999]
     df_rest = df_fetch_parameters.iloc[9999:]
 
@@ -42,7 +57,8 @@ def create_fetch_parameters_csv():
     df_rest.to_csv(os.path.join(OUTPUT_DIR, "fetch_parameters_rest.csv"), index=False)
 
 
-def call_for_data(which_part: int, chunk_size: int = 100):
+def call_for_data(which_part: int, chunk_size: int = 100, cache: WeatherCache = None):
+    cache = cache or get_default_cache()
     if which_part == 0:
         input_file = os.path.join(OUTPUT_DIR, "fetch_parameters_first9999.csv")
         output_file_base = "first_part_with_wind"
@@ -50,35 +66,29 @@ def call_for_data(which_part: int, chunk_size: int = 100):
         input_file = os.path.join(OUTPUT_DIR, "fetch_parameters_rest.csv")
         output_file_base = "second_part_with_wind"
 
-    df = pd.read_csv(input_file)
+    df = pd.read_csv(input_file, parse_dates=["Time in France"])
     total_rows = len(df)
     logger.info(f"Processing {total_rows} rows in chunks of {chunk_size}...")
 
-    # Find last completed chunk
-    os.makedirs(CHUNKS_DIR, exist_ok=True)
-    chunk_files = glob.glob(os.path.join(CHUNKS_DIR, f"{output_file_base}_chunk_*.csv"))
-
-    last_completed_end = -1
-    pattern = re.compile(r"_chunk_(\d+)_(\d+)\.csv$")
-    for f in chunk_files:
-        m = pattern.search(f)
-        if m:
-            start_idx, end_idx = int(m.group(1)), int(m.group(2))
-            last_completed_end = max(last_completed_end, end_idx)
-
-    logger.info(f"Last completed chunk ends at row {last_completed_end}. Resuming from next chunk...")
+    # Only the row ranges the journal does not know yet are fetched, whatever happened to the run before
+    store = ChunkStore(STORE_DIR)
+    missing = store.missing(output_file_base, total_rows)
+    logger.info(f"{total_rows - sum(end - start for start, end in missing)} rows already in the store, "
+                f"fetching {len(missing)} missing range(s)...")
 
     # Process in chunks
-    for start in range(last_completed_end, total_rows, chunk_size):
-        end = min(start + chunk_size, total_rows)
+    chunks = [(start, min(start + chunk_size, range_end))
+              for range_start, range_end in missing for start in range(range_start, range_end, chunk_size)]
+    for start, end in chunks:
         df_chunk = df.iloc[start:end].copy()
+        misses = cache.misses
 
         wind_speeds = []
         wind_dirs = []
         wind_gusts = []
 
         for _, row in tqdm(df_chunk.iterrows(), total=len(df_chunk), desc=f"Rows {start}-{end}"):
-            ws, wd, wg = fetch_weather_for_row(row)
+            ws, wd, wg = fetch_weather_for_row(row, cache=cache)
             wind_speeds.append(ws)
             wind_dirs.append(wd)
             wind_gusts.append(wg)
@@ -87,45 +97,229 @@ def call_for_data(which_part: int, chunk_size: int = 100):
         df_chunk["Wind Direction"] = wind_dirs
         df_chunk["Wind Gust"] = wind_gusts
 
-        chunk_file = os.path.join(CHUNKS_DIR, f"{output_file_base}_chunk_{start}_{end}.csv")
-        df_chunk.to_csv(chunk_file, index=False)
-        logger.info(f"Saved chunk {start}-{end} to {chunk_file}")
-        sleep(60)
+        store.append(output_file_base, start, end, df_chunk)
+        logger.info(f"Saved chunk {start}-{end} to {STORE_DIR}")
+        # Every cache miss is a request, a chunk the cache answered entirely does not count against the rate limit
+        if cache.misses > misses:
+            sleep(60)
 
 
 
-def fetch_weather_for_row(row, max_retries=3):
+# The answer for the row's cell and day is taken from the weather cache when it is there
+def fetch_weather_for_row(row, max_retries=3, cache: WeatherCache = None):
+    cache = cache or get_default_cache()
     lat = row['Latitude']
     lon = row['Longitude']
-    row_time = datetime.fromisoformat(row['Time in France'])
+    row_time = datetime.fromisoformat(str(row['Time in France']))
     date_str = row_time.strftime("%Y-%m-%d")
 
-    url = (
-        "https://archive-api.open-meteo.com/v1/archive?"
-        f"latitude={lat}&longitude={lon}&start_date={date_str}&end_date={date_str}"
-        "&hourly=wind_speed_10m,wind_direction_10m,wind_gusts_10m&timezone=Europe/Paris"
-    )
+    hourly = cache.get(lat, lon, date_str)
+    if hourly is None:
+        url = (
+            f"{ARCHIVE_API_URL}?"
+            f"latitude={lat}&longitude={lon}&start_date={date_str}&end_date={date_str}"
+            "&hourly=wind_speed_10m,wind_direction_10m,wind_gusts_10m&timezone=Europe/Paris"
+        )
+
+        for attempt in range(max_retries):
+            try:
+                instrumentation.count("http_requests")
+                response = requests.get(url, timeout=60)
+                response.raise_for_status()  # Raise error if status != 200
+                hourly = response.json().get("hourly", {})
+                break
+
+            except (requests.RequestException, ValueError) as e:
+                instrumentation.count("http_retries")
+                logger.warning(f"Attempt {attempt+1} failed for {lat},{lon} at {row_time}: {e}")
+                time.sleep(2)  # wait a bit before retrying
+
+        if hourly is None:
+            instrumentation.count("http_failures")
+            return None, None, None
+        cache.put(lat, lon, date_str, hourly)
+
+    times = [datetime.fromisoformat(t) for t in hourly.get("time", [])]
+    if not times:
+        return None, None, None
+    nearest_idx = min(range(len(times)), key=lambda i: abs(times[i] - row_time))
+    wind_speed = hourly["wind_speed_10m"][nearest_idx]
+    wind_dir = hourly["wind_direction_10m"][nearest_idx]
+    wind_gust = hourly["wind_gusts_10m"][nearest_idx]
+    return wind_speed, wind_dir, wind_gust
+
+# One request for many locations over a date range, the API answers with one result per location
+# (a single object instead of a list when only one location was asked for)
+def fetch_weather_batch(session, cells: list, start_date: str, end_date: str, max_retries=3,
+                        api_url: str = None) -> list:
+    params = {
+        "latitude": ",".join(f"{lat:.4f}" for lat, _ in cells),
+        "longitude": ",".join(f"{lon:.4f}" for _, lon in cells),
+        "start_date": start_date,
+        "end_date": end_date,
+        "hourly": ",".join(HOURLY_VARIABLES),
+        "timezone": "Europe/Paris",
+    }
 
     for attempt in range(max_retries):
         try:
-            response = requests.get(url, timeout=60)
-            response.raise_for_status()  # Raise error if status != 200
+            instrumentation.count("http_requests")
+            response = session.get(api_url or ARCHIVE_API_URL, params=params, timeout=60)
+            response.raise_for_status()
             data = response.json()
-            hourly = data.get("hourly", {})
-            times = [datetime.fromisoformat(t) for t in hourly.get("time", [])]
-            if not times:
-                return None, None, None
-            nearest_idx = min(range(len(times)), key=lambda i: abs(times[i] - row_time))
-            wind_speed = hourly["wind_speed_10m"][nearest_idx]
-            wind_dir = hourly["wind_direction_10m"][nearest_idx]
-            wind_gust = hourly["wind_gusts_10m"][nearest_idx]
-            return wind_speed, wind_dir, wind_gust
+            if isinstance(data, dict):
+                data = [data]
+            if len(data) != len(cells):
+                raise ValueError(f"expected {len(cells)} locations, got {len(data)}")
+            return [location.get("hourly", {}) for location in data]
 
         except (requests.RequestException, ValueError) as e:
-            print(f"Attempt {attempt+1} failed for {lat},{lon} at {row_time}: {e}")
-            time.sleep(2)  # wait a bit before retrying
+            instrumentation.count("http_retries")
+            logger.warning(f"Attempt {attempt+1} failed for {len(cells)} locations {start_date}..{end_date}: {e}")
+            time.sleep(2)
+
+    instrumentation.count("http_failures")
+    return [{} for _ in cells]
+
+
+# Picks the hourly sample closest to every query time, vectorized with searchsorted
+def nearest_hourly_samples(hourly: dict, query_times: np.ndarray) -> np.ndarray:
+    samples = np.full((len(query_times), len(HOURLY_VARIABLES)), np.nan)
+    if not hourly.get("time"):
+        return samples
+
+    times = np.array(hourly["time"], dtype="datetime64[m]")
+    query_times = query_times.astype("datetime64[m]")
+    right = np.clip(np.searchsorted(times, query_times), 0, len(times) - 1)
+    left = np.clip(right - 1, 0, len(times) - 1)
+    nearest = np.where(np.abs(times[left] - query_times) <= np.abs(times[right] - query_times), left, right)
+
+    for i, variable in enumerate(HOURLY_VARIABLES):
+        values = np.array(hourly.get(variable, []), dtype="float64")
+        if len(values) == len(times):
+            samples[:, i] = values[nearest]
+    return samples
+
+
+# Positions are snapped to a grid of grid_resolution degrees and grouped by days_per_request day windows,
+# every window asks for all of its cells in requests of up to locations_per_request locations.
+# Open-Meteo's reanalysis grid is ~0.25 degrees, so snapping to it costs next to no accuracy.
+# Every batch is (start_date, end_date, [(lat, lon), ...], [row indices of each cell, ...])
+def plan_weather_batches(df: pd.DataFrame, grid_resolution: float = 0.25, locations_per_request: int = 100,
+                         days_per_request: int = 1) -> list:
+    if df.empty:
+        return []
+
+    days = df["Time in France"].to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")
+    first_day = days.min()
+    window = (days - first_day).astype(int) // days_per_request
+
+    cells = pd.DataFrame({
+        "window": window,
+        "cell_lat": np.round(df["Latitude"].to_numpy() / grid_resolution) * grid_resolution,
+        "cell_lon": np.round(df["Longitude"].to_numpy() / grid_resolution) * grid_resolution,
+    })
+    cell_rows = cells.groupby(["window", "cell_lat", "cell_lon"], sort=True).indices
+
+    batches = []
+    for w, window_cells in groupby(sorted(cell_rows), key=lambda key: key[0]):
+        window_cells = list(window_cells)
+        start = first_day + np.timedelta64(int(w) * days_per_request, "D")
+        end = min(start + np.timedelta64(days_per_request - 1, "D"), days.max())
+        for i in range(0, len(window_cells), locations_per_request):
+            batch_cells = window_cells[i:i + locations_per_request]
+            coordinates = [(float(lat), float(lon)) for _, lat, lon in batch_cells]
+            batches.append((str(start), str(end), coordinates, [cell_rows[key] for key in batch_cells]))
+    return batches
+
+
+def save_wind_data(df: pd.DataFrame, wind: np.ndarray, output_path: str):
+    df = df.copy()
+    df[WIND_COLUMNS] = wind
+    df.to_csv(output_path, index=False)
+    logger.info(f"Saved weather for {len(df)} rows ({int(np.isnan(wind[:, 0]).sum())} without data) to {output_path}")
+
+
+# Runs the batches of plan_weather_batches through the weather cache, only the cells the cache does not
+# know yet are asked for. Yields every batch together with the hourly answer of each of its cells
+# cache=None fetches everything, api_url defaults to the archive. A caller that runs many of these can pass its
+# own session, otherwise one is opened for the batches
+def fetch_batches_cached(batches: list, cache: WeatherCache, api_url: str = None, progress: bool = True,
+                         session: requests.Session = None):
+    requests_made = 0
+    with nullcontext(session) if session is not None else requests.Session() as session:
+        for batch in tqdm(batches, desc="Fetching weather", disable=not progress):
+            start, end, coordinates, _ = batch
+            if cache is not None:
+                hourly_per_cell = cache.get_range_many(coordinates, start, end)
+            else:
+                hourly_per_cell = [None] * len(coordinates)
+            missing = [i for i, hourly in enumerate(hourly_per_cell) if hourly is None]
+            if missing:
+                missing_coordinates = [coordinates[i] for i in missing]
+                fetched = fetch_weather_batch(session, missing_coordinates, start, end, api_url=api_url)
+                if cache is not None:
+                    cache.put_range_many(missing_coordinates, fetched)
+                requests_made += 1
+                for i, hourly in zip(missing, fetched):
+                    hourly_per_cell[i] = hourly
+            yield batch, hourly_per_cell
+
+    if cache is not None:
+        logger.info(f"Made {requests_made} requests, weather cache: {cache.stats()}")
+    else:
+        logger.info(f"Made {requests_made} requests")
+
+
+# Batched version of call_for_data, one request per batch of plan_weather_batches instead of one per row,
+# every row then takes its nearest hour from the cell it fell in
+@instrumentation.measured("fetch_weather")
+def call_for_data_batched(grid_resolution: float = 0.25, locations_per_request: int = 100,
+                          days_per_request: int = 1, output_path: str = None, cache: WeatherCache = None):
+    cache = cache or get_default_cache()
+    output_path = output_path or os.path.join(WIND_DIR, "wind_data.csv")
+    df = storage.read("total", columns=["Time in France", "Latitude", "Longitude", "Sailor"])
+    if df.empty:
+        logger.warning("No positions to enrich.")
+        return
+
+    batches = plan_weather_batches(df, grid_resolution, locations_per_request, days_per_request)
+    logger.info(f"Fetching weather for {len(df)} rows with {len(batches)} requests")
+
+    query_times = df["Time in France"].to_numpy(dtype="datetime64[ns]")
+    wind = np.full((len(df), len(HOURLY_VARIABLES)), np.nan)
+    for (_, _, _, cell_rows), hourly_per_cell in fetch_batches_cached(batches, cache):
+        for rows, hourly in zip(cell_rows, hourly_per_cell):
+            wind[rows] = nearest_hourly_samples(hourly, query_times[rows])
+
+    save_wind_data(df, wind, output_path)
+
+
+# Like call_for_data_batched, but the grid nodes around every position are fetched and the wind is
+# interpolated in space and time with wind_field.WindField instead of taking the nearest hour of one cell.
+# Boats close to each other share the same nodes, on the sample race this takes ~3x the requests of the batched mode
+@instrumentation.measured("fetch_weather")
+def call_for_data_interpolated(grid_resolution: float = 0.25, locations_per_request: int = 100,
+                               days_per_request: int = 1, output_path: str = None, cache: WeatherCache = None):
+    cache = cache or get_default_cache()
+    output_path = output_path or os.path.join(WIND_DIR, "wind_data.csv")
+    df = storage.read("total", columns=["Time in France", "Latitude", "Longitude", "Sailor"])
+    if df.empty:
+        logger.warning("No positions to enrich.")
+        return
+
+    nodes = corner_queries(df, grid_resolution)
+    batches = plan_weather_batches(nodes, grid_resolution, locations_per_request, days_per_request)
+    logger.info(f"Fetching weather for {len(df)} rows from {len(nodes)} grid node hours with {len(batches)} requests")
+
+    entries = []
+    for (_, _, coordinates, _), hourly_per_cell in fetch_batches_cached(batches, cache):
+        entries.extend((lat, lon, hourly) for (lat, lon), hourly in zip(coordinates, hourly_per_cell))
+
+    field = WindField.from_hourly(entries, grid_resolution)
+    speed, direction, gust = field.interpolate(df["Time in France"], df["Latitude"], df["Longitude"])
+    save_wind_data(df, np.column_stack([speed, direction, gust]), output_path)
 
-    return None, None, None
 
 def kmh_to_knots(kmh: float) -> float:
     knots =  (kmh / 1.852)
@@ -133,8 +327,84 @@ def kmh_to_knots(kmh: float) -> float:
 
 
 
-def add_weather():
-    if not os.path.exists(OUTPUT_DIR + "/total.csv" ):
+# The weather for a handful of rows (one leaderboard, or a few in the streaming pipeline), in knots like add_weather.
+# Live mode asks the forecast API without the weather cache, today's hours are partly forecast and get revised.
+# Rows without weather are kept with NaN wind, a late or failed answer should not hide a boat from the dashboard
+def enrich_rows(df: pd.DataFrame, grid_resolution: float = 0.25, api_url: str = FORECAST_API_URL,
+                cache: WeatherCache = None, session: requests.Session = None) -> pd.DataFrame:
+    df = df.reset_index(drop=True)
+    query_times = df["Time in France"].to_numpy(dtype="datetime64[ns]")
+    wind = np.full((len(df), len(HOURLY_VARIABLES)), np.nan)
+    batches = plan_weather_batches(df, grid_resolution)
+    fetched = fetch_batches_cached(batches, cache, api_url, progress=False, session=session)
+    for (_, _, _, cell_rows), hourly_per_cell in fetched:
+        for rows, hourly in zip(cell_rows, hourly_per_cell):
+            wind[rows] = nearest_hourly_samples(hourly, query_times[rows])
+
+    df[WIND_COLUMNS] = wind
+    for column in ["Wind Speed", "Wind Gust"]:
+        df[column] = (df[column] / 1.852).round(1)
+    missing = int(df[WIND_COLUMNS].isna().any(axis=1).sum())
+    if missing:
+        logger.warning(f"No weather for {missing} of {len(df)} rows")
+    return df
+
+
+# Leaderboard rows and wind rows are matched on sailor and exact time with merge_asof instead of
+# rounded float coordinates. A sailor can have two rows with the same time (stale snapshots), so the
+# n-th such row on one side is paired with the n-th on the other, and the positions only have to agree
+# within position_tolerance degrees. Rows without a match or without wind are dropped and counted
+def join_weather(df_vendee: pd.DataFrame, df_wind: pd.DataFrame, position_tolerance: float = 1e-4) -> tuple:
+    keys = ["Sailor", "Occurrence"]
+    # Both sides hold the sailors as categories but each with its own, the union gives them the same codes
+    sailors = pd.api.types.union_categoricals(
+        [pd.Categorical(df_vendee["Sailor"].astype(object)), pd.Categorical(df_wind["Sailor"].astype(object))]
+    ).categories
+
+    left = df_vendee.copy()
+    right = df_wind.copy()
+    for frame in (left, right):
+        frame["Sailor"] = pd.Categorical(frame["Sailor"].astype(object), categories=sailors)
+        frame["Occurrence"] = frame.groupby(["Sailor", "Time in France"], observed=True).cumcount()
+    right = right.rename(columns={"Latitude": "Wind Latitude", "Longitude": "Wind Longitude"})
+
+    left = left.reset_index(drop=True).sort_values("Time in France", kind="stable")
+    right = right.sort_values("Time in France", kind="stable")
+    merged = pd.merge_asof(left, right, on="Time in France", by=keys, direction="nearest",
+                           tolerance=pd.Timedelta(0))
+
+    same_position = (
+        ((merged["Latitude"] - merged["Wind Latitude"]).abs() <= position_tolerance)
+        & ((merged["Longitude"] - merged["Wind Longitude"]).abs() <= position_tolerance)
+    )
+    has_wind = merged[WIND_COLUMNS].notna().all(axis=1)
+    stats = {
+        "rows": len(merged),
+        "matched": int((same_position & has_wind).sum()),
+        "unmatched": int((~same_position).sum()),
+        "missing_wind": int((same_position & ~has_wind).sum()),
+    }
+
+    merged = merged[same_position & has_wind].sort_index()
+    merged = merged.drop(columns=["Occurrence", "Wind Latitude", "Wind Longitude"])
+    merged["Sailor"] = merged["Sailor"].cat.remove_unused_categories()
+    return merged.reset_index(drop=True), stats
+
+
+# The wind of one race day of the "wind" dataset (see add_weather), in knots
+def read_wind_data(race_day: str) -> pd.DataFrame:
+    df_wind_data = storage.read("wind", filters=[(storage.PARTITION_COLUMN, "==", race_day)], output_dir=WIND_DIR)
+    # km/h to knots, same rounding as kmh_to_knots without going through Python for every cell
+    for column in ["Wind Speed", "Wind Gust"]:
+        df_wind_data[column] = (df_wind_data[column] / 1.852).round(1)
+    return df_wind_data
+
+
+# The join runs one race day at a time, so only that day of the leaderboard and of the wind is in memory.
+# wind_data.csv is first split by race day a chunk at a time, then every day reads its own partition
+@instrumentation.measured("weather")
+def add_weather(position_tolerance: float = 1e-4):
+    if not storage.exists("total"):
         logger.info(f"Origin file does not exist {OUTPUT_DIR}. Skipping processing.")
         logger.info("Generate or drop in the file in order to use this step")
         return
@@ -143,50 +413,79 @@ def add_weather():
         logger.info("Generate or drop in the file in order to use this step")
         return
 
-    df_vendee = pd.read_csv(OUTPUT_DIR + "/total.csv")
-    df_wind_data = pd.read_csv(WIND_DIR + "/wind_data.csv")
-
-    print(df_vendee.info())
-    print(df_wind_data.info())
-
-    df_wind_data["Wind Speed"] = df_wind_data["Wind Speed"].apply(kmh_to_knots)
-    df_wind_data["Wind Gust"] = df_wind_data["Wind Gust"].apply(kmh_to_knots)
-
-    df_wind_data["Latitude"] = df_wind_data["Latitude"].round(4)
-    df_wind_data["Longitude"] = df_wind_data["Longitude"].round(4)
-    df_vendee["Latitude"] = df_vendee["Latitude"].round(4)
-    df_vendee["Longitude"] = df_vendee["Longitude"].round(4)
-
-    df_wind_data = df_wind_data.dropna()
-
-    merged = pd.merge(
-        df_wind_data,
-        df_vendee,
-        on=["Time in France", "Sailor", "Latitude", "Longitude"],
-        how="inner")
-
-    merged.to_csv(OUTPUT_DIR + "/dataset.csv", index=False)
-
+    with instrumentation.stage("read_wind") as stage:
+        stage.rows_out = storage.import_csv(WIND_DIR + "/wind_data.csv", "wind", WIND_CHUNK_ROWS, output_dir=WIND_DIR)
+
+    totals = {"rows": 0, "matched": 0, "unmatched": 0, "missing_wind": 0}
+    mode = "overwrite"
+    with instrumentation.stage("join") as stage:
+        for race_day, df_vendee in tqdm(storage.iter_race_days("total"), desc="Joining weather", unit="day"):
+            merged, stats = join_weather(df_vendee, read_wind_data(race_day), position_tolerance)
+            for key, value in stats.items():
+                totals[key] += value
+            if not merged.empty:
+                storage.write(merged, "dataset", mode=mode)
+                mode = "append"
+        stage.rows_in = totals["rows"]
+        stage.rows_out = totals["matched"]
+
+    stage = instrumentation.current()
+    stage.rows_in = totals["rows"]
+    stage.rows_out = totals["matched"]
+    stage.count("unmatched", totals["unmatched"])
+    stage.count("missing_wind", totals["missing_wind"])
+    logger.info(f"Joined weather to {totals['matched']} of {totals['rows']} rows, dropped "
+                f"{totals['unmatched']} without a wind row and {totals['missing_wind']} without wind data")
+
+
+# Chunk CSVs of older runs (or dropped in, like the data samples) go into the store once. A file with fewer
+# rows than its name says was cut off while writing and is left out, so its rows get fetched again
+def import_csv_chunks(store: ChunkStore, chunks_dir: str = CHUNKS_DIR) -> int:
+    if not os.path.isdir(chunks_dir):
+        return 0
+    pattern = re.compile(r"^(.+)_chunk_(\d+)_(\d+)\.csv$")
+    known = {entry["source"] for entry in store.entries}
+    imported = 0
+    for name in sorted(os.listdir(chunks_dir)):
+        m = pattern.match(name)
+        if not m or name in known:
+            continue
+        part, start, end = m.group(1), int(m.group(2)), int(m.group(3))
+        if any(start >= done_start and end <= done_end for done_start, done_end in store.completed(part)):
+            continue
+        table = pa_csv.read_csv(
+            os.path.join(chunks_dir, name),
+            convert_options=pa_csv.ConvertOptions(column_types=CHUNK_SCHEMA, include_columns=CHUNK_SCHEMA.names),
+        )
+        if table.num_rows != end - start:
+            logger.warning(f"{name} has {table.num_rows} rows instead of {end - start}, not importing it")
+            continue
+        store.append(part, start, end, table, source=name)
+        imported += table.num_rows
+    if imported:
+        logger.info(f"Imported {imported} rows of chunk files into {store.path}")
+    return imported
+
+
+# The store is read without copying and written out as CSV by Arrow, the chunks are not parsed again.
+# The file is replaced in one go, a reader never sees half of it
+@instrumentation.measured("combine_chunks")
 def combine_chunks():
     os.makedirs(WIND_DIR, exist_ok=True)
     output_path = os.path.join(WIND_DIR, "wind_data.csv")
 
-    files = sorted([os.path.join(CHUNKS_DIR, f) for f in os.listdir(CHUNKS_DIR) if f.endswith(".csv")])
-    if not files:
-        logger.warning("No chunk files found.")
+    store = ChunkStore(STORE_DIR)
+    import_csv_chunks(store)
+    if not store.entries:
+        logger.warning("No chunks found.")
         return
 
-    for i, f in enumerate(tqdm(files, desc="Merging incrementally")):
-        df = pd.read_csv(f)
-        mode = "w" if i == 0 else "a"
-        header = i == 0
-        df.to_csv(output_path, mode=mode, header=header, index=False)
-        del df
+    table = store.read()
+    times = pc.strftime(table["Time in France"].cast("timestamp[s]"), format="%Y-%m-%d %H:%M:%S")
+    table = table.set_column(0, "Time in France", times)
+    temporary_path = output_path + ".tmp"
+    pa_csv.write_csv(table, temporary_path)
+    os.replace(temporary_path, output_path)
 
+    instrumentation.current().rows_out = table.num_rows
     logger.info(f"✅ Combined CSV saved to {output_path}")
-
-
-
-
-
-
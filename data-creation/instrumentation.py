@@ -0,0 +1,369 @@
+#The purpose of this file is to know where a run spends its time without guesswork. Every stage and sub-step
+#is measured (wall time, CPU time, peak RSS while it ran, rows in and out and counters like HTTP requests,
+#retries and cache hits) and written as one JSON line to the run report in output/reports as soon as it finishes.
+#PROFILE=parse,weather (stage names, or "all") runs those stages under cProfile, PROFILER=sample uses a
+#sampling profiler instead that sees every thread, the profiles are saved next to the report
+
+import contextvars
+import cProfile
+import functools
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+from datetime import datetime
+
+import storage
+
+logger = logging.getLogger(__name__)
+
+REPORT_DIR = os.environ.get("REPORT_DIR", os.path.join(storage.OUTPUT_DIR, "reports"))
+PROFILE = [name.strip() for name in os.environ.get("PROFILE", "").split(",") if name.strip()]
+PROFILER = os.environ.get("PROFILER", "cprofile")
+SAMPLE_INTERVAL = 0.005
+# How often the RSS of the process is looked at while stages are open
+RSS_INTERVAL = 0.01
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_current = contextvars.ContextVar("instrumentation_stage", default=None)
+_lock = threading.Lock()
+_run = None
+
+
+def setup_logging(level: str = None):
+    logging.basicConfig(
+        level=level or os.environ.get("LOG_LEVEL", "INFO"),
+        format=LOG_FORMAT,
+        handlers=[
+            logging.StreamHandler()
+        ]
+    )
+
+
+# Highest RSS of the process (or of its biggest finished child) since it started, not of a stage
+def _process_peak_rss_mb(who) -> float:
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if platform.system() == "Darwin" else 1024
+    return resource.getrusage(who).ru_maxrss * unit / 1024 / 1024
+
+
+# Current RSS from /proc (Linux), None where there is no /proc
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+# High water mark of the RSS (VmHWM), what ru_maxrss reports for the process
+def _hwm_mb() -> float:
+    try:
+        with open("/proc/self/status", "rb") as f:
+            for line in f:
+                if line.startswith(b"VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class RssWatch(threading.Thread):
+    """
+    Peak RSS of every open stage: the RSS is read every `interval` seconds while a stage is open (and when
+    a stage opens or closes) and counts for all the stages open at that moment. When the high water mark of
+    the process went up while a stage was open, that new high is its exact peak. Resetting the high water
+    mark instead (/proc/self/clear_refs) would also reset ru_maxrss, which the benchmarks read.
+    """
+
+    def __init__(self, interval: float = RSS_INTERVAL):
+        super().__init__(name="rss-watch", daemon=True)
+        self.interval = interval
+        # stage -> [peak so far, high water mark when it opened]
+        self.peaks = {}
+        self.lock = threading.Lock()
+        self.active = threading.Event()
+
+    def _sample(self):
+        rss = _rss_mb()
+        if rss is None:
+            return
+        with self.lock:
+            for peak in self.peaks.values():
+                peak[0] = max(peak[0], rss)
+
+    def run(self):
+        while self.active.wait():
+            self._sample()
+            time.sleep(self.interval)
+
+    def open(self, stage):
+        rss = _rss_mb()
+        if rss is None:
+            return
+        hwm = _hwm_mb()
+        with self.lock:
+            self.peaks[stage] = [rss, hwm]
+            if not self.is_alive():
+                self.start()
+            self.active.set()
+
+    # Peak RSS in MB since `stage` was opened, None without /proc
+    def close(self, stage) -> float:
+        self._sample()
+        hwm = _hwm_mb()
+        with self.lock:
+            peak, opened_hwm = self.peaks.pop(stage, (None, None))
+            if not self.peaks:
+                self.active.clear()
+        if peak is not None and hwm is not None and opened_hwm is not None and hwm > opened_hwm:
+            peak = max(peak, hwm)
+        return peak
+
+
+_rss_watch = RssWatch()
+
+
+# A forked worker (the parser's process pool) does not get the thread, it starts its own
+def _after_fork():
+    global _rss_watch
+    _rss_watch = RssWatch()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _children_cpu() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Sampler(threading.Thread):
+    """
+    Sampling profiler: looks at the stack of every thread every `interval` seconds and counts the
+    stacks, saved in the collapsed format flamegraph.pl and speedscope read.
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        super().__init__(name="sampler", daemon=True)
+        self.interval = interval
+        self.stacks = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                key = ";".join([names.get(ident, str(ident))] + stack[::-1])
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+    def enable(self):
+        self.start()
+
+    def disable(self):
+        self.stopped.set()
+        self.join()
+
+    def dump_stats(self, path: str):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, samples in sorted(self.stacks.items()):
+                f.write(f"{stack} {samples}\n")
+
+
+class Stage:
+    """
+    One measured stage or sub-step. Counters and rows are added while it runs, the record is written
+    to the run report when it exits.
+    """
+
+    def __init__(self, name: str, rows_in: int = None):
+        self.name = name
+        self.parent = _current.get()
+        self.path = f"{self.parent.path}/{name}" if self.parent else name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.counters = {}
+        # Wall time of the sub-steps by name, for one line summaries
+        self.steps = {}
+        self.wall = None
+        self.profiler = None
+        self.profile_path = None
+
+    def count(self, counter: str, n: int = 1):
+        with _lock:
+            stage = self
+            while stage is not None:
+                stage.counters[counter] = stage.counters.get(counter, 0) + n
+                stage = stage.parent
+
+    def summary(self) -> str:
+        steps = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.steps.items())
+        total = f"total {self.wall:.2f}s" if self.wall is not None else "running"
+        return f"{steps}, {total}" if steps else total
+
+    def _wants_profile(self) -> bool:
+        if not PROFILE:
+            return False
+        if not ("all" in PROFILE or self.name in PROFILE or self.path in PROFILE):
+            return False
+        # A profiled parent already covers this stage
+        stage = self.parent
+        while stage is not None:
+            if stage.profiler is not None:
+                return False
+            stage = stage.parent
+        return True
+
+    def _start_profiler(self):
+        profiler = Sampler() if PROFILER == "sample" else cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Another profiler is already active in this process (e.g. a stage of another thread under cProfile)
+            logger.warning(f"Not profiling {self.path}: {e}")
+            return
+        self.profiler = profiler
+        extension = "folded" if PROFILER == "sample" else "prof"
+        # Outside of a run (e.g. a stage called from the benchmarks) the profile gets a name of its own
+        report_dir = _run.report_dir if _run is not None else REPORT_DIR
+        prefix = _run.id if _run is not None else f"{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}"
+        os.makedirs(report_dir, exist_ok=True)
+        self.profile_path = os.path.join(report_dir, f"{prefix}.{self.path.replace('/', '.')}.{extension}")
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        self._started_at = datetime.now()
+        self._started = time.perf_counter()
+        self._cpu = time.process_time()
+        self._thread_cpu = time.thread_time()
+        self._children_cpu = _children_cpu()
+        _rss_watch.open(self)
+        if self._wants_profile():
+            self._start_profiler()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.profile_path)
+        self.wall = time.perf_counter() - self._started
+        peak_rss = _rss_watch.close(self)
+        _current.reset(self._token)
+        if self.parent is not None:
+            with _lock:
+                self.parent.steps[self.name] = self.parent.steps.get(self.name, 0.0) + self.wall
+
+        record = {
+            "type": "run" if self is _run else "stage",
+            "stage": self.path,
+            "thread": threading.current_thread().name,
+            "started": self._started_at.isoformat(timespec="milliseconds"),
+            "wall_s": round(self.wall, 4),
+            # Process CPU time includes the other threads running at the same time, thread CPU time only this one
+            "cpu_s": round(time.process_time() - self._cpu, 4),
+            "thread_cpu_s": round(time.thread_time() - self._thread_cpu, 4),
+            "children_cpu_s": round(_children_cpu() - self._children_cpu, 4),
+            # RSS while this stage was open (other threads' stages included), None where it cannot be read
+            "peak_rss_mb": round(peak_rss, 1) if peak_rss is not None else None,
+            # ru_maxrss: the whole process so far, and the biggest of its finished child processes
+            "process_peak_rss_mb": round(_process_peak_rss_mb(resource.RUSAGE_SELF), 1),
+            "process_children_peak_rss_mb": round(_process_peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "counters": dict(self.counters),
+            "error": f"{exc_type.__name__}: {exc}" if exc_type is not None else None,
+            "profile": self.profile_path,
+        }
+        if _run is not None:
+            _run.write(record)
+        logger.debug(f"⏱ {self.path}: {self.summary()}, {self.rows_out} rows out, {self.counters}")
+        if self.profile_path is not None:
+            logger.info(f"Profile of {self.path} saved to {self.profile_path}")
+        return False
+
+
+class Run(Stage):
+    """
+    The outermost stage of a process, owns the report file. A run inside a run is a plain stage.
+    """
+
+    def __init__(self, name: str, report_dir: str = None):
+        super().__init__(name)
+        self.report_dir = report_dir or REPORT_DIR
+        self.id = f"{name}_{datetime.now():%Y%m%d_%H%M%S}_{os.getpid()}"
+        self.report_path = os.path.join(self.report_dir, f"{self.id}.jsonl")
+
+    def write(self, record: dict):
+        with _lock:
+            with open(self.report_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"run": self.id, **record}, default=str) + "\n")
+
+    def __enter__(self):
+        global _run
+        os.makedirs(self.report_dir, exist_ok=True)
+        _run = self
+        self.write({"type": "start", "argv": sys.argv, "pid": os.getpid(), "profile": PROFILE, "profiler": PROFILER})
+        return super().__enter__()
+
+    def __exit__(self, exc_type, exc, traceback):
+        global _run
+        try:
+            return super().__exit__(exc_type, exc, traceback)
+        finally:
+            _run = None
+            logger.info(f"⏱ {self.name}: {self.summary()}, report saved to {self.report_path}")
+
+
+def run(name: str, report_dir: str = None) -> Stage:
+    if _run is not None:
+        return Stage(name)
+    return Run(name, report_dir)
+
+
+def stage(name: str, rows_in: int = None) -> Stage:
+    return Stage(name, rows_in)
+
+
+# Decorator version of stage() (or of run() for an entry point), the function can reach its stage with current()
+def measured(name: str, is_run: bool = False):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with (run(name) if is_run else Stage(name)):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def current() -> Stage:
+    return _current.get()
+
+
+# Adds to a counter of the stage this code runs in and of all the stages around it, does nothing outside of a stage
+def count(counter: str, n: int = 1):
+    stage = _current.get()
+    if stage is not None:
+        stage.count(counter, n)
+
+
+# Threads do not inherit the current stage, a function handed to a thread or pool is bound to it here
+def bind(function):
+    stage = _current.get()
+
+    def bound(*args, **kwargs):
+        token = _current.set(stage)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            _current.reset(token)
+    return bound
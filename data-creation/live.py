@@ -0,0 +1,100 @@
+#The purpose of this file is to follow a race while it is on. Instead of rerunning the whole pipeline,
+#it waits for the next leaderboard, parses just that file, fetches the weather for its ~40 rows and
+#appends them to the dataset and the database, so a new leaderboard is on the dashboards within a minute
+
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine
+
+import combiner
+import instrumentation
+import metrics
+import parser
+import saver
+import scraper
+import storage
+
+logger = logging.getLogger(__name__)
+
+STEP_HOURS = scraper.step_hours
+# Polling starts MIN_DELAY seconds apart once a leaderboard is due and backs off up to MAX_DELAY
+MIN_DELAY = 10
+MAX_DELAY = 60
+TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S"
+
+
+# The timestamp after the newest leaderboard we already have, or the start of the race
+def next_timestamp() -> datetime:
+    files = [f for f in os.listdir(scraper.FILES_DIR) if f.startswith("leaderboard_") and f.endswith(".xlsx")]
+    if not files:
+        return datetime.strptime(scraper.start_date, TIMESTAMP_FORMAT)
+    newest = max(files)[len("leaderboard_"):-len(".xlsx")]
+    return datetime.strptime(newest, TIMESTAMP_FORMAT) + timedelta(hours=STEP_HOURS)
+
+
+# Parse, enrich and load one downloaded leaderboard, returns the number of rows loaded
+def process(ts: str, engine) -> int:
+    with instrumentation.stage("leaderboard") as leaderboard:
+        with instrumentation.stage("parse") as stage:
+            df = parser.ingest_file(f"leaderboard_{ts}.xlsx")
+            stage.rows_out = len(df)
+        if df.empty:
+            logger.info(f"{ts} brought no new rows")
+            return 0
+
+        with instrumentation.stage("weather", rows_in=len(df)):
+            df = combiner.enrich_rows(df)
+
+        with instrumentation.stage("load", rows_in=len(df)) as stage:
+            if storage.exists("dataset"):
+                storage.write(df, "dataset", mode="append")
+            stage.rows_out = saver.save_rows(df, engine)
+        # The metrics of a new report need the reports before it, they are recomputed over the whole dataset
+        if storage.exists("dataset"):
+            metrics.add_metrics()
+            with engine.connect() as connection:
+                saver.load_metrics(connection, df["Time in France"].min().date())
+        leaderboard.rows_out = len(df)
+
+    lag = datetime.now() - datetime.strptime(ts, TIMESTAMP_FORMAT)
+    logger.info(f"{ts}: {len(df)} rows live ({leaderboard.summary()}), {lag} after the leaderboard time")
+    return len(df)
+
+
+@instrumentation.measured("live", is_run=True)
+def run(until: str = None):
+    until = datetime.strptime(until or scraper.end_date, TIMESTAMP_FORMAT)
+    engine = create_engine(saver.DB_URL)
+    saver.create_schema(engine)
+    expected = next_timestamp()
+    delay = MIN_DELAY
+    logger.info(f"Following the race from {expected:%Y-%m-%d %H:%M}")
+
+    while expected <= until:
+        now = datetime.now()
+        if now < expected:
+            time.sleep(min((expected - now).total_seconds(), MAX_DELAY))
+            continue
+
+        ts = expected.strftime(TIMESTAMP_FORMAT)
+        with instrumentation.stage("poll") as poll:
+            status, message = scraper.download_file(ts)
+        logger.info(f"{message} ({poll.wall:.2f}s)")
+
+        if status in ("saved", "skipped"):
+            process(ts, engine)
+            expected += timedelta(hours=STEP_HOURS)
+            delay = MIN_DELAY
+        elif now >= expected + timedelta(hours=STEP_HOURS):
+            # The next one is already due, this one is not coming any more
+            logger.warning(f"{ts} was never published, moving on")
+            expected += timedelta(hours=STEP_HOURS)
+            delay = MIN_DELAY
+        else:
+            time.sleep(delay)
+            delay = min(delay * 2, MAX_DELAY)
+
+    logger.info("Reached the end of the race.")
@@ -1,16 +1,50 @@
+import os
+import sys
+
 import scraper
 import parser
 import combiner
 import saver
+import live
+import metrics
+import pipeline
+import scheduler
+import tracks
+import instrumentation
+
+# PARSE_BACKEND=spark parses the workbooks with the PySpark engine in ../spark (needs pyspark and Java)
+PARSE_BACKEND = os.environ.get("PARSE_BACKEND", "pandas")
+
+
+def parse():
+    if PARSE_BACKEND == "spark":
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "spark"))
+        import sparky
+        sparky.parse_directory()
+    else:
+        parser.parse_directory()
 
 
 def main():
-    scraper.download()
-    parser.parse_directory()
-    combiner.add_weather()
-    saver.save_to_postgres()
+    with instrumentation.run("batch"):
+        scraper.download()
+        parse()
+        tracks.build()
+        combiner.add_weather()
+        metrics.add_metrics()
+        saver.save_to_postgres()
     quit(0)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    # "python main.py live" follows the race after the batch pipeline has caught up
+    if len(sys.argv) > 1 and sys.argv[1] == "live":
+        live.run()
+    # "python main.py pipeline" streams every file through all the stages instead of running them one after another
+    elif len(sys.argv) > 1 and sys.argv[1] == "pipeline":
+        pipeline.run()
+    # "python main.py races [race id ...]" runs the pipelines of the races in races.json side by side
+    elif len(sys.argv) > 1 and sys.argv[1] == "races":
+        scheduler.run(sys.argv[2:])
+    else:
+        main()
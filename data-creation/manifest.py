@@ -0,0 +1,44 @@
+#The purpose of this file is to remember which leaderboard files were already parsed, so a rerun
+#during the race only has to parse the new (or changed) ones instead of the whole files/ directory
+
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+def load_manifest(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# Written to a temp file first and then renamed, a crash mid-write never leaves a broken manifest
+def save_manifest(manifest: dict, path: str):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# Size and mtime are checked first so unchanged files do not have to be hashed again
+def fingerprint(path: str, previous: dict = None) -> dict:
+    stat = os.stat(path)
+    if previous and previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime:
+        return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": previous["sha256"]}
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_hash(path)}
+
+
+def has_changed(entry: dict, current: dict) -> bool:
+    return entry is None or entry.get("sha256") != current["sha256"]
@@ -0,0 +1,118 @@
+#The purpose of this file is to compute the sailing metrics we chart from the enriched dataset: the true wind
+#angle, the distance actually sailed between two reports and the speed over ground it gives, the speed
+#relative to the wind and to the fleet's polar, ranking changes and the distance sailed over the last 24h.
+#Everything is NumPy over whole columns: rows are sorted once by (sailor, time), "the report before" is the
+#row before unless it belongs to another sailor, and the 24h windows come from cumulative sums and a
+#searchsorted on (sailor, second) keys, so millions of rows take seconds instead of a Python loop per row
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import storage
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_NM = 3440.065
+WINDOW_HOURS = 24
+# The polar is the fleet's best speed (POLAR_QUANTILE, so one bad report does not set it) per true wind angle
+# and true wind speed bin
+POLAR_ANGLE_BIN = 10
+POLAR_WIND_BIN = 2
+POLAR_QUANTILE = 0.95
+INPUT_COLUMNS = ["Sailor", "Time in France", "Ranking", "Latitude", "Longitude", "Heading 30min", "Speed 30min",
+                 "Wind Speed", "Wind Direction"]
+
+
+# Signed difference a - b in degrees, between -180 and 180
+def angle_difference(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.mod(a - b + 180, 360) - 180
+
+
+def haversine_nm(lat1: np.ndarray, lon1: np.ndarray, lat2: np.ndarray, lon2: np.ndarray) -> np.ndarray:
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_NM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+# Best speed of the fleet in the (angle, wind) bin of every row, NaN where the bin has no speed
+def polar_speed(speed: np.ndarray, twa: np.ndarray, tws: np.ndarray) -> np.ndarray:
+    bins = np.floor(twa / POLAR_ANGLE_BIN) * 1000 + np.floor(tws / POLAR_WIND_BIN)
+    known = np.isfinite(bins) & np.isfinite(speed)
+    targets = pd.Series(speed[known]).groupby(bins[known]).quantile(POLAR_QUANTILE)
+    return targets.reindex(bins).to_numpy(dtype="float64")
+
+
+# Metrics of every row of df (INPUT_COLUMNS are enough), in the order of df. The first report of a sailor
+# has no report before it, its distances and changes are NaN
+def compute(df: pd.DataFrame) -> pd.DataFrame:
+    codes = pd.Categorical(df["Sailor"].astype(object)).codes.astype("int64")
+    seconds = df["Time in France"].to_numpy(dtype="datetime64[s]").astype("int64")
+    order = np.lexsort((seconds, codes))
+    codes, seconds = codes[order], seconds[order]
+
+    def column(name: str) -> np.ndarray:
+        return df[name].to_numpy(dtype="float64", na_value=np.nan)[order]
+
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = codes[1:] != codes[:-1]
+    previous = np.maximum(np.arange(len(order)) - 1, 0)
+
+    lat, lon = column("Latitude"), column("Longitude")
+    heading, speed = column("Heading 30min"), column("Speed 30min")
+    tws, ranking = column("Wind Speed"), column("Ranking")
+
+    distance = np.where(first, np.nan, haversine_nm(lat[previous], lon[previous], lat, lon))
+    hours = np.where(first, np.nan, (seconds - seconds[previous]) / 3600)
+    twa = np.abs(angle_difference(column("Wind Direction"), heading))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        speed_over_ground = np.where(hours > 0, distance / hours, np.nan)
+        speed_to_wind = np.where(tws > 0, speed / tws, np.nan)
+        polar = polar_speed(speed, twa, tws)
+        performance = np.where(polar > 0, speed / polar, np.nan)
+
+    # Reports of the same sailor within the last WINDOW_HOURS: the window starts at the first key after (sailor, t - window).
+    # The leg into that first report started before the window, only the share of its time inside the window counts
+    window_start = seconds - WINDOW_HOURS * 3600
+    keys = (codes << 32) | seconds
+    start = np.searchsorted(keys, (codes << 32) | window_start, side="right")
+    legs = np.nan_to_num(distance)
+    cumulative = np.concatenate([[0.0], np.cumsum(legs)])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inside = np.where(first[start], 0.0, (seconds[start] - window_start) / (hours[start] * 3600))
+    distance_24h = cumulative[1:] - cumulative[start + 1] + legs[start] * np.clip(inside, 0, 1)
+
+    metrics = {
+        "True Wind Angle": twa,
+        "Heading Change": np.where(first, np.nan, angle_difference(heading, heading[previous])),
+        "Distance Sailed": distance,
+        "Speed Over Ground": speed_over_ground,
+        "Speed To Wind": speed_to_wind,
+        "Polar Speed": polar,
+        "Polar Performance": performance,
+        # Places gained since the report before
+        "Ranking Change": np.where(first, np.nan, ranking[previous] - ranking),
+        "Distance Sailed 24h": distance_24h,
+    }
+    result = pd.DataFrame({"Sailor": df["Sailor"].to_numpy(), "Time in France": df["Time in France"].to_numpy()})
+    for name, values in metrics.items():
+        unsorted = np.empty_like(values)
+        unsorted[order] = values
+        result[name] = unsorted
+    result["Ranking Change"] = result["Ranking Change"].round().astype("Int64")
+    return result
+
+
+@instrumentation.measured("metrics")
+def add_metrics():
+    if not storage.exists("dataset"):
+        logger.info("Dataset does not exist yet. Skipping metrics.")
+        return
+    df = storage.read("dataset", columns=INPUT_COLUMNS)
+    stage = instrumentation.current()
+    stage.rows_in = len(df)
+    metrics = compute(df)
+    storage.write(metrics, "metrics")
+    stage.rows_out = len(metrics)
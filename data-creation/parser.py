@@ -1,19 +1,31 @@
 import os
+import re
+import numpy as np
 import pandas as pd
 import logging
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler()
-    ]
-)
+import instrumentation
+import races
+import schema
+import storage
+from manifest import load_manifest, save_manifest, fingerprint, has_changed
+
+instrumentation.setup_logging()
 logger = logging.getLogger(__name__)
 
-FILES_DIR = os.path.join(os.path.dirname(__file__), "files")
-OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "output")
+DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(__file__))
+FILES_DIR = os.path.join(DATA_DIR, "files")
+OUTPUT_DIR = os.path.join(DATA_DIR, "output")
+PARTITIONS_DIR = os.path.join(OUTPUT_DIR, "partitions")
+MANIFEST_PATH = os.path.join(OUTPUT_DIR, "manifest.json")
+# PARSE_WORKERS (env) is the size of the parsing pool, the scheduler shares the CPUs out between races
+PARSE_WORKERS = int(os.environ.get("PARSE_WORKERS", "0")) or os.cpu_count() or 1
+# Sheet quirks of the race this process works on (races.py)
+race = races.current()
+HEADER_ROW = race.header_row
+DROPPED_STATUS = race.dropped_status
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 
@@ -60,140 +72,230 @@ def parse_distance(distance: str) -> float:
         raise
 
 
+# Vectorized versions of the parsers above, they work on a whole column at once with the
+# pandas string accessors instead of calling the scalar function once per cell.
+# The results are the same as the scalar ones, except that a bad cell becomes NaN instead of raising
+_NUMBER = r"[+-]?(?:\d+\.?\d*|\.\d+)"
+_INTEGER = r"[+-]?\d+"
 
 
-def parse_file(filename: str) -> pd.DataFrame:
-    logger.info(f"Parsing file: {filename}")
+# Anything that is not a string (empty cells, stray numbers) is treated as a bad cell
+def _as_text(values: pd.Series) -> pd.Series:
+    values = values.astype("object")
+    return values.where(values.map(type) == str, np.nan)
 
-    try:
-        # Date parts
-        basename = os.path.basename(filename)
-        date_str = basename.split("_")[1]
-        date_part = pd.to_datetime(date_str, format="%Y%m%d").date()
-        logger.debug(f"Extracted date: {date_part}")
-
-        df_check = pd.read_excel(filename, engine="calamine", skiprows=3, nrows=1)
-
-        # Check if ARV format exists
-        if any('arrivée' in str(col).lower() or 'arrival date' in str(col).lower() for col in df_check.columns):
-            logger.info("Detected ARV format, searching for racing table...")
-
-            # Read full file to find racing header
-            df_full = pd.read_excel(filename, engine="calamine", header=None)
-
-            beginning_of_racing_rows = 3  # default
-            for idx in range(len(df_full)):
-                row_values = df_full.iloc[idx].astype(str).str.cat(sep=' ')
-                if 'Depuis 30 minutes' in row_values or 'Since 30 minutes' in row_values:
-                    beginning_of_racing_rows = idx
-                    logger.info(f"Found racing data starting at row {idx}")
-                    break
-        else:
-            beginning_of_racing_rows = 3
 
+# Only strings that look like numbers are handed to float(), so the values come out bit for bit
+# the same as with the scalar parsers and anything else turns into NaN
+def _to_float(values: pd.Series, pattern: str = _NUMBER) -> pd.Series:
+    values = values.str.strip()
+    valid = values.str.fullmatch(pattern, na=False)
+    return values.where(valid, np.nan).astype("float64")
 
 
+def parse_coordinates_column(cords: pd.Series) -> pd.Series:
+    parts = _as_text(cords).str.extract(r"^([^°]*)°([^°]*)[^°]([^°])$")
+    degrees = _to_float(parts[0])
+    minutes = _to_float(parts[1])
+    decimal_degrees = degrees + minutes / 60
+    sign = np.where(parts[2].isin(["S", "W"]), -1.0, 1.0)
+    return decimal_degrees * sign
 
-        df = pd.read_excel(filename, engine="calamine", skiprows=beginning_of_racing_rows)
 
-        df = df.iloc[:, 1:]
-        df = df.iloc[:-4, :]
-        df = df.drop(0, errors="ignore")
+def parse_heading_column(heading: pd.Series) -> pd.Series:
+    return _to_float(_as_text(heading).str[:-1], _INTEGER).astype("Int64")
 
-        # Cleaning column strings of useless tabs and spaces
-        df.columns = df.columns.str.replace(r'[\r\n]+', ' ', regex=True).str.strip()
-        # Cleaning row strings of useless tabs and spaces
-        df = df.map(lambda x: str(x).replace("\r\n", " ").strip() if isinstance(x, str) else x)
 
-        #Get rid of RET,DNF or ARV Sailors
-        first_col = df.columns[0]
-        df = df[~df[first_col].astype(str).str.strip().isin(['RET', 'DNF', 'ARV'])]
-        df = df.reset_index(drop=True)
+def parse_speed_column(speed: pd.Series) -> pd.Series:
+    return _to_float(_as_text(speed).str[:-3])
 
 
+def parse_distance_column(distance: pd.Series) -> pd.Series:
+    return _to_float(_as_text(distance).str[:-2])
 
 
+# "Justine Mettraux\nTeamWork - Team Snef" -> first two words are the sailor, the rest is the team
+def parse_sailor_and_team_column(names: pd.Series) -> pd.DataFrame:
+    parts = _as_text(names).str.extract(r"^\s*(\S+)(?:\s+(\S+))?(.*)$", flags=re.DOTALL)
+    sailor = parts[0].str.cat(parts[1], sep=" ", na_rep="").str.strip().where(parts[0].notna())
+    team = parts[2].str.strip()
+    return pd.DataFrame({"Sailor": sailor, "Team": team}, index=names.index)
 
-        # Renaming
-        df.rename(columns={
-            df.columns.values[0]: "Ranking",
-            df.columns.values[1]: "Sailor Nationality and Sail Number",
-            df.columns.values[2]: "Sailor Name and Team Name",
-            df.columns.values[3]: "Time in France",
-            df.columns.values[4]: "Latitude",
-            df.columns.values[5]: "Longitude",
 
-            "Depuis 30 minutes Since 30 minutes": "Heading 30min",
-            "Unnamed: 8": "Speed 30min",
-            "Unnamed: 9": "VMG 30min",
-            "Unnamed: 10": "Dist 30min",
+# "SUI\nFRA 08" -> first word is the nation, the last two are the sail number
+def parse_nation_and_sail_column(values: pd.Series) -> pd.DataFrame:
+    values = _as_text(values)
+    nation = values.str.extract(r"^\s*(\S+)")[0]
+    sail_parts = values.str.extract(r"(?:(\S+)\s+)?(\S+)\s*$")
+    sail = sail_parts[0].str.cat(sail_parts[1], sep=" ", na_rep="").str.strip().where(sail_parts[1].notna())
+    return pd.DataFrame({"Nation": nation, "Sail": sail}, index=values.index)
 
-            "Depuis le dernier classement Since the the last report": "Heading Last Report",
-            "Unnamed: 12": "Speed Last Report",
-            "Unnamed: 13": "VMG Last Report",
-            "Unnamed: 14": "Dist Last Report",
 
-            "Depuis 24 heures Since 24 hours": "Heading 24h",
-            "Unnamed: 16": "Speed 24h",
-            "Unnamed: 17": "VMG 24h",
-            "Unnamed: 18": "Dist 24h",
-        }, inplace=True)
+def _clean_cells(values: pd.Series) -> pd.Series:
+    text = _as_text(values)
+    return text.str.replace("\r\n", " ", regex=False).str.strip().where(text.notna(), values)
 
-        # Applying
-        df["Latitude"] = df["Latitude"].apply(parse_coordinates)
-        df["Longitude"] = df["Longitude"].apply(parse_coordinates)
 
-        df["Sailor"] = df["Sailor Name and Team Name"].apply(lambda x: " ".join(x.split()[:2]))
-        df["Team"] = df.apply(lambda row: row["Sailor Name and Team Name"].replace(row["Sailor"], "").strip(), axis=1)
-        df["Nation"] = df["Sailor Nationality and Sail Number"].apply(lambda x: " ".join(x.split()[:1]))
-        df["Sail"] = df["Sailor Nationality and Sail Number"].apply(lambda x: " ".join(x.split()[-2:]))
+# Cells with something in them, after _clean_cells a cell of only spaces is an empty string
+def _filled(values):
+    return values.notna() & values.ne("")
 
-        df["Time in France"] = df["Time in France"].apply(lambda t: t.split()[0])
-        df["Time in France"] = df["Time in France"].apply(
-            lambda t: pd.to_datetime(f"{date_part} {t}", format="%Y-%m-%d %H:%M"))
 
+# "22:30 FR" -> the hour of the report on the day taken from the file name
+def parse_time_column(times: pd.Series, date_part) -> pd.Series:
+    hours = _as_text(times).str.extract(r"^\s*(\S+)")[0]
+    return pd.to_datetime(f"{date_part} " + hours, format="%Y-%m-%d %H:%M", errors="coerce")
 
 
-        df["Heading 30min"] = df["Heading 30min"].apply(parse_heading)
-        df["Heading Last Report"] = df["Heading Last Report"].apply(parse_heading)
-        df["Heading 24h"] = df["Heading 24h"].apply(parse_heading)
+# Leaderboards only have ~40 rows, so the fixed cost of every pandas call matters more than the
+# row count. Columns sharing a parser are stacked into one long Series and parsed in a single pass
+def _apply_stacked(df: pd.DataFrame, columns: list, column_parser) -> pd.DataFrame:
+    n = len(df)
+    stacked = pd.concat([df[column] for column in columns], ignore_index=True)
+    parsed = column_parser(stacked)
+    for i, column in enumerate(columns):
+        df[column] = parsed.iloc[i * n:(i + 1) * n].set_axis(df.index)
+    return df
 
-        df["Speed 30min"] = df["Speed 30min"].apply(parse_speed)
-        df["VMG 30min"] = df["VMG 30min"].apply(parse_speed)
 
-        df["Speed Last Report"] = df["Speed Last Report"].apply(parse_speed)
-        df["VMG Last Report"] = df["VMG Last Report"].apply(parse_speed)
+COLUMN_PARSERS = {
+    "Latitude": parse_coordinates_column,
+    "Longitude": parse_coordinates_column,
+    "Heading 30min": parse_heading_column,
+    "Heading Last Report": parse_heading_column,
+    "Heading 24h": parse_heading_column,
+    "Speed 30min": parse_speed_column,
+    "VMG 30min": parse_speed_column,
+    "Speed Last Report": parse_speed_column,
+    "VMG Last Report": parse_speed_column,
+    "Speed 24h": parse_speed_column,
+    "VMG 24h": parse_speed_column,
+    "Dist 30min": parse_distance_column,
+    "Dist Last Report": parse_distance_column,
+    "Dist 24h": parse_distance_column,
+    "DTL": parse_distance_column,
+    "DTF": parse_distance_column,
+}
 
-        df["Speed 24h"] = df["Speed 24h"].apply(parse_speed)
-        df["VMG 24h"] = df["VMG 24h"].apply(parse_speed)
 
-        df["Dist 30min"] = df["Dist 30min"].apply(parse_distance)
-        df["Dist Last Report"] = df["Dist Last Report"].apply(parse_distance)
-        df["Dist 24h"] = df["Dist 24h"].apply(parse_distance)
-        df["DTL"] = df["DTL"].apply(parse_distance)
-        df["DTF"] = df["DTF"].apply(parse_distance)
+# Finisher-format files (ARV) have an "Arrival date" header on row 3 and the table of the boats still
+# racing further down, the row holding "Since 30 minutes" is where that table starts
+def find_racing_header(raw: pd.DataFrame, default_row: int = HEADER_ROW) -> int:
+    if default_row >= len(raw):
+        return default_row
 
-        # Types
-        df["Ranking"] = df["Ranking"].astype(int)
-        df[["Sailor", "Team", "Nation", "Sail"]] = df[["Sailor", "Team", "Nation", "Sail"]].astype("string")
+    header_cells = raw.iloc[default_row].dropna().astype(str).str.lower()
+    if not header_cells.str.contains("arrivée|arrival date").any():
+        return default_row
+
+    logger.info("Detected ARV format, searching for racing table...")
+    cells = raw.stack()
+    cells = cells[cells.map(type) == str]
+    matches = cells[cells.str.contains("Depuis 30 minutes|Since 30 minutes")]
+    if matches.empty:
+        return default_row
+
+    idx = int(matches.index.get_level_values(0).min())
+    logger.info(f"Found racing data starting at row {idx}")
+    return idx
 
-        # Replacing, respect for the legend
-        df["Sailor"] = df["Sailor"].replace("Jean Le", "Jean Le Cam")
 
-        # Dropping
-        df.drop(columns=["Sailor Nationality and Sail Number", "Sailor Name and Team Name"], inplace=True)
+# Same frame as read_excel(skiprows=header_row) would give, header row included as column names
+def slice_table(raw: pd.DataFrame, header_row: int) -> pd.DataFrame:
+    header = raw.iloc[header_row] if header_row < len(raw) else pd.Series(np.nan, index=raw.columns)
+
+    columns = []
+    seen = {}
+    for i, name in enumerate(header):
+        name = f"Unnamed: {i}" if pd.isna(name) else str(name)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        columns.append(name)
+
+    df = raw.iloc[header_row + 1:].reset_index(drop=True)
+    df.columns = columns
+    return df.infer_objects()
+
+
+# The racing table of a workbook with its columns renamed, cells still as they are in the sheet.
+# Returns (table, date of the file), the Spark backend does the value parsing of parse_file on top of this
+def read_table(filename: str) -> tuple:
+    # Date parts
+    basename = os.path.basename(filename)
+    date_str = basename.split("_")[1]
+    date_part = pd.to_datetime(date_str, format="%Y%m%d").date()
+    logger.debug(f"Extracted date: {date_part}")
+
+    # One read of the whole sheet, the racing table is sliced out of the grid in memory
+    raw = pd.read_excel(filename, engine="calamine", header=None)
+    beginning_of_racing_rows = find_racing_header(raw)
+    df = slice_table(raw, beginning_of_racing_rows)
+
+    df = df.iloc[:, 1:]
+    df = df.iloc[:-4, :]
+    df = df.drop(0, errors="ignore")
+
+    # Cleaning column strings of useless tabs and spaces
+    df.columns = df.columns.str.replace(r'[\r\n]+', ' ', regex=True).str.strip()
+
+    # Renaming
+    df.rename(columns={
+        df.columns.values[0]: "Ranking",
+        df.columns.values[1]: "Sailor Nationality and Sail Number",
+        df.columns.values[2]: "Sailor Name and Team Name",
+        df.columns.values[3]: "Time in France",
+        df.columns.values[4]: "Latitude",
+        df.columns.values[5]: "Longitude",
+        # The heading, speed, VMG and distance columns are found by their sheet titles
+        **schema.sheet_headers(),
+    }, inplace=True)
+    return df, date_part
+
+
+def parse_file(filename: str) -> pd.DataFrame:
+    logger.info(f"Parsing file: {filename}")
+
+    try:
+        df, date_part = read_table(filename)
+
+        # Cleaning row strings of useless tabs and spaces
+        df = _apply_stacked(df, list(df.columns[df.dtypes == "object"]), _clean_cells)
+
+        #Get rid of RET,DNF or ARV Sailors (or whatever statuses the race uses)
+        df = df[~df["Ranking"].astype(str).str.strip().isin(DROPPED_STATUS)]
+        df = df.reset_index(drop=True)
+
+        # Applying, every bad cell becomes NaN and is counted instead of failing the whole file.
+        # Blank cells are NaN too but there was nothing to parse, only filled cells that came out NaN count
+        parse_errors = 0
+        for column_parser in dict.fromkeys(COLUMN_PARSERS.values()):
+            columns = [column for column, p in COLUMN_PARSERS.items() if p is column_parser]
+            filled = _filled(df[columns])
+            df = _apply_stacked(df, columns, column_parser)
+            parse_errors += int((filled & df[columns].isna()).sum().sum())
+
+        sailor_and_team = parse_sailor_and_team_column(df["Sailor Name and Team Name"])
+        df["Sailor"] = sailor_and_team["Sailor"]
+        df["Team"] = sailor_and_team["Team"]
+        nation_and_sail = parse_nation_and_sail_column(df["Sailor Nationality and Sail Number"])
+        df["Nation"] = nation_and_sail["Nation"]
+        df["Sail"] = nation_and_sail["Sail"]
+
+        time_in_france = parse_time_column(df["Time in France"], date_part)
+        parse_errors += int((_filled(df["Time in France"]) & time_in_france.isna()).sum())
+        df["Time in France"] = time_in_france
 
-        # Reordering
-        cols_in_prefered_order = [
-            "Ranking", "Sailor", "Nation", "Team", "Sail", "Latitude", "Longitude", "Time in France",
-            "Heading 30min", "Heading Last Report", "Heading 24h",
-            "Speed 30min", "Speed Last Report", "Speed 24h",
-            "VMG 30min", "VMG Last Report", "VMG 24h",
-            "Dist 30min", "Dist Last Report", "Dist 24h",
-            "DTF", "DTL"
-        ]
+        # Replacing, respect for the legend
+        df["Sailor"] = df["Sailor"].replace("Jean Le", "Jean Le Cam")
 
-        df = df.reindex(columns=cols_in_prefered_order)
+        # Dropping, reordering and types
+        df = schema.validate(df, "total")
+        df.attrs["parse_errors"] = parse_errors
+        if parse_errors:
+            logger.warning(f"{parse_errors} cell(s) in {filename} could not be parsed and were set to NaN")
         logger.info(f"Successfully parsed {len(df)} rows from {filename}")
         return df
 
@@ -202,38 +304,220 @@ def parse_file(filename: str) -> pd.DataFrame:
         raise
 
 
-def parse_directory():
+# Wrapper used by the process pool, a failing file should not take the whole pool down
+# so the error is handed back together with the file name instead of being raised
+def parse_file_safe(file_path: str):
+    try:
+        return file_path, parse_file(file_path), None
+    except Exception as e:
+        return file_path, None, str(e)
+
+
+@instrumentation.measured("parse_files")
+def _parse_files(file_paths: list, max_workers: int) -> list:
+    instrumentation.current().rows_in = len(file_paths)
+    if max_workers == 1:
+        results = map(parse_file_safe, file_paths)
+        return list(tqdm(results, total=len(file_paths), desc="Processing files", unit="file"))
+
+    # map keeps the input order, chunksize keeps the pickling overhead down for ~700 small files
+    chunksize = max(1, len(file_paths) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(parse_file_safe, file_paths, chunksize=chunksize)
+        return list(tqdm(results, total=len(file_paths), desc="Processing files", unit="file"))
+
+
+def partition_path(file: str) -> str:
+    return os.path.join(PARTITIONS_DIR, os.path.splitext(file)[0] + ".parquet")
+
+
+# Writes the partition of a parsed file, returns its manifest entry
+def write_partition(file: str, df: pd.DataFrame, current: dict) -> dict:
+    storage.write_file(df, "total", partition_path(file))
+    return {**current, "partition": os.path.basename(partition_path(file)), "rows": len(df)}
+
+
+# The manifest rules of parse_directory, the streaming pipeline goes through them too. What to do with a file
+# given its manifest entry (previous), its fingerprint (current) and the files already parsed by content hash
+# (known_hashes, a new file to parse is added to it). Returns (action, manifest entry):
+#   "unchanged"  same content as when it was parsed, nothing to do
+#   "changed"    its rows are already in the total dataset and the caller cannot replace them (replace=False)
+#   "duplicate"  byte identical to a file parsed before under another name, recorded but not parsed
+#   "parse"      new or changed content, the entry is its fingerprint
+def classify_file(file: str, previous: dict, current: dict, known_hashes: dict, replace: bool = True) -> tuple:
+    if not has_changed(previous, current):
+        return "unchanged", {**previous, **current}
+    if not replace and previous is not None and previous.get("partition"):
+        return "changed", current
+    original = known_hashes.get(current["sha256"])
+    if original is not None and original != file:
+        return "duplicate", {**current, "partition": None, "rows": 0, "duplicate_of": original}
+    known_hashes[current["sha256"]] = file
+    return "parse", current
+
+
+def _drop_partition(file: str):
+    if os.path.exists(partition_path(file)):
+        os.remove(partition_path(file))
+
+
+# Every parsed file gets its own partition, the total dataset is the partitions glued together in file order
+@instrumentation.measured("rebuild_total")
+def rebuild_total(manifest: dict) -> int:
+    partitions = [entry["partition"] for _, entry in sorted(manifest.items()) if entry.get("partition")]
+    if partitions:
+        df_total = storage.read_files([os.path.join(PARTITIONS_DIR, partition) for partition in partitions])
+    else:
+        df_total = pd.DataFrame(columns=schema.columns("total"))
+    storage.write(df_total, "total")
+    instrumentation.current().rows_out = len(df_total)
+    return len(df_total)
+
+
+@instrumentation.measured("parse")
+def parse_directory(max_workers: int = None):
     logger.info(f"Starting directory parsing from: {FILES_DIR}")
 
-    files = [f for f in os.listdir(FILES_DIR) if os.path.isfile(os.path.join(FILES_DIR, f))]
+    # Sorted so the output row order is the same no matter how the pool schedules the work
+    # Only workbooks, the scraper keeps its temp downloads and missing-file record next to them
+    files = sorted(f for f in os.listdir(FILES_DIR) if f.endswith(".xlsx") and os.path.isfile(os.path.join(FILES_DIR, f)))
 
     if len(files) == 0:
         logger.warning("No files found in directory")
         return
 
-    if os.path.exists(OUTPUT_DIR + "/total.csv" ):
-        logger.info(f"Output file already exists at {OUTPUT_DIR}. Skipping processing.")
+    output_path = storage.dataset_path("total")
+    if storage.exists("total") and not os.path.exists(MANIFEST_PATH):
+        logger.info(f"Output file already exists at {OUTPUT_DIR} but was not built with a manifest. Skipping processing.")
         logger.info("Delete the file if you want to regenerate it.")
         return
 
-
-    logger.info(f"Found {len(files)} files to process")
-
-    df_total = pd.DataFrame()
-
-    for file in tqdm(files, desc="Processing files", unit="file"):
-        try:
-            file_path = os.path.join(FILES_DIR, file)
-            df_temp = parse_file(file_path)
-            df_total = pd.concat([df_total, df_temp], ignore_index=True)
-        except Exception as e:
-            logger.error(f"Skipping file {file} due to error: {e}")
+    if max_workers is None:
+        max_workers = PARSE_WORKERS
+
+    os.makedirs(PARTITIONS_DIR, exist_ok=True)
+    manifest = load_manifest(MANIFEST_PATH)
+
+    # Only files that are new or whose content changed get parsed, byte identical snapshots
+    # published under another timestamp are recorded as duplicates and skipped
+    with instrumentation.stage("fingerprint", rows_in=len(files)):
+        current_fingerprints = {file: fingerprint(os.path.join(FILES_DIR, file), manifest.get(file)) for file in files}
+
+    # Duplicates of a file whose content changed lost their original, they are treated as new files
+    changed = {file for file in files if has_changed(manifest.get(file), current_fingerprints[file])}
+    for file in [file for file, entry in manifest.items() if entry.get("duplicate_of") in changed]:
+        del manifest[file]
+    known_hashes = {
+        entry["sha256"]: file for file, entry in manifest.items() if entry.get("partition") and file not in changed
+    }
+
+    pending = []
+    fingerprints = {}
+    duplicates = 0
+    # A deleted total dataset is glued back together from the partitions, delete the manifest to re-parse everything
+    rebuild = not os.path.exists(output_path)
+    for file in files:
+        previous = manifest.get(file)
+        action, entry = classify_file(file, previous, current_fingerprints[file], known_hashes)
+        if action == "unchanged":
+            manifest[file] = entry
             continue
+        if previous is not None and previous.get("partition"):
+            # The old rows of this file are already in the total dataset and have to go
+            rebuild = True
+            _drop_partition(file)
+        if action == "duplicate":
+            manifest[file] = entry
+            duplicates += 1
+            continue
+        fingerprints[file] = entry
+        pending.append(file)
 
-    output_path = os.path.join(OUTPUT_DIR, "total.csv")
-    df_total.to_csv(output_path, index=False)
-    logger.info(f"Successfully saved combined data to {output_path}")
-    logger.info(f"Total rows in combined dataset: {len(df_total)}")
-
-
+    if not pending and not rebuild:
+        save_manifest(manifest, MANIFEST_PATH)
+        logger.info(f"All {len(files)} files already parsed ({duplicates} new duplicate(s)), nothing to do.")
+        return
 
+    logger.info(f"Found {len(pending)} new or changed file(s) out of {len(files)} to process "
+                f"with {max_workers} worker(s), {duplicates} duplicate(s) skipped")
+
+    # Appending is only correct when nothing already in the total dataset changed and the new files come after it
+    combined = [file for file, entry in manifest.items() if entry.get("partition")]
+    can_append = (
+        os.path.exists(output_path)
+        and not rebuild
+        and (not combined or min(pending) > max(combined))
+    )
+
+    results = _parse_files([os.path.join(FILES_DIR, file) for file in pending], max_workers)
+
+    frames = []
+    failed = []
+    with instrumentation.stage("write_partitions"):
+        for file_path, df_temp, error in results:
+            file = os.path.basename(file_path)
+            if error is not None:
+                # Remembered so a broken file is not parsed again until its content changes
+                manifest[file] = {**fingerprints[file], "partition": None, "rows": 0, "error": error}
+                failed.append((file, error))
+                continue
+            manifest[file] = write_partition(file, df_temp, fingerprints[file])
+            frames.append(df_temp)
+
+    if can_append:
+        # One concat for all the new files instead of growing the frame on every file
+        df_new = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if not df_new.empty:
+            storage.write(df_new, "total", mode="append")
+        logger.info(f"Appended {len(df_new)} rows to {output_path}")
+    else:
+        total_rows = rebuild_total(manifest)
+        logger.info(f"Successfully saved combined data to {output_path}")
+        logger.info(f"Total rows in combined dataset: {total_rows}")
+
+    save_manifest(manifest, MANIFEST_PATH)
+
+    parse_errors = sum(frame.attrs.get("parse_errors", 0) for frame in frames)
+    stage = instrumentation.current()
+    stage.rows_in = len(pending)
+    stage.rows_out = sum(len(frame) for frame in frames)
+    stage.count("files_parsed", len(frames))
+    stage.count("files_failed", len(failed))
+    stage.count("duplicates", duplicates)
+    stage.count("parse_errors", parse_errors)
+    logger.info(f"Parsed {len(frames)}/{len(pending)} files, {len(failed)} failed, "
+                f"{parse_errors} bad cell(s) set to NaN")
+    for file, error in failed:
+        logger.error(f"Skipped file {file} due to error: {error}")
+
+
+# Live mode: one freshly downloaded file is parsed and appended to the total dataset and recorded in the
+# manifest, as parse_directory would do for it. Returns its rows, empty if it was already parsed or is a
+# republished duplicate. Anything that is not a plain append goes through parse_directory
+def ingest_file(file: str) -> pd.DataFrame:
+    empty = pd.DataFrame(columns=schema.columns("total"))
+    manifest = load_manifest(MANIFEST_PATH)
+    previous = manifest.get(file)
+    current = fingerprint(os.path.join(FILES_DIR, file), previous)
+    if not has_changed(previous, current):
+        return empty
+
+    combined = [name for name, entry in manifest.items() if entry.get("partition")]
+    if previous is not None or not storage.exists("total") or (combined and file < max(combined)):
+        parse_directory(max_workers=1)
+        entry = load_manifest(MANIFEST_PATH).get(file, {})
+        return storage.read_files([partition_path(file)]) if entry.get("partition") else empty
+
+    action, entry = classify_file(file, previous, current, {manifest[name]["sha256"]: name for name in combined})
+    if action == "duplicate":
+        manifest[file] = entry
+        save_manifest(manifest, MANIFEST_PATH)
+        logger.info(f"{file} is a duplicate of {entry['duplicate_of']}, skipped")
+        return empty
+
+    os.makedirs(PARTITIONS_DIR, exist_ok=True)
+    df = parse_file(os.path.join(FILES_DIR, file))
+    manifest[file] = write_partition(file, df, current)
+    storage.write(df, "total", mode="append")
+    save_manifest(manifest, MANIFEST_PATH)
+    return df
@@ -0,0 +1,323 @@
+#The purpose of this file is to run scrape -> parse -> weather -> load as a stream instead of four stages
+#that each finish before the next starts. Every downloaded workbook is handed to the parser right away,
+#parsed rows are enriched in small batches and loaded while the rest is still downloading.
+#Stages are threads connected by bounded queues (parsing runs in a process pool), a full queue blocks
+#the stage in front of it, so memory stays flat and the run takes about as long as its slowest stage
+
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import pandas as pd
+import requests
+from sqlalchemy import create_engine
+
+import combiner
+import instrumentation
+import metrics
+import parser
+import saver
+import scraper
+import storage
+from manifest import load_manifest, save_manifest, fingerprint
+from weather_cache import WeatherCache
+
+logger = logging.getLogger(__name__)
+
+QUEUE_SIZE = 32
+# Parsed leaderboards are enriched together once they add up to this many rows
+WEATHER_BATCH_ROWS = 500
+# WEATHER_WORKERS (env) batches are enriched at once, the stage mostly waits on the weather API
+WEATHER_WORKERS = int(os.environ.get("WEATHER_WORKERS", "4"))
+# The manifest is saved every MANIFEST_EVERY files whose rows are loaded, a killed run keeps that progress
+MANIFEST_EVERY = 20
+
+_DONE = object()
+
+
+class Stage(threading.Thread):
+    """
+    One pipeline stage in its own thread, keeps track of the time it spent working and of its error.
+    """
+
+    def __init__(self, name: str, target, *args):
+        super().__init__(name=name, daemon=True)
+        # Measured as a sub-step of the pipeline run, from the thread it runs in
+        self.target = instrumentation.bind(instrumentation.measured(name)(target))
+        self.args = args
+        self.busy = 0.0
+        self.busy_lock = threading.Lock()
+        self.error = None
+
+    def run(self):
+        try:
+            self.target(self, *self.args)
+        except Exception as e:
+            self.error = e
+            logger.exception(f"Stage {self.name} failed")
+
+    def timed(self, function, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            # Also called from the threads of a stage's own pool
+            with self.busy_lock:
+                self.busy += time.perf_counter() - started
+
+
+def _put(output: queue.Queue, item, stages: list):
+    # A put that gives up when a downstream stage died, otherwise a full queue would block forever
+    while True:
+        try:
+            output.put(item, timeout=1)
+            return
+        except queue.Full:
+            if any(stage.error is not None for stage in stages):
+                raise RuntimeError("a downstream stage failed")
+
+
+def _close(output: queue.Queue, stages: list):
+    try:
+        _put(output, _DONE, stages)
+    except RuntimeError:
+        pass
+
+
+def _download(stage: Stage, files: queue.Queue, stages: list, max_workers: int, download: bool):
+    try:
+        # Workbooks already on disk go first, new ones follow as soon as they are saved
+        for file in sorted(f for f in os.listdir(scraper.FILES_DIR) if f.endswith(".xlsx")):
+            _put(files, file, stages)
+        if download:
+            stage.timed(scraper.download, max_workers, on_file=lambda file: _put(files, file, stages))
+    finally:
+        _close(files, stages)
+
+
+def _parse(stage: Stage, files: queue.Queue, parsed: queue.Queue, stages: list, manifest: dict, max_workers: int,
+           counts: dict):
+    os.makedirs(parser.PARTITIONS_DIR, exist_ok=True)
+    known_hashes = {entry["sha256"]: file for file, entry in manifest.items() if entry.get("partition")}
+    fingerprints = {}
+    in_flight = set()
+    max_in_flight = 2 * max_workers
+
+    # Manifest entries travel with their rows and only go into the manifest once the load stage has loaded them
+    def forward(done):
+        for future in done:
+            in_flight.discard(future)
+            file_path, df, error = future.result()
+            file = os.path.basename(file_path)
+            if error is not None:
+                logger.error(f"Skipped file {file} due to error: {error}")
+                _put(parsed, ({file: {**fingerprints[file], "partition": None, "rows": 0, "error": error}}, None),
+                     stages)
+                continue
+            entry = stage.timed(parser.write_partition, file, df, fingerprints[file])
+            counts["files"] += 1
+            _put(parsed, ({file: entry}, df), stages)
+
+    try:
+        # The other stages are running threads (HTTP, SQLite, pandas) when the pool starts, a forked worker could
+        # inherit a lock one of them holds and hang. The workers are forked from a clean forkserver process instead
+        context = multiprocessing.get_context("forkserver")
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context) as executor:
+            finished = False
+            while True:
+                if in_flight and (finished or len(in_flight) >= max_in_flight):
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    forward(done)
+                    continue
+                if finished:
+                    break
+                try:
+                    file = files.get(timeout=0.05)
+                except queue.Empty:
+                    forward({future for future in in_flight if future.done()})
+                    continue
+                if file is _DONE:
+                    finished = True
+                    continue
+
+                if file in fingerprints:
+                    continue
+                # The rows of an earlier version are already in the dataset and the database and the pipeline
+                # only appends, parse_directory drops the old partition before parsing it again
+                current = fingerprint(os.path.join(scraper.FILES_DIR, file), manifest.get(file))
+                action, entry = parser.classify_file(file, manifest.get(file), current, known_hashes, replace=False)
+                if action == "changed":
+                    logger.warning(f"{file} changed since it was parsed, left for the batch run (python main.py)")
+                    counts["changed"] += 1
+                elif action == "duplicate":
+                    _put(parsed, ({file: entry}, None), stages)
+                elif action == "parse":
+                    fingerprints[file] = entry
+                    in_flight.add(executor.submit(parser.parse_file_safe, os.path.join(scraper.FILES_DIR, file)))
+    finally:
+        _close(parsed, stages)
+
+
+def _weather(stage: Stage, parsed: queue.Queue, enriched: queue.Queue, stages: list, batch_rows: int, workers: int):
+    batches = queue.Queue(workers)
+    errors = []
+    frames = []
+    entries = {}
+
+    # SQLite connections belong to the thread that opened them, every worker has its own cache and HTTP session.
+    # Batches are passed on in the order they finish
+    def work():
+        cache = WeatherCache()
+        try:
+            with requests.Session() as session:
+                while True:
+                    item = batches.get()
+                    if item is _DONE:
+                        return
+                    if errors:
+                        continue
+                    files, df = item
+                    try:
+                        if df is not None:
+                            df = stage.timed(combiner.enrich_rows, df, api_url=combiner.ARCHIVE_API_URL, cache=cache,
+                                             session=session)
+                            # Like add_weather, rows without weather do not go into the dataset
+                            df = df.dropna(subset=combiner.WIND_COLUMNS)
+                        # Passed on even without rows, the manifest entries of the batch still go to the load stage
+                        _put(enriched, (files, df), stages)
+                    except Exception as e:
+                        # The stage fails, the other workers only drain the queue from now on
+                        errors.append(e)
+        finally:
+            cache.close()
+
+    def flush():
+        if errors:
+            raise errors[0]
+        if not entries:
+            return
+        batches.put((dict(entries), pd.concat(frames, ignore_index=True) if frames else None))
+        frames.clear()
+        entries.clear()
+
+    threads = [threading.Thread(target=instrumentation.bind(work), name=f"weather-{i}", daemon=True)
+               for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            try:
+                item = parsed.get(timeout=1)
+            except queue.Empty:
+                # Nothing is coming in right now, do not hold on to what we have
+                flush()
+                continue
+            if item is _DONE:
+                break
+            files, df = item
+            entries.update(files)
+            if df is not None:
+                frames.append(df)
+            if sum(len(frame) for frame in frames) >= batch_rows:
+                flush()
+        flush()
+    finally:
+        for _ in threads:
+            batches.put(_DONE)
+        for thread in threads:
+            thread.join()
+        _close(enriched, stages)
+    if errors:
+        raise errors[0]
+
+
+def _load(stage: Stage, enriched: queue.Queue, overwrite: bool, engine, manifest: dict, counts: dict):
+    mode = "overwrite" if overwrite else "append"
+    unsaved = 0
+    while True:
+        item = enriched.get()
+        if item is _DONE:
+            break
+        files, df = item
+        if df is None or df.empty:
+            unsaved = _commit_files(manifest, files, unsaved)
+            continue
+        stage.timed(storage.write, df, "dataset", mode=mode)
+        mode = "append"
+        if engine is not None:
+            # The rollups are rebuilt once at the end, rebuilding the wind bins after every batch grows with the table
+            stage.timed(saver.save_rows, df, engine, rollups=False)
+            first_day = df["Time in France"].min().date()
+            counts["since"] = min(counts["since"] or first_day, first_day)
+        counts["rows"] += len(df)
+        unsaved = _commit_files(manifest, files, unsaved)
+
+
+# Records the files of a loaded batch in the manifest, saved once MANIFEST_EVERY files are waiting.
+# Returns the number of files not saved yet
+def _commit_files(manifest: dict, files: dict, unsaved: int) -> int:
+    manifest.update(files)
+    unsaved += len(files)
+    if unsaved >= MANIFEST_EVERY:
+        save_manifest(manifest, parser.MANIFEST_PATH)
+        return 0
+    return unsaved
+
+
+@instrumentation.measured("pipeline", is_run=True)
+def run(max_workers: int = None, download_workers: int = scraper.DOWNLOAD_WORKERS, batch_rows: int = WEATHER_BATCH_ROWS,
+        download: bool = True, load_database: bool = True, weather_workers: int = WEATHER_WORKERS):
+    started = time.perf_counter()
+    max_workers = max_workers or parser.PARSE_WORKERS
+    manifest = load_manifest(parser.MANIFEST_PATH)
+    # Nothing parsed yet means a cold rebuild, the dataset is rewritten instead of appended to
+    cold = not any(entry.get("partition") for entry in manifest.values())
+
+    engine = None
+    if load_database:
+        engine = create_engine(saver.DB_URL)
+        saver.create_schema(engine)
+
+    files = queue.Queue(QUEUE_SIZE)
+    parsed = queue.Queue(QUEUE_SIZE)
+    enriched = queue.Queue(QUEUE_SIZE)
+    counts = {"files": 0, "rows": 0, "changed": 0, "since": None}
+    stages = []
+    stages.extend([
+        Stage("download", _download, files, stages, download_workers, download),
+        Stage("parse", _parse, files, parsed, stages, manifest, max_workers, counts),
+        Stage("weather", _weather, parsed, enriched, stages, batch_rows, weather_workers),
+        Stage("load", _load, enriched, cold, engine, manifest, counts),
+    ])
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+
+    errors = [stage for stage in stages if stage.error is not None]
+    if errors:
+        raise RuntimeError(f"Pipeline stage(s) {[stage.name for stage in errors]} failed") from errors[0].error
+
+    # Files finished in whatever order the pool returned them, the total dataset is glued back in file order
+    if counts["files"] or not storage.exists("total"):
+        parser.rebuild_total(manifest)
+    save_manifest(manifest, parser.MANIFEST_PATH)
+    # The metrics look at the reports before and after a row, they are computed once everything is in
+    if counts["rows"]:
+        metrics.add_metrics()
+        if engine is not None:
+            with engine.connect() as connection:
+                saver.load_metrics(connection)
+                saver.refresh_rollups(connection, counts["since"], saver.resolve_race(connection))
+
+    report = instrumentation.current()
+    report.rows_out = counts["rows"]
+    report.count("files_parsed", counts["files"])
+    report.count("files_changed_skipped", counts["changed"])
+    busy = ", ".join(f"{stage.name} {stage.busy:.1f}s" for stage in stages)
+    logger.info(f"Pipeline done in {time.perf_counter() - started:.1f}s: {counts['files']} files parsed, "
+                f"{counts['rows']} rows enriched and loaded (busy: {busy})")
@@ -0,0 +1,59 @@
+#The purpose of this file is to describe the races we follow as configuration instead of constants in the code.
+#Every race in races.json has its leaderboard URL template, the first and last leaderboard, how many hours apart
+#they are published and the quirks of its sheets (where the racing table starts, which statuses are dropped).
+#A pipeline process works on one race, picked with RACE (the first race of the file by default); the scheduler
+#gives every race its own DATA_DIR so their files and outputs never mix
+
+import json
+import os
+
+RACES_PATH = os.environ.get("RACES_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "races.json"))
+TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S"
+
+
+class Race:
+    """
+    One race (or edition of a race). `leaderboard_url` contains YYYYMMDD_HHMMSS where the timestamp of a
+    leaderboard goes, `start` and `end` are the first and last leaderboard in that format.
+    """
+
+    def __init__(self, id: str, name: str, leaderboard_url: str, start: str, end: str, step_hours: int = 4,
+                 header_row: int = 3, dropped_status: list = ("RET", "DNF", "ARV")):
+        self.id = id
+        self.name = name
+        self.leaderboard_url = leaderboard_url
+        self.start = start
+        self.end = end
+        self.step_hours = int(step_hours)
+        self.header_row = int(header_row)
+        self.dropped_status = list(dropped_status)
+
+    def __repr__(self) -> str:
+        return f"Race({self.id!r})"
+
+
+# Every race of the file by id, in file order
+def load(path: str = RACES_PATH) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        definitions = json.load(f)
+    races = {}
+    for definition in definitions:
+        race = Race(**definition)
+        if race.id in races:
+            raise ValueError(f"Race '{race.id}' is defined twice in {path}")
+        races[race.id] = race
+    return races
+
+
+def get(race_id: str = None, path: str = RACES_PATH) -> Race:
+    races = load(path)
+    if race_id is None:
+        return next(iter(races.values()))
+    if race_id not in races:
+        raise KeyError(f"Unknown race '{race_id}', known races are {list(races)}")
+    return races[race_id]
+
+
+# The race of this process
+def current() -> Race:
+    return get(os.environ.get("RACE") or None)
@@ -0,0 +1,90 @@
+#The purpose of this file is to run the pipelines of several races at the same time. Every race runs main.py in
+#its own process with RACE set and its own DATA_DIR (RACES_DIR/<race id>), so its files, Parquet datasets,
+#chunks and reports stay apart from the other races. What the races have in common is shared: one weather
+#cache (boats of different races sail through the same areas), one database with a row per race in `races`,
+#a lock file so two races never bulk load at the same moment, and the CPUs and download slots, split between
+#the races running at once
+
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import instrumentation
+import races
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(__file__))
+RACES_DIR = os.environ.get("RACES_DIR", os.path.join(DATA_DIR, "races"))
+WEATHER_CACHE = os.environ.get("WEATHER_CACHE", os.path.join(RACES_DIR, "weather_cache.sqlite"))
+LOAD_LOCK = os.path.join(RACES_DIR, "load.lock")
+# WORKERS (env) parsing processes and DOWNLOAD_WORKERS downloads for all the races together,
+# MAX_RACES (env) how many races run at once, all of them by default
+WORKERS = int(os.environ.get("WORKERS", "0")) or os.cpu_count() or 1
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "10"))
+MAX_RACES = int(os.environ.get("MAX_RACES", "0"))
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+
+def race_dir(race: races.Race) -> str:
+    return os.path.join(RACES_DIR, race.id)
+
+
+# Environment of the pipeline process of one race out of `concurrent` running at once
+def race_env(race: races.Race, concurrent: int) -> dict:
+    return dict(
+        os.environ,
+        RACE=race.id,
+        RACES_PATH=races.RACES_PATH,
+        DATA_DIR=race_dir(race),
+        WEATHER_CACHE=WEATHER_CACHE,
+        LOAD_LOCK=LOAD_LOCK,
+        PARSE_WORKERS=str(max(1, WORKERS // concurrent)),
+        DOWNLOAD_WORKERS=str(max(1, DOWNLOAD_WORKERS // concurrent)),
+    )
+
+
+# Runs main.py for one race ("batch" or "pipeline"), its output goes to pipeline.log in the race's directory.
+# Returns the exit code
+def run_race(race: races.Race, mode: str = "batch", concurrent: int = 1) -> int:
+    os.makedirs(race_dir(race), exist_ok=True)
+    command = [sys.executable, MAIN] + ([mode] if mode != "batch" else [])
+    log_path = os.path.join(race_dir(race), "pipeline.log")
+    logger.info(f"🚀 {race.id} started ({mode}), log in {log_path}")
+    started = time.perf_counter()
+    with open(log_path, "a", encoding="utf-8") as log:
+        result = subprocess.run(command, env=race_env(race, concurrent), cwd=os.path.dirname(MAIN),
+                                stdout=log, stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - started
+    if result.returncode == 0:
+        logger.info(f"✅ {race.id} finished in {elapsed:.1f}s")
+    else:
+        logger.error(f"❌ {race.id} failed with exit code {result.returncode} after {elapsed:.1f}s, see {log_path}")
+    return result.returncode
+
+
+# Runs the races (all of races.json by default) at most max_races at a time
+@instrumentation.measured("races", is_run=True)
+def run(race_ids: list = None, mode: str = "batch", max_races: int = MAX_RACES):
+    definitions = races.load()
+    race_ids = race_ids or list(definitions)
+    unknown = [race_id for race_id in race_ids if race_id not in definitions]
+    if unknown:
+        raise KeyError(f"Unknown race(s) {unknown}, known races are {list(definitions)}")
+    selected = [definitions[race_id] for race_id in race_ids]
+
+    stage = instrumentation.current()
+    stage.rows_in = len(selected)
+    concurrent = min(max_races or len(selected), len(selected))
+    os.makedirs(RACES_DIR, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=concurrent) as executor:
+        futures = {executor.submit(run_race, race, mode, concurrent): race for race in selected}
+        failed = [futures[future].id for future in as_completed(futures) if future.result() != 0]
+
+    stage.rows_out = len(selected) - len(failed)
+    stage.count("races_failed", len(failed))
+    if failed:
+        raise RuntimeError(f"Race(s) {failed} failed")
@@ -0,0 +1,186 @@
+#The purpose of this file is to say once what every column is: its name, how it is stored on disk (Arrow type),
+#how it is held in memory (the smallest pandas dtype that keeps its values) and where it goes in the database.
+#Parser, combiner, metrics, storage and saver all go through it instead of repeating names and types.
+#In memory the text columns are categories and the leaderboard measures float32, about a quarter of the
+#object/float64 default. On disk and in the database the measures stay float64: float32 is rounded back to
+#the decimals the leaderboard gives (1, `decimals` keeps a spare one) when it leaves memory, so 12.3 is
+#written as 12.3 and not as 12.300000190734863
+
+import pandas as pd
+import pyarrow as pa
+
+
+class Field:
+    """
+    One column. `db` is (table, column) in saver's star schema, `header` the column title in the
+    leaderboard sheets for the columns that are found by name.
+    """
+
+    def __init__(self, name: str, arrow_type: pa.DataType, dtype: str, db: tuple = None, header: str = None,
+                 decimals: int = None):
+        self.name = name
+        self.arrow_type = arrow_type
+        self.dtype = dtype
+        self.db = db
+        self.header = header
+        self.decimals = decimals
+
+
+def _measure(name: str, db_column: str, header: str = None) -> Field:
+    return Field(name, pa.float64(), "float32", ("performances", db_column), header, decimals=2)
+
+
+def _heading(name: str, db_column: str, header: str = None) -> Field:
+    return Field(name, pa.int64(), "Int16", ("performances", db_column), header)
+
+
+def _metric(name: str, db_column: str) -> Field:
+    return Field(name, pa.float32(), "float32", ("report_metrics", db_column))
+
+
+FIELDS = {field.name: field for field in [
+    Field("Ranking", pa.int64(), "int16", ("fact_race", "ranking")),
+    Field("Sailor", pa.string(), "category", ("sailors", "name")),
+    Field("Nation", pa.string(), "category", ("sailors", "nation")),
+    Field("Team", pa.string(), "category", ("sailors", "team")),
+    Field("Sail", pa.string(), "category", ("sailors", "sail")),
+    # Positions are join keys (combiner) and the natural key of the positions table, they keep every digit
+    Field("Latitude", pa.float64(), "float64", ("positions", "latitude")),
+    Field("Longitude", pa.float64(), "float64", ("positions", "longitude")),
+    Field("Geohash", pa.string(), "object", ("positions", "geohash")),
+    Field("Time in France", pa.timestamp("ns"), "datetime64[ns]", ("times", "timestamp")),
+    _heading("Heading 30min", "heading_30min", "Depuis 30 minutes Since 30 minutes"),
+    _heading("Heading Last Report", "heading_last_report", "Depuis le dernier classement Since the the last report"),
+    _heading("Heading 24h", "heading_24h", "Depuis 24 heures Since 24 hours"),
+    _measure("Speed 30min", "speed_30min", "Unnamed: 8"),
+    _measure("Speed Last Report", "speed_last_report", "Unnamed: 12"),
+    _measure("Speed 24h", "speed_24h", "Unnamed: 16"),
+    _measure("VMG 30min", "vmg_30min", "Unnamed: 9"),
+    _measure("VMG Last Report", "vmg_last_report", "Unnamed: 13"),
+    _measure("VMG 24h", "vmg_24h", "Unnamed: 17"),
+    _measure("Dist 30min", "dist_30min", "Unnamed: 10"),
+    _measure("Dist Last Report", "dist_last_report", "Unnamed: 14"),
+    _measure("Dist 24h", "dist_24h", "Unnamed: 18"),
+    _measure("DTF", "dtf"),
+    _measure("DTL", "dtl"),
+    # Interpolated wind has any number of decimals and is part of the conditions key, it stays float64
+    Field("Wind Speed", pa.float64(), "float64", ("conditions", "wind_speed")),
+    Field("Wind Direction", pa.float64(), "float64", ("conditions", "wind_direction")),
+    Field("Wind Gust", pa.float64(), "float64", ("conditions", "wind_gust")),
+    _metric("True Wind Angle", "true_wind_angle"),
+    _metric("Heading Change", "heading_change"),
+    _metric("Distance Sailed", "distance_sailed"),
+    _metric("Speed Over Ground", "speed_over_ground"),
+    _metric("Speed To Wind", "speed_to_wind"),
+    _metric("Polar Speed", "polar_speed"),
+    _metric("Polar Performance", "polar_performance"),
+    Field("Ranking Change", pa.int16(), "Int16", ("report_metrics", "ranking_change")),
+    _metric("Distance Sailed 24h", "distance_sailed_24h"),
+]}
+
+_LEADERBOARD = [
+    "Ranking", "Sailor", "Nation", "Team", "Sail", "Latitude", "Longitude", "Time in France",
+    "Heading 30min", "Heading Last Report", "Heading 24h",
+    "Speed 30min", "Speed Last Report", "Speed 24h",
+    "VMG 30min", "VMG Last Report", "VMG 24h",
+    "Dist 30min", "Dist Last Report", "Dist 24h",
+    "DTF", "DTL",
+]
+_POSITION = ["Time in France", "Latitude", "Longitude", "Sailor"]
+_WIND = ["Wind Speed", "Wind Direction", "Wind Gust"]
+
+# The columns of every dataset in order
+DATASETS = {
+    # parser output
+    "total": _LEADERBOARD,
+    # combiner output, the leaderboard with the weather at every position
+    "dataset": _LEADERBOARD + _WIND,
+    # metrics.py output, keyed by sailor and time like the dataset
+    "metrics": ["Sailor", "Time in France"] + [name for name, field in FIELDS.items()
+                                               if field.db and field.db[0] == "report_metrics"],
+    # weather fetched by call_for_data (km/h), chunk_store
+    "wind": _POSITION + _WIND,
+}
+
+
+def columns(name: str) -> list:
+    return list(DATASETS[name])
+
+
+def arrow_schema(name: str) -> pa.Schema:
+    return pa.schema([(column, FIELDS[column].arrow_type) for column in DATASETS[name]])
+
+
+# Sheet titles of the columns the parser finds by name -> column names
+def sheet_headers() -> dict:
+    return {field.header: field.name for field in FIELDS.values() if field.header}
+
+
+# db column -> column name of every column that goes into `table`
+def db_columns(table: str) -> dict:
+    return {field.db[1]: field.name for field in FIELDS.values() if field.db and field.db[0] == table}
+
+
+# The columns of df that are in the registry get their in-memory dtype, the others are left alone.
+# A column whose values do not fit its dtype raises a ValueError naming it
+def apply(df: pd.DataFrame) -> pd.DataFrame:
+    dtypes = {column: FIELDS[column].dtype for column in df.columns
+              if column in FIELDS and str(df[column].dtype) != FIELDS[column].dtype}
+    if not dtypes:
+        return df
+    # Categories of plain strings whatever the text dtype was ("string", object...)
+    text = [column for column, dtype in dtypes.items()
+            if dtype == "category" and isinstance(df[column].dtype, pd.StringDtype)]
+    if text:
+        df = df.astype({column: object for column in text})
+    try:
+        # One astype for all columns, it is most of the cost of a 40 row leaderboard
+        return df.astype(dtypes)
+    except (TypeError, ValueError):
+        pass
+    for column, dtype in dtypes.items():
+        try:
+            df[column].astype(dtype)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Column '{column}' does not fit {dtype}: {e}") from e
+    raise ValueError(f"Columns {list(dtypes)} do not fit {list(dtypes.values())}")
+
+
+# Stage boundary check: every column of the dataset is there and fits its dtype. Returns df with the
+# dataset's columns in order and in their in-memory dtypes
+def validate(df: pd.DataFrame, name: str) -> pd.DataFrame:
+    missing = [column for column in DATASETS[name] if column not in df.columns]
+    if missing:
+        raise ValueError(f"Dataset '{name}' is missing columns {missing}")
+    return apply(df[DATASETS[name]])
+
+
+# How a column leaves memory (to Parquet or the database): categories as plain text, small integers
+# as int64 and float32 as float64 rounded to its decimals
+def _export(values: pd.Series, field: Field) -> pd.Series:
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.astype(object).where(values.notna(), None)
+    if field.dtype == "float32" and field.arrow_type == pa.float64():
+        values = values.astype("float64")
+        return values.round(field.decimals) if field.decimals is not None else values
+    if field.dtype == "int16":
+        return values.astype("int64")
+    if field.dtype == "Int16" and field.arrow_type == pa.int64():
+        return values.astype("Int64")
+    return values
+
+
+def to_arrow(df: pd.DataFrame, name: str) -> pa.Table:
+    df = validate(df, name)
+    df = pd.DataFrame({column: _export(df[column], FIELDS[column]) for column in df.columns})
+    return pa.Table.from_pandas(df, schema=arrow_schema(name), preserve_index=False)
+
+
+def from_arrow(table: pa.Table) -> pd.DataFrame:
+    return apply(table.to_pandas())
+
+
+# The registry columns of df in the types the database gets
+def for_database(df: pd.DataFrame) -> pd.DataFrame:
+    return pd.DataFrame({column: _export(df[column], FIELDS[column]) if column in FIELDS else df[column]
+                         for column in df.columns}, index=df.index)
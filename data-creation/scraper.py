@@ -1,24 +1,31 @@
 import os
+import threading
+import time
 import requests
 import logging
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
-start_date = "20241110_100000"
-end_date = "20250308_070000"
-leaderboard_link = "https://www.vendeeglobe.org/sites/default/files/ranking/vendeeglobe_leaderboard_YYYYMMDD_HHMMSS.xlsx"
-FILES_DIR = os.path.join(os.path.dirname(__file__), "files")
+import instrumentation
+import races
+from manifest import load_manifest, save_manifest
+
+# Dates, cadence and URL of the race this process works on (races.py), LEADERBOARD_URL still overrides the URL
+race = races.current()
+start_date = race.start
+end_date = race.end
+step_hours = race.step_hours
+leaderboard_link = os.environ.get("LEADERBOARD_URL", race.leaderboard_url)
+# DOWNLOAD_WORKERS (env) is how many downloads run at once, the scheduler shares them out between races
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "10"))
+DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(__file__))
+FILES_DIR = os.path.join(DATA_DIR, "files")
 os.makedirs(FILES_DIR, exist_ok=True)
 
 
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[
-        logging.StreamHandler(),
-    ]
-)
+instrumentation.setup_logging()
 logger = logging.getLogger(__name__)
 
 def generate_timestamps(start_date: str, end_date: str, step_hours: int = 4):
@@ -29,40 +36,169 @@ def generate_timestamps(start_date: str, end_date: str, step_hours: int = 4):
         yield current.strftime("%Y%m%d_%H%M%S")
         current += timedelta(hours=step_hours)
 
-def download_file(ts: str):
+# Timestamps that came back 404 or with something that is not a workbook, so warm reruns do not ask again.
+# A timestamp that was less than RECENT_WINDOW old when checked may still get published and is asked again
+# after RECENT_TTL, older ones after MISSING_TTL
+MISSING_PATH = os.path.join(FILES_DIR, ".missing.json")
+MISSING_TTL = 7 * 24 * 3600
+RECENT_TTL = 3600
+RECENT_WINDOW = 24 * 3600
+# .missing.json is saved every MISSING_SAVE_EVERY results that changed it, a killed run keeps what it learned
+MISSING_SAVE_EVERY = 50
+CHUNK_SIZE = 64 * 1024
+
+_local = threading.local()
+
+
+# One pooled keep-alive session per worker thread
+def _session() -> requests.Session:
+    if not hasattr(_local, "session"):
+        session = requests.Session()
+        session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        _local.session = session
+    return _local.session
+
+
+class AdaptiveLimit:
+    """
+    Number of requests allowed in flight. Halved on every error, grown by one after a full
+    window of successes, so a struggling server gets fewer parallel requests.
+    """
+
+    def __init__(self, maximum: int):
+        self.maximum = maximum
+        self.limit = maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while self.in_flight >= self.limit:
+                self.condition.wait()
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def success(self):
+        with self.condition:
+            self.successes += 1
+            if self.successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self.successes = 0
+                self.condition.notify_all()
+
+    def error(self):
+        with self.condition:
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+
+
+def is_known_missing(ts: str, entry: dict, now: float) -> bool:
+    if entry is None:
+        return False
+    published = datetime.strptime(ts, "%Y%m%d_%H%M%S").timestamp()
+    ttl = RECENT_TTL if entry["checked"] - published < RECENT_WINDOW else MISSING_TTL
+    return now - entry["checked"] < ttl
+
+
+# Streams the body to a temp file and renames it, a killed download never leaves half a workbook.
+# Returns (status, message), status being one of saved, skipped, missing, invalid, error
+def download_file(ts: str, limit: AdaptiveLimit = None):
     save_path = os.path.join(FILES_DIR, f"leaderboard_{ts}.xlsx")
     if os.path.exists(save_path):
         #Yup its a double check
-        return f"⏩ {ts} skipped (already exists)"
+        return "skipped", f"⏩ {ts} skipped (already exists)"
 
     url = leaderboard_link.replace("YYYYMMDD_HHMMSS", ts)
+    tmp_path = save_path + ".part"
+    limit = limit or AdaptiveLimit(1)
+    instrumentation.count("http_requests")
     try:
-        r = requests.get(url, timeout=10)
-        if r.status_code == 200 and len(r.content) > 1000 and r.content[:2] == b"PK":
-            with open(save_path, "wb") as f:
-                f.write(r.content)
-            return f"✅ {ts} saved ({len(r.content)} bytes)"
-        else:
-            return f"❌ {ts} missing or invalid content"
+        with limit, _session().get(url, timeout=10, stream=True) as r:
+            if r.status_code == 429 or r.status_code >= 500:
+                instrumentation.count("http_errors")
+                limit.error()
+                return "error", f"⚠️ {ts} error: HTTP {r.status_code}"
+            limit.success()
+            if r.status_code != 200:
+                return "missing", f"❌ {ts} missing (HTTP {r.status_code})"
+
+            size = 0
+            with open(tmp_path, "wb") as f:
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    if size == 0 and chunk[:2] != b"PK":
+                        break
+                    f.write(chunk)
+                    size += len(chunk)
+            if size <= 1000:
+                os.remove(tmp_path)
+                return "invalid", f"❌ {ts} missing or invalid content"
+            os.replace(tmp_path, save_path)
+            return "saved", f"✅ {ts} saved ({size} bytes)"
     except Exception as e:
-        return f"⚠️ {ts} error: {e}"
+        instrumentation.count("http_errors")
+        limit.error()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return "error", f"⚠️ {ts} error: {e}"
 
-def download(max_workers=10):
+
+# on_file is called with the name of every newly saved workbook as soon as it is on disk
+@instrumentation.measured("download")
+def download(max_workers=DOWNLOAD_WORKERS, on_file=None):
+    stage = instrumentation.current()
     existing_files = set(os.listdir(FILES_DIR))
+    missing = load_manifest(MISSING_PATH)
+    now = time.time()
+    # Leaderboards of the future do not exist yet
+    last = min(datetime.strptime(end_date, "%Y%m%d_%H%M%S"), datetime.now()).strftime("%Y%m%d_%H%M%S")
+    timestamps = [ts for ts in generate_timestamps(start_date, end_date, step_hours) if ts <= last]
+    known_missing = {
+        ts for ts in timestamps
+        if f"leaderboard_{ts}.xlsx" not in existing_files and is_known_missing(ts, missing.get(ts), now)
+    }
     timestamps_to_download = [
-        ts for ts in generate_timestamps(start_date, end_date)
-        if f"leaderboard_{ts}.xlsx" not in existing_files
+        ts for ts in timestamps
+        if f"leaderboard_{ts}.xlsx" not in existing_files and ts not in known_missing
     ]
+    stage.rows_in = len(timestamps_to_download)
+    stage.count("known_missing_skipped", len(known_missing))
 
     if not timestamps_to_download:
-        logger.info("✔ All files already exist, nothing to download.")
+        logger.info("✔ All files already exist or are known to be missing, nothing to download.")
         return
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = {executor.submit(download_file, ts): ts for ts in timestamps_to_download}
+    limit = AdaptiveLimit(max_workers)
+    counts = {}
+    unsaved = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(instrumentation.bind(download_file), ts, limit): ts for ts in timestamps_to_download}
 
-        for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading"):
-            result = future.result()
-            logger.info(result)
-    executor.shutdown()
-    logger.info("✔ Finished downloading all files.")
\ No newline at end of file
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Downloading"):
+                ts = futures[future]
+                status, result = future.result()
+                counts[status] = counts.get(status, 0) + 1
+                stage.count(f"files_{status}")
+                if status in ("missing", "invalid"):
+                    missing[ts] = {"status": status, "checked": time.time()}
+                    unsaved += 1
+                elif status == "saved":
+                    unsaved += missing.pop(ts, None) is not None
+                    if on_file is not None:
+                        on_file(f"leaderboard_{ts}.xlsx")
+                logger.info(result)
+                if unsaved >= MISSING_SAVE_EVERY:
+                    save_manifest(missing, MISSING_PATH)
+                    unsaved = 0
+        executor.shutdown()
+    finally:
+        save_manifest(missing, MISSING_PATH)
+    stage.rows_out = counts.get("saved", 0)
+    logger.info(f"✔ Finished downloading all files: {counts}")
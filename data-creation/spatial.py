@@ -0,0 +1,300 @@
+#The purpose of this file is to answer "who was near whom", "who was near Cape Horn between these dates" or
+#"which fixes fall in this weather cell" without measuring the distance to every fix of the race.
+#Every fix gets a geohash cell (the same cells are stored on the positions table, so the database can answer
+#the same questions from an index) and the fixes are kept sorted by cell id. A geohash prefix is a contiguous
+#range of that order, so a region is a handful of searchsorted ranges and a radius is the 3x3 block of cells
+#at least as large as the radius around the center, and only those candidates get the exact haversine.
+#Like wind_field and tracks everything is NumPy over whole arrays, many queries are answered at once
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+import storage
+from metrics import haversine_nm
+
+logger = logging.getLogger(__name__)
+
+BASE32 = np.frombuffer(b"0123456789bcdefghjkmnpqrstuvwxyz", dtype="uint8")
+# Cells of 8 characters are about 38 x 19 m at the equator, fine enough for any region we ask for
+PRECISION = 8
+# A region is covered with at most this many cells, the coarsest precision that fits is used
+MAX_COVER_CELLS = 64
+# Half the circumference of the earth, no two points are further apart
+MAX_DISTANCE_NM = 10_800
+
+
+def _bits(precision: int) -> tuple:
+    # Longitude takes the even bits, so it gets the extra one when the count is odd
+    bits = 5 * precision
+    return (bits + 1) // 2, bits // 2
+
+
+def _cells(lat: np.ndarray, lon: np.ndarray, precision: int) -> tuple:
+    lon_bits, lat_bits = _bits(precision)
+    ilat = np.clip(np.floor((lat + 90) / 180 * 2 ** lat_bits), 0, 2 ** lat_bits - 1)
+    ilon = np.mod(np.floor((lon + 180) / 360 * 2 ** lon_bits), 2 ** lon_bits)
+    return ilat.astype("int64"), ilon.astype("int64")
+
+
+def _interleave(ilat: np.ndarray, ilon: np.ndarray, precision: int) -> np.ndarray:
+    lon_bits, lat_bits = _bits(precision)
+    ids = np.zeros(np.shape(ilat), dtype="int64")
+    for i in range(5 * precision):
+        if i % 2 == 0:
+            bit = (ilon >> (lon_bits - 1 - i // 2)) & 1
+        else:
+            bit = (ilat >> (lat_bits - 1 - i // 2)) & 1
+        ids = (ids << 1) | bit
+    return ids
+
+
+def cell_ids(lat, lon, precision: int = PRECISION) -> np.ndarray:
+    lat = np.asarray(lat, dtype="float64")
+    lon = np.asarray(lon, dtype="float64")
+    return _interleave(*_cells(np.nan_to_num(lat), np.nan_to_num(lon), precision), precision)
+
+
+def to_geohash(ids: np.ndarray, precision: int = PRECISION) -> np.ndarray:
+    ids = np.asarray(ids, dtype="int64").reshape(-1)
+    digits = (ids[:, None] >> (5 * np.arange(precision - 1, -1, -1))) & 31
+    return np.ascontiguousarray(BASE32[digits]).view(f"S{precision}").ravel().astype(str).astype(object)
+
+
+# Geohash strings of the positions, None where a coordinate is missing
+def geohash(lat, lon, precision: int = PRECISION) -> np.ndarray:
+    lat = np.asarray(lat, dtype="float64")
+    lon = np.asarray(lon, dtype="float64")
+    hashes = to_geohash(cell_ids(lat, lon, precision), precision)
+    hashes[~(np.isfinite(lat) & np.isfinite(lon))] = None
+    return hashes
+
+
+# Geohash cells (finest precision with at most MAX_COVER_CELLS of them) that together cover the box.
+# lon_min > lon_max is a box across the antimeridian
+def cover(lat_min: float, lat_max: float, lon_min: float, lon_max: float) -> tuple:
+    lon_spans = [(lon_min, lon_max)] if lon_min <= lon_max else [(lon_min, 180.0), (-180.0, lon_max)]
+    for precision in range(PRECISION, 0, -1):
+        blocks = []
+        for west, east in lon_spans:
+            (ilat_min, ilat_max), (ilon_min, ilon_max) = _cells(np.array([lat_min, lat_max]), np.array([west, east]),
+                                                               precision)
+            # 180 itself falls in the first column again, the box ends in the last one
+            if east >= 180:
+                ilon_max = 2 ** _bits(precision)[0] - 1
+            blocks.append((ilat_min, ilat_max, ilon_min, ilon_max))
+        count = sum((b[1] - b[0] + 1) * (b[3] - b[2] + 1) for b in blocks)
+        if count <= MAX_COVER_CELLS or precision == 1:
+            break
+
+    cells = []
+    for ilat_min, ilat_max, ilon_min, ilon_max in blocks:
+        ilat, ilon = np.meshgrid(np.arange(ilat_min, ilat_max + 1), np.arange(ilon_min, ilon_max + 1))
+        cells.append(_interleave(ilat.ravel(), ilon.ravel(), precision))
+    return np.unique(np.concatenate(cells)), precision
+
+
+# First and last geohash of PRECISION characters inside each cell, for range queries on a geohash column
+def cell_bounds(cells: np.ndarray, precision: int) -> list:
+    padding = PRECISION - precision
+    return [(cell + "0" * padding, cell + "z" * padding) for cell in to_geohash(cells, precision)]
+
+
+# The 3x3 block of cells around every cell, valid is False for rows past the poles. With few columns the
+# block wraps onto itself, every cell then counts once
+def _neighbours(ilat: np.ndarray, ilon: np.ndarray, precision: int) -> tuple:
+    lon_bits, lat_bits = _bits(precision)
+    offsets = np.array([-1, 0, 1])
+    neighbour_lat = np.repeat(ilat[:, None] + offsets, 3, axis=1)
+    neighbour_lon = np.tile(np.mod(ilon[:, None] + offsets, 2 ** lon_bits), 3)
+    valid = (neighbour_lat >= 0) & (neighbour_lat < 2 ** lat_bits)
+    cells = _interleave(np.clip(neighbour_lat, 0, 2 ** lat_bits - 1), neighbour_lon, precision)
+    if 2 ** lon_bits < 3:
+        cells = np.where(valid, cells, -1)
+        cells.sort(axis=1)
+        valid = (cells >= 0) & np.concatenate([np.ones((len(cells), 1), dtype=bool), cells[:, 1:] != cells[:, :-1]], axis=1)
+    return cells, valid
+
+
+def _ranges(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    # starts[0]..starts[0]+counts[0]-1, starts[1].. concatenated without a Python loop
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype="int64")
+    ends = np.cumsum(counts)
+    return np.repeat(starts - (ends - counts), counts) + np.arange(total)
+
+
+def _seconds(value) -> int:
+    return int(np.datetime64(pd.Timestamp(value).to_datetime64(), "s").astype("int64"))
+
+
+class SpatialIndex:
+    """
+    Fixes of the parser output sorted by geohash cell id: sailor, time (seconds since the epoch), latitude,
+    longitude and cell id of PRECISION characters, all flat arrays in the same order.
+    """
+
+    def __init__(self, sailors: list, codes: np.ndarray, times: np.ndarray, lat: np.ndarray, lon: np.ndarray):
+        ids = cell_ids(lat, lon)
+        order = np.argsort(ids, kind="stable")
+        self.sailors = np.asarray(sailors, dtype=object)
+        self.ids = ids[order]
+        self.codes = codes[order]
+        self.times = times[order]
+        self.lat = lat[order]
+        self.lon = lon[order]
+        self.max_abs_lat = float(np.abs(self.lat).max()) if len(self.lat) else 0.0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "SpatialIndex":
+        df = df.dropna(subset=["Sailor", "Time in France", "Latitude", "Longitude"])
+        sailor = pd.Categorical(df["Sailor"].astype(object))
+        return cls(
+            list(sailor.categories),
+            sailor.codes.astype("int64"),
+            df["Time in France"].to_numpy(dtype="datetime64[s]").astype("int64"),
+            df["Latitude"].to_numpy(dtype="float64"),
+            df["Longitude"].to_numpy(dtype="float64"),
+        )
+
+    @classmethod
+    def from_dataset(cls, name: str = "total", filters: list = None) -> "SpatialIndex":
+        columns = ["Sailor", "Time in France", "Latitude", "Longitude"]
+        return cls.from_frame(storage.read(name, columns=columns, filters=filters))
+
+    def _in_window(self, rows: np.ndarray, start=None, end=None) -> np.ndarray:
+        keep = np.ones(len(rows), dtype=bool)
+        if start is not None:
+            keep &= self.times[rows] >= _seconds(start)
+        if end is not None:
+            keep &= self.times[rows] <= _seconds(end)
+        return keep
+
+    def _frame(self, rows: np.ndarray, **columns) -> pd.DataFrame:
+        df = pd.DataFrame(columns)
+        df["Sailor"] = self.sailors[self.codes[rows]]
+        df["Time in France"] = self.times[rows].astype("datetime64[s]").astype("datetime64[ns]")
+        df["Latitude"] = self.lat[rows]
+        df["Longitude"] = self.lon[rows]
+        return df
+
+    # Coarsest-first search precision whose cells are at least radius_nm high and wide wherever the
+    # searched points can be, None when even the largest cells are too small (the search scans everything)
+    def _search_precision(self, radius_nm: float, max_abs_lat: float):
+        max_abs_lat = min(max(max_abs_lat, self.max_abs_lat) + radius_nm / 60, 89.0)
+        for precision in range(PRECISION, 0, -1):
+            lon_bits, lat_bits = _bits(precision)
+            height = 180 / 2 ** lat_bits * 60
+            width = 360 / 2 ** lon_bits * 60 * np.cos(np.radians(max_abs_lat))
+            if height >= radius_nm and width >= radius_nm:
+                return precision
+        return None
+
+    # (query, row) candidate pairs: the rows in the 3x3 cells around every query point
+    def _candidates(self, lat: np.ndarray, lon: np.ndarray, radius_nm: float) -> tuple:
+        precision = self._search_precision(radius_nm, float(np.abs(lat).max()) if len(lat) else 0.0)
+        if precision is None:
+            return np.repeat(np.arange(len(lat)), len(self)), np.tile(np.arange(len(self)), len(lat))
+
+        cells, valid = _neighbours(*_cells(lat, lon, precision), precision)
+        shift = 5 * (PRECISION - precision)
+        lo = np.searchsorted(self.ids, cells << shift)
+        hi = np.searchsorted(self.ids, (cells + 1) << shift)
+        counts = np.where(valid, hi - lo, 0).ravel()
+        queries = np.repeat(np.repeat(np.arange(len(lat)), 9), counts)
+        return queries, _ranges(lo.ravel(), counts)
+
+    # Every fix within radius_nm of every (lat, lon) center, with the index of the center it belongs to
+    def radius(self, lat, lon, radius_nm: float, start=None, end=None) -> pd.DataFrame:
+        lat = np.atleast_1d(np.asarray(lat, dtype="float64"))
+        lon = np.atleast_1d(np.asarray(lon, dtype="float64"))
+        queries, rows = self._candidates(lat, lon, radius_nm)
+        keep = self._in_window(rows, start, end)
+        queries, rows = queries[keep], rows[keep]
+        distance = haversine_nm(lat[queries], lon[queries], self.lat[rows], self.lon[rows])
+        keep = distance <= radius_nm
+        return self._frame(rows[keep], query=queries[keep], Distance=distance[keep]).sort_values(
+            ["query", "Distance"], kind="stable", ignore_index=True)
+
+    # The k fixes closest to every center, searched in growing radii until every center has k of them
+    def nearest(self, lat, lon, k: int = 1, start=None, end=None, radius_nm: float = 60) -> pd.DataFrame:
+        lat = np.atleast_1d(np.asarray(lat, dtype="float64"))
+        lon = np.atleast_1d(np.asarray(lon, dtype="float64"))
+        pending = np.arange(len(lat))
+        found = []
+        while len(pending):
+            matches = self.radius(lat[pending], lon[pending], radius_nm, start, end)
+            matches["query"] = pending[matches["query"].to_numpy()]
+            counts = np.bincount(matches["query"].to_numpy(), minlength=len(lat))[pending]
+            done = (counts >= k) | (radius_nm >= MAX_DISTANCE_NM)
+            found.append(matches[matches["query"].isin(pending[done])])
+            pending = pending[~done]
+            radius_nm *= 4
+        matches = pd.concat(found, ignore_index=True).sort_values(["query", "Distance"], kind="stable")
+        return matches.groupby("query", sort=True).head(k).reset_index(drop=True)
+
+    # Fixes inside the box, lon_min > lon_max is a box across the antimeridian
+    def bbox(self, lat_min: float, lat_max: float, lon_min: float, lon_max: float, start=None, end=None) -> pd.DataFrame:
+        cells, precision = cover(lat_min, lat_max, lon_min, lon_max)
+        shift = 5 * (PRECISION - precision)
+        lo = np.searchsorted(self.ids, cells << shift)
+        hi = np.searchsorted(self.ids, (cells + 1) << shift)
+        rows = _ranges(lo, hi - lo)
+
+        lat, lon = self.lat[rows], self.lon[rows]
+        inside = (lat >= lat_min) & (lat <= lat_max)
+        if lon_min <= lon_max:
+            inside &= (lon >= lon_min) & (lon <= lon_max)
+        else:
+            inside &= (lon >= lon_min) | (lon <= lon_max)
+        rows = rows[inside & self._in_window(rows, start, end)]
+        return self._frame(np.sort(rows)).sort_values(["Time in France", "Sailor"], kind="stable", ignore_index=True)
+
+    # Boats within radius_nm of each other at the same report time, every pair once
+    def close_pairs(self, radius_nm: float, start=None, end=None) -> pd.DataFrame:
+        rows = np.flatnonzero(self._in_window(np.arange(len(self)), start, end))
+        precision = self._search_precision(radius_nm, 0.0)
+
+        _, time_rank = np.unique(self.times[rows], return_inverse=True)
+        time_rank = time_rank.astype("int64")
+
+        if precision is None:
+            # No cells are as large as the radius: every boat of a report time is a candidate
+            order = np.argsort(time_rank, kind="stable")
+            rows, time_rank = rows[order], time_rank[order]
+            lo = np.searchsorted(time_rank, time_rank)[:, None]
+            hi = np.searchsorted(time_rank, time_rank, side="right")[:, None]
+            valid = np.ones(lo.shape, dtype=bool)
+        else:
+            # Sorted by (report time, cell), the fixes of one time in one cell are a contiguous range
+            ilat, ilon = _cells(self.lat[rows], self.lon[rows], precision)
+            bits = 5 * precision
+            keys = (time_rank << bits) | _interleave(ilat, ilon, precision)
+            order = np.argsort(keys, kind="stable")
+            rows, keys, time_rank, ilat, ilon = rows[order], keys[order], time_rank[order], ilat[order], ilon[order]
+            cells, valid = _neighbours(ilat, ilon, precision)
+            neighbour_keys = (time_rank[:, None] << bits) | cells
+            lo = np.searchsorted(keys, neighbour_keys)
+            hi = np.searchsorted(keys, neighbour_keys, side="right")
+
+        counts = np.where(valid, hi - lo, 0).ravel()
+        first = np.repeat(np.repeat(np.arange(len(rows)), lo.shape[1]), counts)
+        second = _ranges(lo.ravel(), counts)
+        keep = first < second
+        a, b = rows[first[keep]], rows[second[keep]]
+        distance = haversine_nm(self.lat[a], self.lon[a], self.lat[b], self.lon[b])
+        keep = distance <= radius_nm
+        a, b, distance = a[keep], b[keep], distance[keep]
+
+        pairs = pd.DataFrame({
+            "Time in France": self.times[a].astype("datetime64[s]").astype("datetime64[ns]"),
+            "Sailor A": self.sailors[self.codes[a]],
+            "Sailor B": self.sailors[self.codes[b]],
+            "Distance": distance,
+        })
+        return pairs.sort_values(["Time in France", "Distance"], kind="stable", ignore_index=True)
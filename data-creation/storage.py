@@ -0,0 +1,168 @@
+#The purpose of this file is to hand data from one stage to the next without going through CSV every time.
+#Datasets are stored as Parquet with a fixed schema, partitioned by race day, so the types survive the
+#round trip and a stage can read only the columns and days it needs.
+#A plain .csv with the same name is still picked up if no Parquet version exists (drop in files keep working)
+#and EXPORT_CSV=1 writes one next to every Parquet dataset
+
+import logging
+import os
+import shutil
+import uuid
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import schema
+
+logger = logging.getLogger(__name__)
+
+# DATA_DIR (env) moves files/, output/, chunks/ and wind/ of every stage somewhere else, e.g. a benchmark workspace
+DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(__file__))
+OUTPUT_DIR = os.path.join(DATA_DIR, "output")
+EXPORT_CSV = os.environ.get("EXPORT_CSV", "0") == "1"
+PARTITION_COLUMN = "race_day"
+TIME_COLUMN = "Time in France"
+
+# Arrow schema of every dataset, the columns and their types are defined in schema.py
+SCHEMAS = {name: schema.arrow_schema(name) for name in ["total", "dataset", "metrics"]}
+
+
+def dataset_path(name: str, output_dir: str = OUTPUT_DIR) -> str:
+    return os.path.join(output_dir, name)
+
+
+def csv_path(name: str, output_dir: str = OUTPUT_DIR) -> str:
+    return os.path.join(output_dir, f"{name}.csv")
+
+
+def exists(name: str, output_dir: str = OUTPUT_DIR) -> bool:
+    return os.path.isdir(dataset_path(name, output_dir)) or os.path.exists(csv_path(name, output_dir))
+
+
+# Columns are put in schema order and validated against schema.py, a missing column or a value that
+# does not fit its type is an error
+def to_table(df: pd.DataFrame, name: str) -> pa.Table:
+    table = schema.to_arrow(df, name)
+    race_day = pc.strftime(table[TIME_COLUMN], format="%Y-%m-%d")
+    return table.append_column(PARTITION_COLUMN, race_day)
+
+
+# mode="overwrite" replaces the whole dataset, mode="append" adds new files next to the existing ones
+def write(df: pd.DataFrame, name: str, mode: str = "overwrite", output_dir: str = OUTPUT_DIR):
+    path = dataset_path(name, output_dir)
+    if mode == "overwrite" and os.path.isdir(path):
+        shutil.rmtree(path)
+
+    table = to_table(df, name)
+    ds.write_dataset(
+        table,
+        path,
+        format="parquet",
+        partitioning=_partitioning(),
+        basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    logger.info(f"Saved {table.num_rows} rows to {path}")
+
+    if EXPORT_CSV:
+        export_csv(name, output_dir)
+
+
+# A CSV too big to hold in memory becomes a dataset chunk_rows rows at a time, every chunk adds its files to the
+# race day partitions it has rows for
+def import_csv(path: str, name: str, chunk_rows: int, output_dir: str = OUTPUT_DIR) -> int:
+    target = dataset_path(name, output_dir)
+    if os.path.isdir(target):
+        shutil.rmtree(target)
+    rows = 0
+    for i, df in enumerate(pd.read_csv(path, usecols=schema.columns(name), parse_dates=[TIME_COLUMN],
+                                       chunksize=chunk_rows)):
+        ds.write_dataset(
+            to_table(df, name),
+            target,
+            format="parquet",
+            partitioning=_partitioning(),
+            basename_template=f"part-{i:05d}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+        rows += len(df)
+    logger.info(f"Imported {rows} rows of {path} to {target}")
+    return rows
+
+
+# A single Parquet file with the dataset schema, the parser keeps one per source file
+def write_file(df: pd.DataFrame, name: str, path: str):
+    pq.write_table(to_table(df, name), path)
+
+
+def read_files(paths: list) -> pd.DataFrame:
+    tables = [pq.read_table(path, memory_map=True) for path in paths]
+    table = pa.concat_tables(tables)
+    return schema.from_arrow(table.drop_columns([PARTITION_COLUMN]))
+
+
+def _partitioning():
+    return ds.partitioning(pa.schema([(PARTITION_COLUMN, pa.string())]), flavor="hive")
+
+
+# Fallback for a dropped in .csv, it goes through the same schema so the result looks the same
+def _read_csv(name: str, output_dir: str) -> pa.Table:
+    df = pd.read_csv(csv_path(name, output_dir), parse_dates=[TIME_COLUMN])
+    return to_table(df, name)
+
+
+# columns is pushed down as a projection and filters (pyarrow filter tuples, e.g.
+# [("race_day", ">=", "2025-01-01")] or [("Sailor", "==", "Charlie Dalin")]) as a predicate,
+# so only the needed columns and row groups are read from disk
+def read(name: str, columns: list = None, filters: list = None, output_dir: str = OUTPUT_DIR) -> pd.DataFrame:
+    path = dataset_path(name, output_dir)
+    if os.path.isdir(path):
+        table = pq.read_table(path, columns=columns, filters=filters, memory_map=True, partitioning=_partitioning())
+    elif os.path.exists(csv_path(name, output_dir)):
+        table = _read_csv(name, output_dir)
+        if filters:
+            table = table.filter(pq.filters_to_expression(filters))
+        if columns:
+            table = table.select(columns)
+    else:
+        raise FileNotFoundError(f"Dataset '{name}' not found in {output_dir}")
+
+    if PARTITION_COLUMN in table.column_names and not (columns and PARTITION_COLUMN in columns):
+        table = table.drop_columns([PARTITION_COLUMN])
+    # Rows come back grouped by partition file, a stable sort on time gives the stages a fixed order
+    if TIME_COLUMN in table.column_names:
+        table = table.sort_by([(TIME_COLUMN, "ascending")])
+    return schema.from_arrow(table)
+
+
+# The race days a dataset has rows for, read from the partition directories without touching the data
+def race_days(name: str, output_dir: str = OUTPUT_DIR) -> list:
+    path = dataset_path(name, output_dir)
+    if os.path.isdir(path):
+        prefix = f"{PARTITION_COLUMN}="
+        return sorted(d[len(prefix):] for d in os.listdir(path) if d.startswith(prefix))
+    times = read(name, columns=[TIME_COLUMN], output_dir=output_dir)[TIME_COLUMN]
+    return sorted(times.dt.strftime("%Y-%m-%d").unique())
+
+
+# Every race day of a dataset with its rows, one partition read at a time. A dropped in .csv is read once
+# and split, instead of once per day
+def iter_race_days(name: str, columns: list = None, output_dir: str = OUTPUT_DIR):
+    if os.path.isdir(dataset_path(name, output_dir)):
+        for race_day in race_days(name, output_dir):
+            yield race_day, read(name, columns=columns, filters=[(PARTITION_COLUMN, "==", race_day)],
+                                 output_dir=output_dir)
+        return
+    df = read(name, columns=columns, output_dir=output_dir)
+    days = df[TIME_COLUMN].dt.strftime("%Y-%m-%d")
+    for race_day, rows in df.groupby(days, sort=True):
+        yield race_day, rows.reset_index(drop=True)
+
+
+def export_csv(name: str, output_dir: str = OUTPUT_DIR):
+    df = read(name, output_dir=output_dir)
+    df.to_csv(csv_path(name, output_dir), index=False)
+    logger.info(f"Exported {len(df)} rows to {csv_path(name, output_dir)}")
@@ -0,0 +1,219 @@
+#The purpose of this file is to answer track questions (where was this boat at that time, where was the whole
+#fleet at an instant, what did a boat do between two dates) without reloading and filtering a DataFrame.
+#The reports of the parser output are kept in flat NumPy arrays sorted by (sailor, time), so the track of
+#one sailor is one contiguous slice of every array, and a (sailor, second) key packed into one int64 finds
+#the reports around any batch of query times with a single searchsorted, like wind_field does for the grid.
+#Saved as one .npy per array, loading memory-maps them so a reader only pages in what it touches
+
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import storage
+
+logger = logging.getLogger(__name__)
+
+TRACKS_DIR = os.path.join(storage.OUTPUT_DIR, "tracks")
+# Parser columns kept per report, positions in double precision, the rest fits in float32
+COLUMNS = {
+    "lat": ("Latitude", "float64"),
+    "lon": ("Longitude", "float64"),
+    "speed": ("Speed Last Report", "float32"),
+    "heading": ("Heading Last Report", "float32"),
+    "dtf": ("DTF", "float32"),
+}
+ARRAYS = ["keys", "times", "offsets"] + list(COLUMNS)
+
+
+def _seconds(times) -> np.ndarray:
+    # Seconds since the epoch as floats, so a query between two whole seconds still interpolates exactly
+    times = np.asarray(times, dtype="datetime64[ns]")
+    return times.astype("int64") / 1e9
+
+
+def _pack(codes: np.ndarray, seconds: np.ndarray) -> np.ndarray:
+    return (codes.astype("int64") << 32) | seconds.astype("int64")
+
+
+def _interpolate_angle(a0: np.ndarray, a1: np.ndarray, w: np.ndarray) -> np.ndarray:
+    # Along the shorter arc, 350 -> 10 goes through 0 and not through 180
+    return np.mod(a0 + (np.mod(a1 - a0 + 180, 360) - 180) * w, 360)
+
+
+class RaceTracks:
+    """
+    Every report of every sailor in flat arrays sorted by (sailor, time). Sailor i owns the rows
+    offsets[i]:offsets[i + 1] of each array, times are seconds since the epoch.
+    """
+
+    def __init__(self, sailors: list, arrays: dict):
+        self.sailors = list(sailors)
+        self._codes = {sailor: i for i, sailor in enumerate(self.sailors)}
+        self.keys = arrays["keys"]
+        self.times = arrays["times"]
+        self.offsets = arrays["offsets"]
+        for name in COLUMNS:
+            setattr(self, name, arrays[name])
+
+    def __len__(self) -> int:
+        return len(self.times)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in ARRAYS)
+
+    # A sailor that reports twice with the same time (stale snapshots) keeps its first report
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> "RaceTracks":
+        sailor = pd.Categorical(df["Sailor"].astype(object))
+        sailors = list(sailor.categories)
+        codes = sailor.codes.astype("int64")
+        seconds = df["Time in France"].to_numpy(dtype="datetime64[s]").astype("int64")
+        valid = (codes >= 0) & (seconds != np.iinfo("int64").min)
+
+        keys, first = np.unique(_pack(codes[valid], seconds[valid]), return_index=True)
+        rows = np.flatnonzero(valid)[first]
+        arrays = {
+            "keys": keys,
+            "times": seconds[rows],
+            "offsets": np.searchsorted(keys >> 32, np.arange(len(sailors) + 1)).astype("int64"),
+        }
+        for name, (column, dtype) in COLUMNS.items():
+            arrays[name] = df[column].to_numpy(dtype="float64", na_value=np.nan)[rows].astype(dtype)
+        return cls(sailors, arrays)
+
+    @classmethod
+    def from_dataset(cls, name: str = "total", filters: list = None) -> "RaceTracks":
+        columns = ["Sailor", "Time in France"] + [column for column, _ in COLUMNS.values()]
+        return cls.from_frame(storage.read(name, columns=columns, filters=filters))
+
+    def save(self, path: str = TRACKS_DIR):
+        os.makedirs(path, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(getattr(self, name)))
+        with open(os.path.join(path, "sailors.json"), "w", encoding="utf-8") as f:
+            json.dump(self.sailors, f, ensure_ascii=False)
+        logger.info(f"Saved {len(self)} reports of {len(self.sailors)} sailors to {path}")
+
+    @classmethod
+    def load(cls, path: str = TRACKS_DIR, mmap: bool = True) -> "RaceTracks":
+        with open(os.path.join(path, "sailors.json"), "r", encoding="utf-8") as f:
+            sailors = json.load(f)
+        arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+                  for name in ARRAYS}
+        return cls(sailors, arrays)
+
+    # Sailor names (or ids) -> ids, -1 for unknown names
+    def sailor_ids(self, sailors) -> np.ndarray:
+        sailors = np.asarray(sailors, dtype=object)
+        if sailors.size and all(isinstance(s, (int, np.integer)) for s in sailors.flat):
+            return sailors.astype("int64")
+        return np.vectorize(lambda s: self._codes.get(s, -1), otypes=["int64"])(sailors)
+
+    # The reports of one sailor, views into the flat arrays
+    def track(self, sailor) -> dict:
+        code = int(self.sailor_ids([sailor])[0])
+        if code < 0:
+            raise KeyError(f"Unknown sailor {sailor}")
+        start, end = self.offsets[code], self.offsets[code + 1]
+        track = {"times": self.times[start:end].astype("datetime64[s]")}
+        for name in COLUMNS:
+            track[name] = getattr(self, name)[start:end]
+        return track
+
+    # Vectorized lookup for any number of (sailor, time) queries, sailors and times are broadcast against
+    # each other. Values between two reports are interpolated linearly in time (heading along the shorter arc,
+    # longitude across the antimeridian), queries before the first or after the last report of a sailor are NaN
+    def at(self, sailors, times) -> dict:
+        codes, seconds = np.broadcast_arrays(self.sailor_ids(sailors), _seconds(times))
+        codes = codes.ravel()
+        seconds = seconds.ravel()
+        known = codes >= 0
+        safe_codes = np.where(known, codes, 0)
+
+        # Last report at or before the query and the one after it
+        lo = np.searchsorted(self.keys, _pack(safe_codes, np.floor(seconds)), side="right") - 1
+        start = self.offsets[safe_codes]
+        end = self.offsets[safe_codes + 1]
+        lo_safe = np.clip(lo, 0, max(len(self) - 1, 0))
+        hi_safe = np.clip(lo + 1, 0, max(len(self) - 1, 0))
+        t0 = self.times[lo_safe] if len(self) else np.zeros(len(lo))
+        t1 = self.times[hi_safe] if len(self) else np.zeros(len(lo))
+
+        exact = known & (lo >= start) & (lo < end) & (t0 == seconds)
+        between = known & (lo >= start) & (lo + 1 < end) & ~exact
+        valid = exact | between
+        with np.errstate(invalid="ignore", divide="ignore"):
+            w = np.where(between, (seconds - t0) / (t1 - t0), 0.0)
+
+        result = {}
+        for name in COLUMNS:
+            values = getattr(self, name)
+            if not len(self):
+                result[name] = np.full(len(codes), np.nan)
+                continue
+            v0 = values[lo_safe].astype("float64")
+            v1 = values[hi_safe].astype("float64")
+            if name == "heading":
+                value = _interpolate_angle(v0, v1, w)
+            elif name == "lon":
+                value = np.mod(v0 + (np.mod(v1 - v0 + 180, 360) - 180) * w + 180, 360) - 180
+            else:
+                value = v0 + (v1 - v0) * w
+            result[name] = np.where(valid, value, np.nan)
+        return result
+
+    def position_at(self, sailors, times) -> tuple:
+        result = self.at(sailors, times)
+        return result["lat"], result["lon"]
+
+    # Where every sailor was at one instant, sailors without a report on both sides of it are left out
+    def snapshot(self, time) -> pd.DataFrame:
+        codes = np.arange(len(self.sailors))
+        result = self.at(codes, np.full(len(codes), np.datetime64(pd.Timestamp(time).to_datetime64(), "ns")))
+        df = pd.DataFrame({
+            "Sailor": self.sailors,
+            "Latitude": result["lat"],
+            "Longitude": result["lon"],
+            "Speed": result["speed"],
+            "Heading": result["heading"],
+            "DTF": result["dtf"],
+        })
+        return df[df["Latitude"].notna()].sort_values("DTF", kind="stable").reset_index(drop=True)
+
+    # The reports between start and end (both included), optionally of some sailors only, as new tracks
+    def slice(self, start=None, end=None, sailors=None) -> "RaceTracks":
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.times >= int(np.floor(_seconds([start])[0]))
+        if end is not None:
+            mask &= self.times <= int(np.floor(_seconds([end])[0]))
+        if sailors is not None:
+            codes = self.keys >> 32
+            mask &= np.isin(codes, self.sailor_ids(sailors))
+
+        keys = self.keys[mask]
+        arrays = {
+            "keys": keys,
+            "times": self.times[mask],
+            "offsets": np.searchsorted(keys >> 32, np.arange(len(self.sailors) + 1)).astype("int64"),
+        }
+        for name in COLUMNS:
+            arrays[name] = getattr(self, name)[mask]
+        return RaceTracks(self.sailors, arrays)
+
+
+# Builds the tracks of the parser output and saves them for the readers
+@instrumentation.measured("tracks")
+def build(name: str = "total", path: str = TRACKS_DIR) -> RaceTracks:
+    if not storage.exists(name):
+        logger.info(f"Dataset '{name}' does not exist yet. Skipping tracks.")
+        return None
+    tracks = RaceTracks.from_dataset(name)
+    tracks.save(path)
+    instrumentation.current().rows_out = len(tracks)
+    return tracks
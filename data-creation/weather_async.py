@@ -0,0 +1,240 @@
+#The purpose of this file is to fetch the weather batches of combiner.plan_weather_batches concurrently.
+#Instead of fixed sleeps the requests are paced by token buckets set to the provider's quotas,
+#429/5xx answers are retried with exponential backoff (honoring Retry-After), other 4xx fail the batch
+#right away, and every finished
+#batch is written to a checkpoint, so a restart continues exactly where the last run stopped
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+
+import aiohttp
+import numpy as np
+from tqdm import tqdm
+
+import combiner
+import instrumentation
+import storage
+from weather_cache import WeatherCache, get_default_cache
+
+logger = logging.getLogger(__name__)
+
+# Open-Meteo free tier quotas, a request for n locations counts as n calls
+QUOTAS = [(600, 60), (5000, 60 * 60)]
+CHECKPOINT_PATH = os.path.join(combiner.WIND_DIR, "wind_checkpoint.jsonl")
+
+
+class TokenBucket:
+    """
+    Holds up to `capacity` tokens and refills them continuously over `period` seconds.
+    """
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, cost: float = 1):
+        cost = min(cost, self.capacity)
+        async with self.lock:
+            self._refill()
+            while self.tokens < cost:
+                await asyncio.sleep((cost - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= cost
+
+
+class RateLimiter:
+    """
+    All buckets have to agree before a request goes out, e.g. a per minute and a per hour quota.
+    """
+
+    def __init__(self, quotas: list = None):
+        self.buckets = [TokenBucket(capacity, period) for capacity, period in (quotas or QUOTAS)]
+
+    async def acquire(self, cost: float = 1):
+        for bucket in self.buckets:
+            await bucket.acquire(cost)
+
+
+def _retry_delay(response, attempt: int, base_delay: float, max_delay: float) -> float:
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after is not None:
+        try:
+            return min(float(retry_after), max_delay)
+        except ValueError:
+            pass
+    return min(base_delay * 2 ** attempt, max_delay) * (0.5 + random.random() / 2)
+
+
+async def fetch_batch(session, limiter: RateLimiter, semaphore: asyncio.Semaphore, coordinates: list,
+                      start_date: str, end_date: str, max_retries: int = 6, base_delay: float = 2,
+                      max_delay: float = 120) -> list:
+    params = {
+        "latitude": ",".join(f"{lat:.4f}" for lat, _ in coordinates),
+        "longitude": ",".join(f"{lon:.4f}" for _, lon in coordinates),
+        "start_date": start_date,
+        "end_date": end_date,
+        "hourly": ",".join(combiner.HOURLY_VARIABLES),
+        "timezone": "Europe/Paris",
+    }
+
+    for attempt in range(max_retries):
+        response = None
+        try:
+            await limiter.acquire(len(coordinates))
+            async with semaphore:
+                instrumentation.count("http_requests")
+                async with session.get(combiner.ARCHIVE_API_URL, params=params) as response:
+                    if response.status == 429 or response.status >= 500:
+                        raise aiohttp.ClientResponseError(response.request_info, (), status=response.status)
+                    if response.status >= 400:
+                        # The same request would get the same answer, no point in retrying it
+                        body = await response.text()
+                        logger.error(f"{response.status} for {len(coordinates)} locations {start_date}..{end_date}, "
+                                     f"not retrying: {body[:200]}")
+                        instrumentation.count("http_failures")
+                        return None
+                    data = await response.json(content_type=None)
+            if isinstance(data, dict):
+                data = [data]
+            if len(data) != len(coordinates):
+                raise ValueError(f"expected {len(coordinates)} locations, got {len(data)}")
+            return [location.get("hourly", {}) for location in data]
+
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            instrumentation.count("http_retries")
+            delay = _retry_delay(response, attempt, base_delay, max_delay)
+            logger.warning(f"Attempt {attempt+1} failed for {len(coordinates)} locations "
+                           f"{start_date}..{end_date}: {e}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    instrumentation.count("http_failures")
+    return None
+
+
+# The checkpoint starts with a line describing the plan, a checkpoint of another plan is not reused
+def _plan_id(df, batches: list) -> str:
+    digest = hashlib.sha256()
+    digest.update(str(len(df)).encode())
+    for start, end, coordinates, _ in batches:
+        digest.update(f"{start}{end}{coordinates}".encode())
+    return digest.hexdigest()
+
+
+def load_checkpoint(path: str, plan_id: str) -> dict:
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    try:
+        header = json.loads(lines[0]) if lines else None
+    except json.JSONDecodeError:
+        # Cut off while the header was written, nothing after it can be trusted either
+        header = None
+    if not isinstance(header, dict) or header.get("plan") != plan_id:
+        logger.info("Checkpoint belongs to another plan or is unreadable, starting from scratch.")
+        return done
+    good_lines = lines[:1]
+    for line in lines[1:]:
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError:
+            # Last line of a run that was killed mid-write, cut it off so new records start on a clean line
+            with open(path, "w", encoding="utf-8") as f:
+                f.writelines(good_lines)
+            break
+        done[record["batch"]] = np.array(record["wind"], dtype="float64")
+        good_lines.append(line)
+    return done
+
+
+async def _run(df, batches: list, checkpoint_path: str, max_concurrency: int, quotas: list,
+               cache: WeatherCache) -> np.ndarray:
+    query_times = df["Time in France"].to_numpy(dtype="datetime64[ns]")
+    wind = np.full((len(df), len(combiner.HOURLY_VARIABLES)), np.nan)
+
+    plan_id = _plan_id(df, batches)
+    done = load_checkpoint(checkpoint_path, plan_id)
+    for i, (_, _, _, cell_rows) in enumerate(batches):
+        if i in done:
+            wind[np.concatenate(cell_rows)] = done[i]
+    pending = [i for i in range(len(batches)) if i not in done]
+    logger.info(f"{len(done)} of {len(batches)} batches restored from checkpoint, {len(pending)} to fetch")
+
+    mode = "a" if done else "w"
+    limiter = RateLimiter(quotas)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    connector = aiohttp.TCPConnector(limit=max_concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
+
+    with open(checkpoint_path, mode, encoding="utf-8") as checkpoint:
+        if mode == "w":
+            checkpoint.write(json.dumps({"plan": plan_id}) + "\n")
+
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            # Cells the weather cache already knows are not asked for again
+            async def work(i):
+                start, end, coordinates, cell_rows = batches[i]
+                hourly_per_cell = cache.get_range_many(coordinates, start, end)
+                missing = [j for j, hourly in enumerate(hourly_per_cell) if hourly is None]
+                if missing:
+                    missing_coordinates = [coordinates[j] for j in missing]
+                    fetched = await fetch_batch(session, limiter, semaphore, missing_coordinates, start, end)
+                    if fetched is None:
+                        return i, None
+                    cache.put_range_many(missing_coordinates, fetched)
+                    for j, hourly in zip(missing, fetched):
+                        hourly_per_cell[j] = hourly
+                return i, hourly_per_cell
+
+            failed = 0
+            tasks = [asyncio.create_task(work(i)) for i in pending]
+            for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Fetching weather"):
+                i, hourly_per_cell = await task
+                if hourly_per_cell is None:
+                    failed += 1
+                    continue
+                _, _, _, cell_rows = batches[i]
+                for rows, hourly in zip(cell_rows, hourly_per_cell):
+                    wind[rows] = combiner.nearest_hourly_samples(hourly, query_times[rows])
+                batch_wind = wind[np.concatenate(cell_rows)]
+                checkpoint.write(json.dumps({"batch": i, "wind": np.where(np.isnan(batch_wind), None, batch_wind)
+                                            .tolist()}) + "\n")
+                checkpoint.flush()
+
+    logger.info(f"Weather cache: {cache.stats()}")
+    if failed:
+        logger.error(f"{failed} batches failed after all retries, rerun to fetch them")
+    return wind
+
+
+@instrumentation.measured("fetch_weather")
+def call_for_data_async(grid_resolution: float = 0.25, locations_per_request: int = 100, days_per_request: int = 1,
+                        max_concurrency: int = 8, quotas: list = None, output_path: str = None,
+                        checkpoint_path: str = CHECKPOINT_PATH, cache: WeatherCache = None):
+    output_path = output_path or os.path.join(combiner.WIND_DIR, "wind_data.csv")
+    df = storage.read("total", columns=["Time in France", "Latitude", "Longitude", "Sailor"])
+    if df.empty:
+        logger.warning("No positions to enrich.")
+        return
+
+    batches = combiner.plan_weather_batches(df, grid_resolution, locations_per_request, days_per_request)
+    logger.info(f"Fetching weather for {len(df)} rows with {len(batches)} requests, "
+                f"up to {max_concurrency} at a time")
+
+    wind = asyncio.run(_run(df, batches, checkpoint_path, max_concurrency, quotas or QUOTAS,
+                            cache or get_default_cache()))
+    combiner.save_wind_data(df, wind, output_path)
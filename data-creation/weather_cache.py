@@ -0,0 +1,201 @@
+#The purpose of this file is to keep every hourly weather answer we ever got from Open-Meteo on disk.
+#Answers are stored per (lat/lon cell, day), a cell being the position quantized to `resolution` degrees,
+#so boats sailing through the same area on the same day and reruns of the enrichment share them.
+#The store is a single SQLite file, least recently used days are evicted once it grows past max_bytes
+
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+import numpy as np
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get("DATA_DIR", os.path.dirname(__file__))
+WIND_DIR = os.path.join(DATA_DIR, "wind")
+# WEATHER_CACHE (env) points several races (scheduler.py) to one cache, they sail through the same areas
+CACHE_PATH = os.environ.get("WEATHER_CACHE", os.path.join(WIND_DIR, "weather_cache.sqlite"))
+# Seconds a write waits for another process holding the cache
+LOCK_TIMEOUT = 60
+DEFAULT_RESOLUTION = 0.25
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+
+class WeatherCache:
+    """
+    Hourly weather per quantized (lat, lon) cell and day, with size based LRU eviction and hit/miss stats.
+    """
+
+    def __init__(self, path: str = CACHE_PATH, resolution: float = DEFAULT_RESOLUTION,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.resolution = resolution
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS hourly (
+                resolution REAL NOT NULL,
+                ilat INTEGER NOT NULL,
+                ilon INTEGER NOT NULL,
+                day TEXT NOT NULL,
+                payload BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (resolution, ilat, ilon, day)
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS hourly_last_access ON hourly (last_access)")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def cell(self, lat: float, lon: float) -> tuple:
+        return int(round(lat / self.resolution)), int(round(lon / self.resolution))
+
+    def _key(self, lat: float, lon: float, day: str) -> tuple:
+        ilat, ilon = self.cell(lat, lon)
+        return self.resolution, ilat, ilon, day
+
+    def get(self, lat: float, lon: float, day: str) -> dict:
+        return self.get_many([(lat, lon, day)])[0]
+
+    # Looks up many (lat, lon, day) at once, None for every miss
+    def get_many(self, queries: list) -> list:
+        results = []
+        touched = []
+        for lat, lon, day in queries:
+            key = self._key(lat, lon, day)
+            row = self.connection.execute(
+                "SELECT payload FROM hourly WHERE resolution = ? AND ilat = ? AND ilon = ? AND day = ?", key
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                instrumentation.count("weather_cache_misses")
+                results.append(None)
+                continue
+            self.hits += 1
+            instrumentation.count("weather_cache_hits")
+            touched.append((time.time(),) + key)
+            results.append(json.loads(zlib.decompress(row[0])))
+
+        if touched:
+            self.connection.executemany(
+                "UPDATE hourly SET last_access = ? WHERE resolution = ? AND ilat = ? AND ilon = ? AND day = ?", touched
+            )
+            self.connection.commit()
+        return results
+
+    def put(self, lat: float, lon: float, day: str, hourly: dict):
+        self.put_many([(lat, lon, day, hourly)])
+
+    def put_many(self, entries: list):
+        now = time.time()
+        rows = []
+        for lat, lon, day, hourly in entries:
+            if not hourly or not hourly.get("time"):
+                # Failed or empty answers are not cached, they get asked again next time
+                continue
+            payload = zlib.compress(json.dumps(hourly).encode("utf-8"))
+            rows.append(self._key(lat, lon, day) + (payload, len(payload), now))
+        if not rows:
+            return
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO hourly (resolution, ilat, ilon, day, payload, size, last_access) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+        )
+        self.connection.commit()
+        self.evict()
+
+    # Multi day answers are stored per day, so a later request for another day range can still use them
+    def get_range(self, lat: float, lon: float, start_date: str, end_date: str) -> dict:
+        return self.get_range_many([(lat, lon)], start_date, end_date)[0]
+
+    def get_range_many(self, coordinates: list, start_date: str, end_date: str) -> list:
+        days = [str(day) for day in np.arange(np.datetime64(start_date), np.datetime64(end_date) + 1)]
+        results = []
+        for lat, lon in coordinates:
+            per_day = self.get_many([(lat, lon, day) for day in days])
+            results.append(None if any(hourly is None for hourly in per_day) else merge_days(per_day))
+        return results
+
+    def put_range_many(self, coordinates: list, hourly_per_location: list):
+        entries = []
+        for (lat, lon), hourly in zip(coordinates, hourly_per_location):
+            for day, day_hourly in split_days(hourly).items():
+                entries.append((lat, lon, day, day_hourly))
+        self.put_many(entries)
+
+    def size(self) -> int:
+        return self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM hourly").fetchone()[0]
+
+    def evict(self):
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        for resolution, ilat, ilon, day, size in self.connection.execute(
+            "SELECT resolution, ilat, ilon, day, size FROM hourly ORDER BY last_access"
+        ):
+            victims.append((resolution, ilat, ilon, day))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany(
+            "DELETE FROM hourly WHERE resolution = ? AND ilat = ? AND ilon = ? AND day = ?", victims
+        )
+        self.connection.commit()
+        self.evictions += len(victims)
+        instrumentation.count("weather_cache_evictions", len(victims))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "bytes": self.size(),
+        }
+
+
+# {"time": [...], "wind_speed_10m": [...], ...} of several days -> one such dict per "YYYY-MM-DD"
+def split_days(hourly: dict) -> dict:
+    times = hourly.get("time") or []
+    days = {}
+    for i, t in enumerate(times):
+        days.setdefault(t[:10], []).append(i)
+    return {
+        day: {variable: [values[i] for i in indices] for variable, values in hourly.items()
+              if isinstance(values, list) and len(values) == len(times)}
+        for day, indices in days.items()
+    }
+
+
+def merge_days(per_day: list) -> dict:
+    merged = {}
+    for hourly in per_day:
+        for variable, values in hourly.items():
+            merged.setdefault(variable, []).extend(values)
+    return merged
+
+
+_default_cache = None
+
+
+# One cache per process, shared by every fetcher that is not given its own
+def get_default_cache() -> WeatherCache:
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = WeatherCache()
+    return _default_cache
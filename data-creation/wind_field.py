@@ -0,0 +1,134 @@
+#The purpose of this file is to answer "what was the wind here at this time" for any batch of positions
+#from the hourly grid samples we fetched, instead of taking the nearest hour of one point per boat.
+#Samples live in flat NumPy arrays sorted by (grid node, hour), a query blends the 4 grid nodes around
+#the position and the 2 hours around the time (bilinear in space, linear in time).
+#Direction is blended through its u/v components so 350 and 10 degrees give 0 and not 180
+
+import numpy as np
+import pandas as pd
+
+HOUR = np.timedelta64(1, "h")
+
+
+def _wrap_ilon(ilon: np.ndarray, resolution: float) -> np.ndarray:
+    return np.mod(ilon, int(round(360 / resolution)))
+
+
+def node_coordinates(ilat: np.ndarray, ilon: np.ndarray, resolution: float) -> tuple:
+    lon = ilon * resolution
+    return ilat * resolution, np.where(lon >= 180, lon - 360, lon)
+
+
+class WindField:
+    """
+    Hourly wind samples on a regular lat/lon grid of `resolution` degrees.
+    """
+
+    def __init__(self, resolution: float = 0.25):
+        self.resolution = resolution
+        self.keys = np.empty(0, dtype="int64")
+        self.speed = np.empty(0)
+        self.u = np.empty(0)
+        self.v = np.empty(0)
+        self.gust = np.empty(0)
+
+    # Node and hour packed into one sortable int64, hours since the epoch take the low 24 bits
+    def _pack(self, ilat: np.ndarray, ilon: np.ndarray, hours: np.ndarray) -> np.ndarray:
+        n_lon = int(round(360 / self.resolution))
+        node = (ilat.astype("int64") + n_lon) * n_lon + _wrap_ilon(ilon, self.resolution).astype("int64")
+        return (node << 24) | hours.astype("int64")
+
+    # entries: (lat, lon, hourly) with hourly the Open-Meteo "hourly" dict of that grid node
+    @classmethod
+    def from_hourly(cls, entries: list, resolution: float = 0.25) -> "WindField":
+        field = cls(resolution)
+        keys, speed, direction, gust = [], [], [], []
+        for lat, lon, hourly in entries:
+            if not hourly or not hourly.get("time"):
+                continue
+            hours = (np.array(hourly["time"], dtype="datetime64[h]") - np.datetime64(0, "h")) // HOUR
+            ilat = np.full(len(hours), int(round(lat / resolution)))
+            ilon = np.full(len(hours), int(round(lon / resolution)))
+            keys.append(field._pack(ilat, ilon, hours))
+            speed.append(np.array(hourly.get("wind_speed_10m"), dtype="float64"))
+            direction.append(np.array(hourly.get("wind_direction_10m"), dtype="float64"))
+            gust.append(np.array(hourly.get("wind_gusts_10m"), dtype="float64"))
+
+        if not keys:
+            return field
+
+        keys = np.concatenate(keys)
+        keys, first = np.unique(keys, return_index=True)
+        speed = np.concatenate(speed)[first]
+        radians = np.deg2rad(np.concatenate(direction)[first])
+        field.keys = keys
+        field.speed = speed
+        # Meteorological convention, the direction the wind blows from
+        field.u = -speed * np.sin(radians)
+        field.v = -speed * np.cos(radians)
+        field.gust = np.concatenate(gust)[first]
+        return field
+
+    def _lookup(self, keys: np.ndarray) -> np.ndarray:
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1)
+        idx = np.clip(np.searchsorted(self.keys, keys), 0, len(self.keys) - 1)
+        return np.where(self.keys[idx] == keys, idx, -1)
+
+    # Vectorized space-time interpolation, returns (speed, direction, gust) arrays.
+    # Corners without a sample are left out and the remaining weights renormalized,
+    # a query with no sample around it at all comes back as NaN
+    def interpolate(self, times, lats, lons) -> tuple:
+        times = np.asarray(times, dtype="datetime64[ns]")
+        lats = np.asarray(lats, dtype="float64")
+        lons = np.asarray(lons, dtype="float64")
+
+        hours = (times - np.datetime64(0, "h")) / HOUR
+        h0 = np.floor(hours)
+        wt = hours - h0
+        y = lats / self.resolution
+        x = lons / self.resolution
+        y0 = np.floor(y)
+        x0 = np.floor(x)
+        wy = y - y0
+        wx = x - x0
+
+        totals = np.zeros((4, len(times)))
+        weight_sum = np.zeros(len(times))
+        for dh, w_time in ((0, 1 - wt), (1, wt)):
+            for dy, w_lat in ((0, 1 - wy), (1, wy)):
+                for dx, w_lon in ((0, 1 - wx), (1, wx)):
+                    idx = self._lookup(self._pack(y0 + dy, x0 + dx, h0 + dh))
+                    weight = w_time * w_lat * w_lon
+                    found = idx >= 0
+                    samples = np.stack([array[np.where(found, idx, 0)] for array in (self.speed, self.u, self.v, self.gust)])
+                    valid = found & ~np.isnan(samples).any(axis=0)
+                    weight = np.where(valid, weight, 0.0)
+                    totals += np.where(valid, samples, 0.0) * weight
+                    weight_sum += weight
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            speed, u, v, gust = totals / np.where(weight_sum > 0, weight_sum, np.nan)
+        direction = np.mod(np.round(np.rad2deg(np.arctan2(-u, -v)), 6), 360)
+        return speed, direction, gust
+
+
+# The grid nodes and hours every position needs for interpolate(), one row per (corner, hour),
+# in the shape combiner.plan_weather_batches expects
+def corner_queries(df: pd.DataFrame, resolution: float = 0.25) -> pd.DataFrame:
+    times = df["Time in France"].to_numpy(dtype="datetime64[ns]")
+    y0 = np.floor(df["Latitude"].to_numpy() / resolution).astype("int64")
+    x0 = np.floor(df["Longitude"].to_numpy() / resolution).astype("int64")
+    h0 = times.astype("datetime64[h]")
+
+    frames = []
+    for dh in (0, 1):
+        for dy in (0, 1):
+            for dx in (0, 1):
+                lat, lon = node_coordinates(y0 + dy, _wrap_ilon(x0 + dx, resolution), resolution)
+                frames.append(pd.DataFrame({
+                    "Time in France": (h0 + dh * HOUR).astype("datetime64[ns]"),
+                    "Latitude": lat,
+                    "Longitude": lon,
+                }))
+    return pd.concat(frames, ignore_index=True).drop_duplicates(ignore_index=True)
@@ -2,6 +2,250 @@
 #the parser.py file. Except this time instead of using pandas dataframes i used PySpark Dataframes,
 #possibly rdd or Spark SQL directly
 
-#For the purpose of making the project easier on the resources, the spark part of it (i.e. this) will be using its
-#own docker compose, as putting it with all the others in the main compose file and running it would probbably
-#make my macbook air cry
\ No newline at end of file
+#Workbooks are opened on the executors with parser.read_table (Spark has no .xlsx reader), every cell leaves
+#as a plain string and all the cleaning and type conversions of parser.parse_file are Spark SQL expressions.
+#The result is written like storage.write does, Parquet partitioned by race_day, so the next stages read it as usual.
+#Runs in local[*] unless SPARK_MASTER says otherwise. Needs Spark 3.5 or newer for timestamps without a time zone
+#(requirements.txt pins 4.0, which runs on Java 17 or 21) and executors with the same Python packages as the driver
+
+import glob
+import logging
+import os
+import sys
+
+DATA_CREATION_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data-creation")
+sys.path.insert(0, DATA_CREATION_DIR)
+
+import pandas as pd
+import pyarrow as pa
+from pyspark.sql import SparkSession, Window
+from pyspark.sql import functions as F
+from pyspark.sql import types as T
+
+import parser
+import schema
+import storage
+
+logger = logging.getLogger(__name__)
+
+SPARK_MASTER = os.environ.get("SPARK_MASTER", "local[*]")
+# Modules the executors need to open the workbooks (parser and what it imports) and the race definitions
+# races.py looks for next to itself
+SHIPPED_MODULES = ["parser.py", "storage.py", "manifest.py", "schema.py", "races.py", "instrumentation.py"]
+SHIPPED_FILES = ["races.json"]
+
+# Columns of parser.read_table that are carried over as text, in this order
+RAW_COLUMNS = [
+    "Ranking", "Sailor Nationality and Sail Number", "Sailor Name and Team Name", "Time in France",
+    "Latitude", "Longitude",
+    "Heading 30min", "Speed 30min", "VMG 30min", "Dist 30min",
+    "Heading Last Report", "Speed Last Report", "VMG Last Report", "Dist Last Report",
+    "Heading 24h", "Speed 24h", "VMG 24h", "Dist 24h",
+    "DTF", "DTL",
+]
+
+RAW_SCHEMA = T.StructType(
+    [T.StructField("file", T.StringType()), T.StructField("date_part", T.StringType()),
+     T.StructField("row", T.IntegerType())]
+    + [T.StructField(column, T.StringType()) for column in RAW_COLUMNS]
+)
+
+# Same patterns as parser._NUMBER and parser._INTEGER, (?U) gives \d and \s the same unicode meaning as in Python
+_NUMBER = r"(?U)^[+-]?(?:\d+\.?\d*|\.\d+)$"
+_INTEGER = r"(?U)^[+-]?\d+$"
+
+
+def create_session(app_name: str = "vendee-parser") -> SparkSession:
+    builder = SparkSession.builder.master(SPARK_MASTER).appName(app_name)
+    # The executors open the workbooks of the same race as the driver
+    if os.environ.get("RACE"):
+        builder = builder.config("spark.executorEnv.RACE", os.environ["RACE"])
+    spark = (
+        builder
+        # Bad cells turn into NULL like they turn into NaN in pandas instead of failing the job
+        .config("spark.sql.ansi.enabled", "false")
+        # Times are wall clock times in France, kept as they are
+        .config("spark.sql.session.timeZone", "UTC")
+        .getOrCreate()
+    )
+    for module in SHIPPED_MODULES:
+        spark.sparkContext.addPyFile(os.path.join(DATA_CREATION_DIR, module))
+    for file in SHIPPED_FILES:
+        spark.sparkContext.addFile(os.path.join(DATA_CREATION_DIR, file))
+    # Imported from main.py (PARSE_BACKEND=spark) _extract_rows is pickled as sparky._extract_rows
+    spark.sparkContext.addPyFile(os.path.abspath(__file__))
+    return spark
+
+
+# Runs on the executors: one workbook -> its table rows as strings. Like parser._as_text only strings count as
+# cells, except for the ranking which parse_file reads with astype(int) whatever its type
+def _extract_rows(path: str):
+    import parser
+
+    df, date_part = parser.read_table(path)
+    df = df.reindex(columns=RAW_COLUMNS)
+    file = os.path.basename(path)
+    for i, values in enumerate(df.itertuples(index=False, name=None)):
+        ranking = values[0]
+        ranking = None if not isinstance(ranking, str) and pd.isna(ranking) else str(ranking)
+        cells = [value if isinstance(value, str) else None for value in values[1:]]
+        yield (file, str(date_part), i, ranking, *cells)
+
+
+def _strip(column):
+    return F.regexp_replace(column, r"(?U)^\s+|\s+$", "")
+
+
+# parser._to_float: only text that looks like a number is converted
+def _to_number(column, pattern: str = _NUMBER, data_type: str = "double"):
+    text = _strip(column)
+    return F.when(text.rlike(pattern), text.cast(data_type))
+
+
+def _drop_last(column, n: int):
+    return F.expr(f"substring(`{column}`, 1, greatest(length(`{column}`) - {n}, 0))")
+
+
+def _clean_cell(column):
+    return _strip(F.regexp_replace(column, "\r\n", " "))
+
+
+def _coordinates(column):
+    pattern = r"^([^°]*)°([^°]*)[^°]([^°])$"
+    matched = column.rlike(pattern)
+    degrees = _to_number(F.regexp_extract(column, pattern, 1))
+    minutes = _to_number(F.regexp_extract(column, pattern, 2))
+    direction = F.regexp_extract(column, pattern, 3)
+    sign = F.when(direction.isin("S", "W"), F.lit(-1.0)).otherwise(F.lit(1.0))
+    return F.when(matched, (degrees + minutes / 60) * sign)
+
+
+def _sailor_and_team(column):
+    pattern = r"(?sU)^\s*(\S+)(?:\s+(\S+))?(.*)$"
+    matched = column.rlike(pattern)
+    sailor = _strip(F.concat_ws(" ", F.regexp_extract(column, pattern, 1), F.regexp_extract(column, pattern, 2)))
+    team = _strip(F.regexp_extract(column, pattern, 3))
+    return F.when(matched, sailor), F.when(matched, team)
+
+
+def _nation_and_sail(column):
+    nation_pattern = r"(?U)^\s*(\S+)"
+    sail_pattern = r"(?U)(?:(\S+)\s+)?(\S+)\s*$"
+    nation = F.when(column.rlike(nation_pattern), F.regexp_extract(column, nation_pattern, 1))
+    sail = _strip(F.concat_ws(" ", F.regexp_extract(column, sail_pattern, 1), F.regexp_extract(column, sail_pattern, 2)))
+    return nation, F.when(column.rlike(sail_pattern), sail)
+
+
+def _time_in_france(column, date_part):
+    hours = F.regexp_extract(column, r"(?U)^\s*(\S+)", 1)
+    return F.when(hours != "", F.to_timestamp_ntz(F.concat_ws(" ", date_part, hours), F.lit("yyyy-MM-dd H:m")))
+
+
+def transform(raw):
+    cleaned = raw.select(
+        "file", "date_part", "row",
+        *[_clean_cell(F.col(f"`{column}`")).alias(column) for column in RAW_COLUMNS],
+    )
+    #Get rid of RET,DNF or ARV Sailors (or whatever statuses the race uses)
+    cleaned = cleaned.where(~F.coalesce(F.col("Ranking"), F.lit("nan")).isin(*parser.DROPPED_STATUS))
+
+    sailor, team = _sailor_and_team(F.col("`Sailor Name and Team Name`"))
+    nation, sail = _nation_and_sail(F.col("`Sailor Nationality and Sail Number`"))
+    columns = {
+        "Ranking": F.col("Ranking").cast("bigint"),
+        # Replacing, respect for the legend
+        "Sailor": F.when(sailor == "Jean Le", F.lit("Jean Le Cam")).otherwise(sailor),
+        "Nation": nation,
+        "Team": team,
+        "Sail": sail,
+        "Latitude": _coordinates(F.col("Latitude")),
+        "Longitude": _coordinates(F.col("Longitude")),
+        "Time in France": _time_in_france(F.col("`Time in France`"), F.col("date_part")),
+    }
+    for column in ["Heading 30min", "Heading Last Report", "Heading 24h"]:
+        columns[column] = _to_number(_drop_last(column, 1), _INTEGER, "bigint")
+    for column in ["Speed 30min", "Speed Last Report", "Speed 24h", "VMG 30min", "VMG Last Report", "VMG 24h"]:
+        columns[column] = _to_number(_drop_last(column, 3))
+    for column in ["Dist 30min", "Dist Last Report", "Dist 24h", "DTF", "DTL"]:
+        columns[column] = _to_number(_drop_last(column, 2))
+
+    parsed = cleaned.select("file", "row", *[expression.alias(name) for name, expression in columns.items()])
+    return parsed.select("file", "row", *storage.SCHEMAS["total"].names)
+
+
+def parse_files(spark: SparkSession, paths: list):
+    slices = max(1, min(len(paths), spark.sparkContext.defaultParallelism * 4))
+    rows = spark.sparkContext.parallelize(paths, slices).flatMap(_extract_rows)
+    return transform(spark.createDataFrame(rows, RAW_SCHEMA))
+
+
+def parse_directory(files_dir: str = parser.FILES_DIR, output_dir: str = storage.OUTPUT_DIR, spark: SparkSession = None):
+    paths = sorted(glob.glob(os.path.join(files_dir, "*.xlsx")))
+    if not paths:
+        logger.warning("No files found in directory")
+        return
+
+    spark = spark or create_session()
+    df = parse_files(spark, paths)
+    df = df.withColumn(storage.PARTITION_COLUMN, F.date_format(F.col("`Time in France`"), "yyyy-MM-dd"))
+    # Within a day the rows keep file order like the pandas backend
+    df = df.repartition(storage.PARTITION_COLUMN).sortWithinPartitions("file", "row").drop("file", "row")
+
+    path = storage.dataset_path("total", output_dir)
+    df.write.mode("overwrite").partitionBy(storage.PARTITION_COLUMN).parquet(path)
+    # The pandas backend's manifest describes a total dataset that was just replaced
+    manifest_path = os.path.join(output_dir, os.path.basename(parser.MANIFEST_PATH))
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+    logger.info(f"Saved {len(paths)} parsed files to {path}")
+
+
+# Row for row comparison with parser.parse_file, returns the number of rows that differ
+def compare_with_pandas(files_dir: str = parser.FILES_DIR, spark: SparkSession = None) -> int:
+    paths = sorted(glob.glob(os.path.join(files_dir, "*.xlsx")))
+    spark = spark or create_session()
+
+    frames = []
+    for path in paths:
+        frame = parser.parse_file(path)
+        frame.insert(0, "file", os.path.basename(path))
+        frame.insert(1, "row", range(len(frame)))
+        frames.append(frame)
+    expected = pd.concat(frames, ignore_index=True)
+    # In the dtypes of the pandas parser, so float32 measures compare equal
+    actual = schema.apply(parse_files(spark, paths).toPandas())
+
+    keys = ["file", "row"]
+    expected = expected.sort_values(keys).reset_index(drop=True)
+    # Spark renumbers after dropping RET/DNF/ARV rows differently, compare the n-th kept row of every file
+    actual = actual.sort_values(keys).reset_index(drop=True)
+    actual["row"] = actual.groupby("file").cumcount()
+    expected["row"] = expected.groupby("file").cumcount()
+
+    if len(expected) != len(actual):
+        logger.error(f"pandas parsed {len(expected)} rows, Spark {len(actual)}")
+        return abs(len(expected) - len(actual))
+
+    different = pd.Series(False, index=expected.index)
+    for field in storage.SCHEMAS["total"]:
+        column = field.name
+        if pa.types.is_timestamp(field.type):
+            left, right = pd.to_datetime(expected[column]), pd.to_datetime(actual[column])
+        elif pa.types.is_string(field.type):
+            left, right = expected[column].astype("object"), actual[column].astype("object")
+        else:
+            left, right = expected[column].astype("float64"), actual[column].astype("float64")
+        missing = left.isna() & right.isna()
+        same = missing | (left.where(~missing, "") == right.where(~missing, "")).fillna(False)
+        if not same.all():
+            logger.error(f"{int((~same).sum())} row(s) differ in '{column}'")
+        different |= ~same
+    logger.info(f"Compared {len(expected)} rows of {len(paths)} files, {int(different.sum())} differ")
+    return int(different.sum())
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) > 1 and sys.argv[1] == "--compare":
+        sys.exit(1 if compare_with_pandas() else 0)
+    parse_directory()
@@ -0,0 +1,61 @@
+#The purpose of this file is to let the tests import the data-creation modules like main.py does.
+#The modules read DATA_DIR, DB_URL and the API URLs once at import, so they are pointed at a throwaway
+#directory here before any test imports them. Nothing a test does reaches the network or the real data
+
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+DATA_CREATION_DIR = os.path.join(ROOT_DIR, "data-creation")
+SAMPLES_DIR = os.path.join(ROOT_DIR, "data_samples")
+# Timestamp -> sample workbook, one of every sheet layout (racing table at the top, below the finishers)
+SAMPLE_FILES = {
+    "20241110_220000": os.path.join(SAMPLES_DIR, "start_format_leaderboard_20241110_220000.xlsx"),
+    "20250214_060000": os.path.join(SAMPLES_DIR, "finishers_format_leaderboard_20250214_060000.xlsx"),
+}
+
+DATA_DIR = tempfile.mkdtemp(prefix="vendee-tests-")
+os.environ["DATA_DIR"] = DATA_DIR
+os.environ["WEATHER_CACHE"] = os.path.join(DATA_DIR, "weather_cache.sqlite")
+os.environ["DB_URL"] = f"sqlite:///{os.path.join(DATA_DIR, 'vendee.sqlite')}"
+# Unreachable until a test starts a stub and points the module at it
+os.environ["ARCHIVE_API_URL"] = "http://127.0.0.1:9/archive"
+os.environ["FORECAST_API_URL"] = "http://127.0.0.1:9/forecast"
+os.environ["LEADERBOARD_URL"] = "http://127.0.0.1:9/leaderboard_YYYYMMDD_HHMMSS.xlsx"
+for name in ["RACE", "RACES_PATH", "LOAD_LOCK", "REPORT_DIR", "PROFILE", "PARTITION_FACTS", "EXPORT_CSV"]:
+    os.environ.pop(name, None)
+sys.path.insert(0, DATA_CREATION_DIR)
+sys.path.insert(0, TESTS_DIR)
+
+
+# Every test starts from an empty DATA_DIR, the paths the modules computed at import stay valid
+@pytest.fixture(autouse=True)
+def data_dir():
+    for entry in os.listdir(DATA_DIR):
+        path = os.path.join(DATA_DIR, entry)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    for name in ["files", "output", "wind", "chunks"]:
+        os.makedirs(os.path.join(DATA_DIR, name), exist_ok=True)
+    yield DATA_DIR
+
+
+# The sample workbooks in the files directory under the names the scraper gives them. Returns their paths
+@pytest.fixture
+def leaderboards(data_dir):
+    paths = []
+    for timestamp, sample in SAMPLE_FILES.items():
+        paths.append(os.path.join(data_dir, "files", f"leaderboard_{timestamp}.xlsx"))
+        shutil.copyfile(sample, paths[-1])
+    return paths
+
+
+def pytest_sessionfinish(session, exitstatus):
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
@@ -0,0 +1,154 @@
+#The purpose of this file is to stand in for the two sites the pipeline talks to, on 127.0.0.1 in a thread:
+#the Open-Meteo archive (deterministic wind for every grid cell and hour) and the leaderboard site (a workbook,
+#a 404 or a 503 per timestamp). Both count the requests they get so the tests can check how many were made
+
+import json
+import re
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# The reanalysis grid of the archive, every position inside a cell gets the same answer
+GRID = 0.25
+
+
+class StubServer:
+    """
+    A ThreadingHTTPServer on a free port, started and stopped as a context manager. `handler` is a
+    BaseHTTPRequestHandler class, it reaches the server's state through self.server.stub
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def __enter__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler)
+        self.server.stub = self
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record(self, path: str):
+        with self.lock:
+            self.requests.append(path)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status: int, body: bytes = b"", content_type: str = "application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+# The wind of a grid cell at an hour, in km/h and degrees like the archive
+def archive_wind(lat: float, lon: float, hour: datetime) -> tuple:
+    i, j = round(lat / GRID), round(lon / GRID)
+    hours = int((hour - datetime(2024, 1, 1)).total_seconds() // 3600)
+    speed = ((i * 31 + j * 17 + hours * 7) % 400) / 10
+    direction = float((i * 13 + j * 7 + hours * 11) % 360)
+    return speed, direction, round(speed * 1.3, 1)
+
+
+def archive_hourly(lat: float, lon: float, start_date: str, end_date: str) -> dict:
+    hour = datetime.fromisoformat(start_date)
+    end = datetime.fromisoformat(end_date) + timedelta(days=1)
+    hourly = {"time": [], "wind_speed_10m": [], "wind_direction_10m": [], "wind_gusts_10m": []}
+    while hour < end:
+        speed, direction, gust = archive_wind(lat, lon, hour)
+        hourly["time"].append(hour.strftime("%Y-%m-%dT%H:%M"))
+        hourly["wind_speed_10m"].append(speed)
+        hourly["wind_direction_10m"].append(direction)
+        hourly["wind_gusts_10m"].append(gust)
+        hour += timedelta(hours=1)
+    return hourly
+
+
+class ArchiveHandler(_Handler):
+    """
+    GET ?latitude=a,b&longitude=c,d&start_date=...&end_date=... like the archive API: a list of one result
+    per location, a single object when one location is asked for. The first `stub.fail_first` requests
+    get a `stub.fail_status` (503 by default)
+    """
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.record(self.path)
+        with stub.lock:
+            failing = len(stub.requests) <= getattr(stub, "fail_first", 0)
+        if failing:
+            self.send(getattr(stub, "fail_status", 503), b'{"error": true, "reason": "stub failure"}')
+            return
+        query = parse_qs(urlparse(self.path).query)
+        try:
+            latitudes = [float(value) for value in query["latitude"][0].split(",")]
+            longitudes = [float(value) for value in query["longitude"][0].split(",")]
+            start_date, end_date = query["start_date"][0], query["end_date"][0]
+        except (KeyError, ValueError):
+            self.send(400, b'{"error": true, "reason": "bad parameters"}')
+            return
+        results = [{"latitude": lat, "longitude": lon, "hourly": archive_hourly(lat, lon, start_date, end_date)}
+                   for lat, lon in zip(latitudes, longitudes)]
+        self.send(200, json.dumps(results[0] if len(results) == 1 else results).encode())
+
+
+def archive_server(fail_first: int = 0, fail_status: int = 503) -> StubServer:
+    server = StubServer(ArchiveHandler)
+    server.fail_first = fail_first
+    server.fail_status = fail_status
+    return server
+
+
+class LeaderboardHandler(_Handler):
+    """
+    GET .../<anything>_YYYYMMDD_HHMMSS.xlsx. `stub.statuses` maps a timestamp to a list of statuses, one per
+    request for it (the last one repeats), missing timestamps are 404. A 200 sends `stub.workbook`
+    """
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.record(self.path)
+        match = re.search(r"_(\d{8}_\d{6})\.xlsx$", urlparse(self.path).path)
+        if match is None:
+            self.send(404)
+            return
+        with stub.lock:
+            statuses = stub.statuses.get(match.group(1), [404])
+            status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        if status == 200:
+            self.send(200, stub.workbook, "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+        else:
+            self.send(status)
+
+
+def leaderboard_server(statuses: dict, workbook: bytes) -> StubServer:
+    server = StubServer(LeaderboardHandler)
+    server.statuses = {timestamp: list(codes) for timestamp, codes in statuses.items()}
+    server.workbook = workbook
+    return server
+
+
+# The timestamps the leaderboard stub was asked for, in request order
+def requested_timestamps(server: StubServer) -> list:
+    return [match.group(1) for match in (re.search(r"_(\d{8}_\d{6})\.xlsx$", path) for path in server.requests)
+            if match]
@@ -0,0 +1,34 @@
+#Run reports: the peak RSS of a stage is its own, not the high water mark of the process so far
+
+import json
+import os
+import time
+
+import numpy as np
+import pytest
+
+import instrumentation
+
+pytestmark = pytest.mark.skipif(not os.path.exists("/proc/self/statm"), reason="RSS is read from /proc")
+
+
+def _records(report_path: str) -> dict:
+    with open(report_path, "r", encoding="utf-8") as f:
+        return {record["stage"]: record for record in map(json.loads, f) if record["type"] != "start"}
+
+
+def test_peak_rss_is_per_stage(tmp_path):
+    with instrumentation.run("check", report_dir=str(tmp_path)) as run:
+        with instrumentation.stage("big"):
+            block = np.ones(256 * 2**20 // 8)
+            # Long enough for the sampler, in case the process was already bigger before
+            time.sleep(5 * instrumentation.RSS_INTERVAL)
+            del block
+        with instrumentation.stage("after"):
+            pass
+    records = _records(run.report_path)
+
+    big, after = records["check/big"], records["check/after"]
+    assert big["peak_rss_mb"] - after["peak_rss_mb"] > 200
+    assert after["process_peak_rss_mb"] >= big["peak_rss_mb"] - 1
+    assert records["check"]["peak_rss_mb"] >= big["peak_rss_mb"]
@@ -0,0 +1,37 @@
+#The distance sailed over the last 24h: only the part of a leg that falls inside the window counts
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+
+def _reports(hours: list) -> pd.DataFrame:
+    # One boat sailing east along the equator, one degree of longitude between two reports
+    n = len(hours)
+    return pd.DataFrame({
+        "Sailor": ["Charlie Dalin"] * n,
+        "Time in France": pd.Timestamp("2024-11-10") + pd.to_timedelta(hours, unit="h"),
+        "Ranking": np.ones(n),
+        "Latitude": np.zeros(n),
+        "Longitude": np.arange(n, dtype="float64"),
+        "Heading 30min": np.full(n, 90.0),
+        "Speed 30min": np.full(n, 10.0),
+        "Wind Speed": np.full(n, 15.0),
+        "Wind Direction": np.zeros(n),
+    })
+
+
+def test_distance_24h_clips_the_leg_that_starts_before_the_window():
+    result = metrics.compute(_reports([0, 10, 20, 30]))
+    leg = metrics.haversine_nm(0.0, 0.0, 0.0, 1.0)
+
+    # The window of the last report starts at 6h, 4 of the 10 hours of the leg from 0h to 10h are inside it
+    np.testing.assert_allclose(result["Distance Sailed 24h"], [0, leg, 2 * leg, 0.4 * leg + 2 * leg])
+
+
+def test_distance_24h_counts_a_leg_from_the_window_start_whole():
+    # The window of the last report starts at the report of 6h, the leg before it is left out
+    result = metrics.compute(_reports([0, 6, 30]))
+    leg = metrics.haversine_nm(0.0, 0.0, 0.0, 1.0)
+    np.testing.assert_allclose(result["Distance Sailed 24h"], [0, leg, leg])
@@ -0,0 +1,34 @@
+#What parse_file counts as a parse error: a cell that had a value and could not be parsed, not a blank one
+
+import pytest
+
+import parser
+from conftest import SAMPLE_FILES
+
+
+@pytest.fixture
+def table(leaderboards, monkeypatch):
+    # The racing table of the start sample, edited before parse_file parses it
+    df, date_part = parser.read_table(leaderboards[0])
+    monkeypatch.setattr(parser, "read_table", lambda filename: (df.copy(), date_part))
+    return df
+
+
+def test_blank_cells_are_not_parse_errors(table):
+    table.iloc[0, table.columns.get_loc("Latitude")] = None
+    table.iloc[1, table.columns.get_loc("Speed 30min")] = "   "
+    table.iloc[2, table.columns.get_loc("Time in France")] = None
+
+    df = parser.parse_file(SAMPLE_FILES["20241110_220000"])
+    assert df["Latitude"].isna().sum() == 1
+    assert df.attrs["parse_errors"] == 0
+
+
+def test_cells_that_do_not_parse_are_parse_errors(table):
+    table.iloc[0, table.columns.get_loc("Latitude")] = "north"
+    table.iloc[1, table.columns.get_loc("Speed 30min")] = "fast kts"
+    table.iloc[2, table.columns.get_loc("Time in France")] = "noon"
+    table.iloc[3, table.columns.get_loc("Longitude")] = None
+
+    df = parser.parse_file(SAMPLE_FILES["20241110_220000"])
+    assert df.attrs["parse_errors"] == 3
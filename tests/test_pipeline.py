@@ -0,0 +1,56 @@
+#The streaming pipeline against the archive stub: the weather stage enriches its batches on several workers and
+#the dataset and the database end up with the same rows as enriching everything at once, and the files are
+#recorded in the manifest like parse_directory records them
+
+import os
+import shutil
+
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, func, select
+
+import combiner
+import parser
+import pipeline
+import saver
+import schema
+import storage
+import stubs
+from conftest import SAMPLE_FILES
+from manifest import load_manifest
+
+
+@pytest.fixture
+def archive(monkeypatch):
+    with stubs.archive_server() as server:
+        monkeypatch.setattr(combiner, "ARCHIVE_API_URL", f"{server.url}/v1/archive")
+        yield server
+
+
+def test_pipeline_enriches_batches_on_workers(archive, leaderboards):
+    # One batch per leaderboard, more workers than batches
+    pipeline.run(max_workers=2, batch_rows=1, download=False, weather_workers=3)
+
+    total = pd.concat([parser.parse_file(path) for path in leaderboards], ignore_index=True)
+    expected = combiner.enrich_rows(total, api_url=combiner.ARCHIVE_API_URL).dropna(subset=combiner.WIND_COLUMNS)
+    key = ["Time in France", "Sailor"]
+    expected = schema.validate(expected, "dataset").sort_values(key).reset_index(drop=True)
+    actual = storage.read("dataset").sort_values(key).reset_index(drop=True)
+    pd.testing.assert_frame_equal(actual, expected)
+
+    with create_engine(saver.DB_URL).connect() as connection:
+        assert connection.execute(select(func.count()).select_from(saver.FactRace)).scalar() == len(expected)
+
+
+def test_pipeline_manifest_matches_parse_directory(archive, leaderboards, data_dir):
+    # A snapshot republished under a later timestamp is a duplicate for both
+    copy = os.path.join(data_dir, "files", "leaderboard_20241111_020000.xlsx")
+    shutil.copyfile(SAMPLE_FILES["20241110_220000"], copy)
+    pipeline.run(max_workers=2, download=False, load_database=False)
+    streamed = load_manifest(parser.MANIFEST_PATH)
+
+    shutil.rmtree(parser.OUTPUT_DIR)
+    os.makedirs(parser.OUTPUT_DIR)
+    parser.parse_directory(max_workers=1)
+    assert load_manifest(parser.MANIFEST_PATH) == streamed
+    assert streamed["leaderboard_20241111_020000.xlsx"]["duplicate_of"] == "leaderboard_20241110_220000.xlsx"
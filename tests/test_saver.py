@@ -0,0 +1,179 @@
+#The bulk loader against the row by row ORM loader it replaced, both on SQLite: the same frame has to give the
+#same dimensions, facts and key mappings, and loading it in two goes the same as in one
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, func, select, text
+from sqlalchemy.dialects.postgresql import pg8000
+
+import parser
+import races
+import saver
+import storage
+from conftest import SAMPLE_FILES
+
+TABLES = [saver.Race, saver.Sailor, saver.Time, saver.Position, saver.Performance, saver.Conditions, saver.FactRace]
+
+
+@pytest.fixture
+def dataset(leaderboards, data_dir):
+    # A second snapshot of the start with the same rows, the loaders have to skip what they already have
+    copy = os.path.join(data_dir, "files", "leaderboard_20241110_230000.xlsx")
+    shutil.copyfile(SAMPLE_FILES["20241110_220000"], copy)
+    df = pd.concat([parser.parse_file(path) for path in sorted(leaderboards + [copy])], ignore_index=True)
+    # Wind that repeats between boats, so the conditions dimension is shared like in a real race
+    df["Wind Speed"] = (np.floor(df["Latitude"]) % 7) * 3.5
+    df["Wind Direction"] = (np.floor(df["Longitude"]) % 4) * 90.0
+    df["Wind Gust"] = df["Wind Speed"] * 1.3
+    return df
+
+
+def _engine(tmp_path, name: str):
+    engine = create_engine(f"sqlite:///{tmp_path / name}.sqlite")
+    saver.create_schema(engine)
+    return engine
+
+
+def _bulk_load(engine, df: pd.DataFrame, upsert: bool = False):
+    with engine.connect() as connection:
+        saver.bulk_load(connection, df, upsert=upsert)
+
+
+def _orm_load(engine, df: pd.DataFrame, monkeypatch):
+    storage.write(df, "dataset")
+    monkeypatch.setattr(saver, "DB_URL", engine.url.render_as_string(hide_password=False))
+    saver.save_to_postgres(bulk=False)
+
+
+def _counts(engine) -> dict:
+    with engine.connect() as connection:
+        return {model.__tablename__: connection.execute(select(func.count()).select_from(model)).scalar()
+                for model in TABLES}
+
+
+# Every fact with its dimensions looked up, i.e. what the surrogate keys point to whatever their values
+def _facts(engine) -> pd.DataFrame:
+    dimensions = [saver.Race, saver.Sailor, saver.Time, saver.Position, saver.Performance, saver.Conditions]
+    columns = [column for model in dimensions for column in model.__table__.columns if column.name != "id"]
+    query = (
+        select(saver.FactRace.ranking, saver.FactRace.race_day, *columns)
+        .select_from(saver.FactRace)
+        .join(saver.Race, saver.FactRace.race_id == saver.Race.id)
+        .join(saver.Sailor, saver.FactRace.sailor_id == saver.Sailor.id)
+        .join(saver.Time, saver.FactRace.time_id == saver.Time.id)
+        .join(saver.Position, saver.FactRace.position_id == saver.Position.id)
+        .join(saver.Performance, saver.FactRace.performance_id == saver.Performance.id)
+        .join(saver.Conditions, saver.FactRace.conditions_id == saver.Conditions.id)
+    )
+    with engine.connect() as connection:
+        rows = connection.execute(query).all()
+    names = ["ranking", "race_day"] + [f"{column.table.name}.{column.name}" for column in columns]
+    facts = pd.DataFrame(rows, columns=names)
+    return facts.sort_values(["sailors.name", "times.timestamp"]).reset_index(drop=True)
+
+
+def _assert_same_load(expected, actual):
+    assert _counts(actual) == _counts(expected)
+    pd.testing.assert_frame_equal(_facts(actual), _facts(expected))
+
+
+def test_bulk_load_matches_orm_load(dataset, tmp_path, monkeypatch):
+    bulk = _engine(tmp_path, "bulk")
+    _bulk_load(bulk, dataset)
+    orm = _engine(tmp_path, "orm")
+    _orm_load(orm, dataset, monkeypatch)
+
+    counts = _counts(bulk)
+    # Two snapshots of the start share every row, the facts are the rows of the two different leaderboards
+    assert counts["fact_race"] == len(dataset.drop_duplicates()) == 46
+    assert counts["sailors"] == dataset["Sailor"].nunique()
+    _assert_same_load(orm, bulk)
+
+
+def test_half_then_full_load_matches_full_load(dataset, tmp_path):
+    full = _engine(tmp_path, "full")
+    _bulk_load(full, dataset)
+    half = dataset.iloc[:len(dataset) // 2]
+
+    # Plain bulk loads skip the facts they already have
+    bulk = _engine(tmp_path, "bulk_twice")
+    _bulk_load(bulk, half)
+    _bulk_load(bulk, dataset)
+    _assert_same_load(full, bulk)
+
+    # Delta loads upsert the second half on the natural keys
+    delta = _engine(tmp_path, "delta")
+    _bulk_load(delta, half)
+    _bulk_load(delta, dataset, upsert=True)
+    _assert_same_load(full, delta)
+
+
+def test_delta_load_from_the_dataset_matches_full_load(dataset, tmp_path, monkeypatch):
+    full = _engine(tmp_path, "full")
+    _bulk_load(full, dataset)
+
+    # save_to_postgres loads the first half in bulk, then only the rows newer than every sailor's watermark
+    engine = _engine(tmp_path, "delta")
+    monkeypatch.setattr(saver, "DB_URL", engine.url.render_as_string(hide_password=False))
+    first_day = dataset["Time in France"].min().normalize() + pd.Timedelta(days=1)
+    storage.write(dataset[dataset["Time in France"] < first_day], "dataset")
+    saver.save_to_postgres()
+    assert _counts(engine)["fact_race"] < _counts(full)["fact_race"]
+    storage.write(dataset, "dataset")
+    saver.save_to_postgres()
+    _assert_same_load(full, engine)
+
+
+@pytest.mark.parametrize("statement", [saver.ROLLUP_SAILOR_DAILY, saver.ROLLUP_WIND_BINS], ids=["daily", "wind_bins"])
+def test_rollups_group_by_without_parameters_on_postgres(statement):
+    # pg8000 binds every parameter on its own, an expression with one in GROUP BY never matches the SELECT
+    compiled = str(text(statement).compile(dialect=pg8000.dialect()))
+    assert "%s" not in compiled[compiled.rindex("GROUP BY"):]
+
+
+def test_wind_bins_rollup(dataset, tmp_path):
+    engine = _engine(tmp_path, "rollups")
+    _bulk_load(engine, dataset)
+    with engine.connect() as connection:
+        race_id = saver.resolve_race(connection)
+        saver.refresh_rollups(connection, dataset["Time in France"].min().date(), race_id)
+        bins = pd.DataFrame(connection.execute(select(saver.WindBin)).mappings().all())
+
+    facts = _facts(engine)
+    expected = (facts["conditions.wind_speed"] // saver.WIND_BIN_WIDTH * saver.WIND_BIN_WIDTH).astype(int)
+    assert bins["reports"].sum() == len(facts)
+    assert sorted(bins["wind_bin"].unique()) == sorted(expected.unique())
+
+
+def test_rollups_refresh_one_race(dataset, tmp_path, monkeypatch):
+    engine = _engine(tmp_path, "races")
+    first_day = dataset["Time in France"].min().date()
+    other = races.Race("other-race", "Other race", "https://example.com/leaderboard_YYYYMMDD_HHMMSS.xlsx",
+                       "20241110_000000", "20241231_000000")
+    _bulk_load(engine, dataset)
+    with engine.connect() as connection:
+        race_id = saver.resolve_race(connection)
+        saver.refresh_rollups(connection, first_day, race_id)
+    # The same boats a month later in another race sharing the database
+    later = dataset.iloc[:len(dataset) // 2].copy()
+    later["Time in France"] += pd.Timedelta(days=30)
+    monkeypatch.setattr(races, "current", lambda: other)
+    _bulk_load(engine, later)
+
+    def rollups(connection, model):
+        return sorted(tuple(row) for row in connection.execute(select(model)).all())
+
+    with engine.connect() as connection:
+        before = {model: rollups(connection, model) for model in (saver.SailorDaily, saver.WindBin)}
+        other_id = saver.resolve_race(connection, other)
+        saver.refresh_rollups(connection, first_day, other_id)
+        facts = connection.execute(select(func.count()).where(saver.FactRace.race_id == other_id)).scalar()
+        for model in (saver.SailorDaily, saver.WindBin):
+            rows = rollups(connection, model)
+            # The first race is left as it was, the second one only has its own facts
+            assert [row for row in rows if row[0] == race_id] == before[model]
+            assert sum(row[3] for row in rows if row[0] == other_id) == facts > 0
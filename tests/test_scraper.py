@@ -0,0 +1,86 @@
+#Downloads against the leaderboard stub: what is saved, what is remembered as missing in .missing.json and
+#what a rerun asks for again
+
+import json
+import os
+import random
+
+import pytest
+
+import scraper
+import stubs
+from conftest import SAMPLE_FILES
+
+START = "20241110_100000"
+END = "20241114_100000"
+
+
+@pytest.fixture
+def site(monkeypatch):
+    # Every timestamp of the window gets a 200, a 404 or a 503 that works on the next try, the same ones every run
+    draw = random.Random(14)
+    statuses = {ts: draw.choice([[200], [404], [503, 200]])
+                for ts in scraper.generate_timestamps(START, END, scraper.step_hours)}
+    with open(SAMPLE_FILES["20241110_220000"], "rb") as f:
+        workbook = f.read()
+    with stubs.leaderboard_server(statuses, workbook) as server:
+        monkeypatch.setattr(scraper, "leaderboard_link", f"{server.url}/ranking/leaderboard_YYYYMMDD_HHMMSS.xlsx")
+        monkeypatch.setattr(scraper, "start_date", START)
+        monkeypatch.setattr(scraper, "end_date", END)
+        server.expected = {status: {ts for ts, codes in statuses.items() if codes[0] == status}
+                           for status in (200, 404, 503)}
+        yield server
+
+
+def _saved() -> set:
+    return {name[len("leaderboard_"):-len(".xlsx")] for name in os.listdir(scraper.FILES_DIR) if name.endswith(".xlsx")}
+
+
+def _missing() -> dict:
+    with open(scraper.MISSING_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def test_download_and_rerun(site):
+    assert all(site.expected.values())
+    scraper.download(max_workers=4)
+
+    requested = stubs.requested_timestamps(site)
+    assert sorted(requested) == sorted(set(requested))
+    assert _saved() == site.expected[200]
+    assert set(_missing()) == site.expected[404]
+
+    # Known missing and saved leaderboards are not asked for again, the ones that failed are
+    site.requests.clear()
+    scraper.download(max_workers=4)
+    assert set(stubs.requested_timestamps(site)) == site.expected[503]
+    assert _saved() == site.expected[200] | site.expected[503]
+    assert set(_missing()) == site.expected[404]
+
+
+def test_missing_is_saved_while_downloading(site, monkeypatch):
+    saves = []
+    save_manifest = scraper.save_manifest
+    monkeypatch.setattr(scraper, "MISSING_SAVE_EVERY", 2)
+    monkeypatch.setattr(scraper, "save_manifest", lambda manifest, path: (saves.append(len(manifest)),
+                                                                          save_manifest(manifest, path)))
+    scraper.download(max_workers=4)
+
+    # One save every two new missing leaderboards and one at the end
+    assert len(saves) == len(site.expected[404]) // 2 + 1
+    assert saves[-1] == len(site.expected[404])
+
+
+def test_missing_is_saved_when_interrupted(site):
+    # One download at a time, in timestamp order. The run stops at the last leaderboard that exists
+    last = max(site.expected[200])
+
+    def interrupt(file):
+        if file == f"leaderboard_{last}.xlsx":
+            raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        scraper.download(max_workers=1, on_file=interrupt)
+
+    # What was learned before the interruption is kept
+    assert set(_missing()) == {ts for ts in site.expected[404] if ts < last}
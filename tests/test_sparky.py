@@ -0,0 +1,45 @@
+#The Spark backend against the pandas parser on the sample leaderboards. Skipped without pyspark and Java
+
+import os
+import shutil
+import sys
+
+import pandas as pd
+import pytest
+
+import parser
+import schema
+import storage
+from conftest import ROOT_DIR
+
+pytest.importorskip("pyspark")
+if not (os.environ.get("JAVA_HOME") or shutil.which("java")):
+    pytest.skip("Spark needs Java", allow_module_level=True)
+
+sys.path.insert(0, os.path.join(ROOT_DIR, "spark"))
+import sparky  # noqa: E402
+
+
+@pytest.fixture(scope="module")
+def spark():
+    session = sparky.create_session("vendee-tests")
+    yield session
+    session.stop()
+
+
+def test_spark_rows_match_pandas(spark, leaderboards):
+    assert sparky.compare_with_pandas(os.path.dirname(leaderboards[0]), spark) == 0
+
+
+def test_spark_output_reads_back_like_the_parser_output(spark, leaderboards):
+    sparky.parse_directory(os.path.dirname(leaderboards[0]), storage.OUTPUT_DIR, spark)
+    expected = schema.validate(pd.concat([parser.parse_file(path) for path in leaderboards], ignore_index=True),
+                               "total")
+
+    actual = storage.read("total")
+    assert list(actual.columns) == schema.columns("total")
+    assert {column: str(dtype) for column, dtype in actual.dtypes.items()} == \
+        {name: schema.FIELDS[name].dtype for name in schema.columns("total")}
+    key = ["Time in France", "Sailor"]
+    pd.testing.assert_frame_equal(actual.sort_values(key).reset_index(drop=True),
+                                  expected.sort_values(key).reset_index(drop=True))
@@ -0,0 +1,150 @@
+#Weather fetching against the archive stub: how many requests the batched fetch makes, and that every row
+#gets the same wind as with the row by row fetch it replaced, and which errors the async fetch retries
+
+import asyncio
+import json
+import os
+import shutil
+
+import aiohttp
+import numpy as np
+import pandas as pd
+import pytest
+import requests
+
+import combiner
+import parser
+import schema
+import storage
+import stubs
+import weather_async
+from weather_cache import WeatherCache
+
+
+@pytest.fixture
+def archive(monkeypatch):
+    with stubs.archive_server() as server:
+        monkeypatch.setattr(combiner, "ARCHIVE_API_URL", f"{server.url}/v1/archive")
+        yield server
+
+
+@pytest.fixture
+def total(leaderboards):
+    storage.write(pd.concat([parser.parse_file(path) for path in leaderboards], ignore_index=True), "total")
+    return storage.read("total")
+
+
+def _cache(tmp_path, name: str) -> WeatherCache:
+    return WeatherCache(str(tmp_path / f"{name}.sqlite"))
+
+
+def test_batched_fetch_makes_one_request_per_batch(archive, total, tmp_path):
+    cache = _cache(tmp_path, "batched")
+    combiner.call_for_data_batched(output_path=str(tmp_path / "wind_data.csv"), cache=cache)
+
+    # The sample leaderboards are two days, each one fits in a request
+    batches = combiner.plan_weather_batches(total)
+    assert len(batches) == 2
+    assert len(archive.requests) == len(batches)
+
+    # Everything is in the cache now
+    combiner.call_for_data_batched(output_path=str(tmp_path / "wind_data_again.csv"), cache=cache)
+    assert len(archive.requests) == len(batches)
+    cache.close()
+
+
+def test_batched_fetch_matches_row_by_row_fetch(archive, total, tmp_path):
+    combiner.call_for_data_batched(output_path=str(tmp_path / "wind_data.csv"), cache=_cache(tmp_path, "batched"))
+    batched = pd.read_csv(tmp_path / "wind_data.csv", parse_dates=["Time in France"])
+    batched_requests = len(archive.requests)
+
+    cache = _cache(tmp_path, "rows")
+    by_row = np.array([combiner.fetch_weather_for_row(row, cache=cache) for _, row in total.iterrows()],
+                      dtype="float64")
+    assert len(archive.requests) - batched_requests > batched_requests
+
+    pd.testing.assert_frame_equal(batched[["Time in France", "Latitude", "Longitude", "Sailor"]],
+                                  total[["Time in France", "Latitude", "Longitude", "Sailor"]].astype({"Sailor": object}),
+                                  check_dtype=False)
+    assert not np.isnan(by_row).any()
+    np.testing.assert_array_equal(batched[combiner.WIND_COLUMNS].to_numpy(), by_row)
+    cache.close()
+
+
+def test_batch_is_retried_after_an_error(monkeypatch):
+    monkeypatch.setattr(combiner.time, "sleep", lambda seconds: None)
+    cells = [(46.5, -1.75), (46.25, -2.0)]
+    with stubs.archive_server(fail_first=1) as server, requests.Session() as session:
+        hourly = combiner.fetch_weather_batch(session, cells, "2024-11-10", "2024-11-10", api_url=server.url)
+        assert len(server.requests) == 2
+
+    assert [len(location["time"]) for location in hourly] == [24, 24]
+    assert hourly[1] == stubs.archive_hourly(46.25, -2.0, "2024-11-10", "2024-11-10")
+
+
+def test_row_by_row_fetch_only_waits_after_requests(archive, total, tmp_path, monkeypatch):
+    waits = []
+    monkeypatch.setattr(combiner, "sleep", waits.append)
+    combiner.create_fetch_parameters_csv()
+    cache = _cache(tmp_path, "rows")
+    combiner.call_for_data(0, chunk_size=20, cache=cache)
+    assert len(waits) == -(-len(total) // 20)
+
+    # The same rows as the second part are all answered by the cache, no request and no wait between chunks
+    waits.clear()
+    requests_made = len(archive.requests)
+    shutil.copyfile(os.path.join(combiner.OUTPUT_DIR, "fetch_parameters_first9999.csv"),
+                    os.path.join(combiner.OUTPUT_DIR, "fetch_parameters_rest.csv"))
+    combiner.call_for_data(1, chunk_size=20, cache=cache)
+    assert len(archive.requests) == requests_made
+    assert waits == []
+    cache.close()
+
+
+def test_add_weather_by_day_matches_whole_join(archive, total, tmp_path, monkeypatch):
+    combiner.call_for_data_batched(cache=_cache(tmp_path, "batched"))
+    wind = pd.read_csv(os.path.join(combiner.WIND_DIR, "wind_data.csv"), parse_dates=["Time in France"])
+    wind[["Wind Speed", "Wind Gust"]] = (wind[["Wind Speed", "Wind Gust"]] / 1.852).round(1)
+    expected, _ = combiner.join_weather(total, wind)
+    expected = schema.validate(expected, "dataset")
+    assert len(expected) == len(total)
+
+    # Chunks smaller than a day, so the days of the wind are put together from several chunks
+    monkeypatch.setattr(combiner, "WIND_CHUNK_ROWS", 7)
+    combiner.add_weather()
+    pd.testing.assert_frame_equal(storage.read("dataset"), expected)
+
+    # A dropped in total.csv instead of the Parquet dataset
+    storage.export_csv("total")
+    shutil.rmtree(storage.dataset_path("total"))
+    combiner.add_weather()
+    pd.testing.assert_frame_equal(storage.read("dataset"), expected)
+
+
+def _fetch_async(server, monkeypatch) -> tuple:
+    monkeypatch.setattr(combiner, "ARCHIVE_API_URL", server.url)
+
+    async def fetch():
+        async with aiohttp.ClientSession() as session:
+            return await weather_async.fetch_batch(session, weather_async.RateLimiter(), asyncio.Semaphore(1),
+                                                   [(46.5, -1.75)], "2024-11-10", "2024-11-10", base_delay=0.01)
+    return asyncio.run(fetch()), len(server.requests)
+
+
+@pytest.mark.parametrize("status, requests_made, fetched", [(429, 2, True), (503, 2, True), (400, 1, False)])
+def test_async_fetch_only_retries_rate_limits_and_server_errors(status, requests_made, fetched, monkeypatch):
+    with stubs.archive_server(fail_first=1, fail_status=status) as server:
+        hourly, made = _fetch_async(server, monkeypatch)
+    assert made == requests_made
+    assert (hourly is not None) == fetched
+
+
+def test_checkpoint_with_an_unreadable_header_is_discarded(tmp_path):
+    path = tmp_path / "checkpoint.jsonl"
+    record = json.dumps({"batch": 0, "wind": [[1.0, 2.0, 3.0]]}) + "\n"
+    path.write_text(json.dumps({"plan": "abc"}) + "\n" + record)
+    assert list(weather_async.load_checkpoint(str(path), "abc")) == [0]
+
+    for header in ['{"pla', "[1, 2]"]:
+        path.write_text(header + "\n" + record)
+        assert weather_async.load_checkpoint(str(path), "abc") == {}